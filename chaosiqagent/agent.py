@@ -9,8 +9,10 @@ from .client import get_client
 from .job import Jobs
 from .heartbeat import Heartbeat
 from .log import logger
+from .metrics import MetricsServer
 from .types import Config
-from .utils import raise_if_errored
+from .utils import Stop, raise_if_errored
+from .watchdog import LoopWatchdog
 
 __all__ = ["Agent"]
 
@@ -19,10 +21,15 @@ class Agent:
     def __init__(self, config: Config) -> None:
         self.client = get_client(config)
         self.backend = get_backend(config)
-        self.jobs = Jobs(config, self.backend)
+        # stops the jobs consumer and the heartbeat at once
+        self.stop = Stop()
+        self.jobs = Jobs(config, self.backend, self.client, self.stop)
         self._running = False
         self.action_url = "/agent/actions"
-        self.heartbeat = Heartbeat(config)
+        self.watchdog = LoopWatchdog(config)
+        self.heartbeat = Heartbeat(
+            config, self.client, self.jobs, self.stop, self.watchdog)
+        self.metrics = MetricsServer(config)
 
     @property
     def running(self) -> bool:
@@ -35,20 +42,31 @@ class Agent:
             self.jobs.setup(),
             self.backend.setup(),
             self.heartbeat.setup(),
+            self.metrics.setup(),
+            self.watchdog.setup(),
         ], return_when=asyncio.ALL_COMPLETED)
         raise_if_errored(*futures)
 
+        # the backend is now ready to run jobs left over by a previous run
+        await self.jobs.resume()
+
     async def cleanup(self) -> None:
         """
         Gracefully cleaning up the jobs consumer and its backend.
+
+        The shared HTTP client is closed last, once every component is done
+        talking to ChaosIQ.
         """
         futures = await asyncio.wait([
             self.disconnect(),
             self.jobs.cleanup(),
             self.backend.cleanup(),
             self.heartbeat.cleanup(),
+            self.metrics.cleanup(),
+            self.watchdog.cleanup(),
         ], return_when=asyncio.ALL_COMPLETED)
         self._running = False
+        await self.client.aclose()
         raise_if_errored(*futures)
 
     async def run(self) -> None:
@@ -57,19 +75,26 @@ class Agent:
         logger.info("Agent components configured")
 
         # handle SIG* as gracefully as we can so that jobs are cleanly
-        # cancelled
+        # cancelled: the consumer leaves right away and the agent is then
+        # cleaned up
         loop = asyncio.get_running_loop()
         signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
         for s in signals:
-            loop.add_signal_handler(
-                s, lambda s=s: asyncio.create_task(self.terminate()))
+            loop.add_signal_handler(s, self.stop.set)
 
         logger.info("Agent ready to consume jobs...")
         self._running = True
         await self.jobs.consume()
+        await self.terminate()
 
     async def terminate(self) -> None:
+        """
+        Drain the jobs before cleaning up, the agent disconnects once their
+        status are sent.
+        """
         logger.info("Terminating agent...")
+        self.stop.set()
+        await self.jobs.drain()
         await self.cleanup()
 
     async def register(self) -> None:
@@ -12,10 +12,19 @@ def get_backend(config: Config) -> BaseBackend:
     """
     backend_name = config.agent_backend
     if backend_name == "kubernetes":
+        if config.k8s_contexts:
+            from .k8s_fleet import K8SFleetBackend
+            return K8SFleetBackend(config)
         from .k8s import K8SBackend
         return K8SBackend(config)
     elif backend_name == "shell":
         from .shell import ShellBackend
         return ShellBackend(config)
+    elif backend_name == "inprocess":
+        from .inprocess import InProcessBackend
+        return InProcessBackend(config)
+    elif backend_name == "router":
+        from .router import RouterBackend
+        return RouterBackend(config)
     elif backend_name == "null":
         return NullBackend(config)
@@ -1,7 +1,16 @@
+from typing import Optional
+
 from ..log import logger
 from ..types import Config, Job, Backend
 
-__all__ = ["BaseBackend", "NullBackend"]
+__all__ = ["BaseBackend", "NullBackend", "JobDeclined"]
+
+
+class JobDeclined(Exception):
+    """
+    The backend has no room for the job, which is handed back to ChaosIQ
+    rather than reported as failed.
+    """
 
 
 class BaseBackend:
@@ -12,6 +21,21 @@ class BaseBackend:
     def name(self) -> Backend:
         return self.config.agent_backend
 
+    def backend_name(self, job: Job) -> str:
+        """
+        Name of the backend running the job.
+        """
+        name: str = self.name
+        return name
+
+    @property
+    def capacity(self) -> Optional[int]:
+        """
+        Jobs the backend holds at once, when it bounds them itself rather
+        than relying on the agent's `max_concurrent_jobs`.
+        """
+        return None
+
     async def setup(self) -> None:
         raise NotImplementedError()
 
@@ -0,0 +1,104 @@
+"""
+Warm Chaos Toolkit worker of the shell backend's pool.
+
+It runs with the interpreter of the Chaos Toolkit installation, which may
+not have the agent installed, so it must only depend on the standard
+library.
+
+The worker imports the Chaos Toolkit once and then runs the jobs it reads
+from stdin, one at a time. Messages are JSON, one per line:
+
+* stdin receives `{"args": [...], "settings": "..."}`, the arguments of the
+  `chaos` command and the Chaos Toolkit settings of the job
+* stdout sends `{"ready": pid}` once warm, then
+  `{"returncode": code, "rss": mib}` after each job
+
+The settings never touch the disk: the command reads them from a pipe,
+through its `/dev/fd` path. The output of the experiments goes to stderr.
+The worker exits when stdin is closed.
+"""
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import traceback
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+
+
+def main() -> None:
+    # keep stdout for the messages and send anything else to stderr
+    protocol = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    from chaostoolkit.cli import cli  # type: ignore
+
+    send(protocol, {"ready": os.getpid()})
+    for line in sys.stdin:
+        job = json.loads(line)
+        with settings_pipe(job.get("settings")) as options:
+            returncode = run(cli, options + job["args"])
+        sys.stderr.flush()
+        send(protocol, {"returncode": returncode, "rss": rss()})
+
+
+def run(cli: Any, args: List[str]) -> int:
+    try:
+        result = cli.main(args=args, prog_name="chaos", standalone_mode=False)
+    except SystemExit as x:
+        if x.code is None or isinstance(x.code, int):
+            return x.code or 0
+        return 1
+    except Exception:  # noqa: 0703
+        traceback.print_exc()
+        return 1
+    # click returns the exit code when the command exits early
+    return result if isinstance(result, int) else 0
+
+
+@contextlib.contextmanager
+def settings_pipe(settings: Optional[str]) -> Iterator[List[str]]:
+    """
+    `--settings` option of the command, reading the settings from a pipe.
+    A thread fills the pipe, so that the settings may be larger than its
+    buffer.
+    """
+    if settings is None:
+        yield []
+        return
+
+    read_fd, write_fd = os.pipe()
+
+    def write() -> None:
+        try:
+            with os.fdopen(write_fd, "w") as f:
+                f.write(settings)  # type: ignore
+        except BrokenPipeError:
+            # the command did not read them
+            pass
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        yield ["--settings", f"/dev/fd/{read_fd}"]
+    finally:
+        os.close(read_fd)
+        writer.join()
+
+
+def rss() -> int:
+    """
+    Peak resident memory of the worker, in MiB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def send(protocol: TextIO, message: Dict[str, Any]) -> None:
+    protocol.write(json.dumps(message) + "\n")
+    protocol.flush()
+
+
+if __name__ == "__main__":
+    main()
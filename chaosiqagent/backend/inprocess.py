@@ -0,0 +1,215 @@
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Dict, List, Optional
+
+import yaml
+
+from ..ctk import get_chaostoolkit_settings
+from ..log import logger
+from ..types import Config, Job
+from .shell import ShellBackend
+
+__all__ = ["InProcessBackend", "JobTimeout"]
+
+
+class JobTimeout(BaseException):
+    """
+    Raised in the pool's process when the experiment ran for too long. It
+    is not an `Exception` so that the toolkit does not swallow it.
+    """
+    pass
+
+
+class InProcessBackend(ShellBackend):
+    """
+    Run the experiments with the Chaos Toolkit's Python API, in a pool of
+    `inprocess_workers` processes, so that jobs pay neither for starting the
+    `chaos` command nor for writing their settings to a temporary file.
+
+    Each process runs up to `inprocess_max_jobs_per_worker` jobs, and each
+    job up to `inprocess_job_timeout` seconds.
+
+    Verifications are run by the ChaosIQ extension's `verify` command rather
+    than by the Python API, they are still run with `chaos_binary`.
+    """
+    def __init__(self, config: Config) -> None:
+        ShellBackend.__init__(self, config)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        # jobs submitted to the current executor
+        self.executor_jobs = 0
+        # previous executors, shutting down once their jobs are done
+        self.retired: List[Awaitable[None]] = []
+
+    async def setup(self) -> None:
+        if importlib.util.find_spec("chaoslib") is None:
+            raise RuntimeError(
+                "The Chaos Toolkit must be installed alongside the agent to "
+                "run experiments in process")
+
+        logger.info(
+            f"Backend '{self.name}' running experiments in "
+            f"{self.config.inprocess_workers} processes")
+        self.executor = self.create_executor()
+        if self.bin:
+            await ShellBackend.setup(self)
+
+    async def cleanup(self) -> None:
+        if self.executor:
+            self.retire(self.executor)
+            self.executor = None
+        await asyncio.gather(*self.retired)
+        self.retired = []
+        await ShellBackend.cleanup(self)
+
+    def retire(self, executor: ProcessPoolExecutor) -> None:
+        """
+        Shut the executor down, in a thread since it waits for its jobs.
+        `shutdown(wait=False)` would leave the processes behind on Python
+        3.8.
+        """
+        loop = asyncio.get_running_loop()
+        self.retired.append(loop.run_in_executor(None, executor.shutdown))
+
+    def kill(self, executor: ProcessPoolExecutor) -> None:
+        """
+        Kill the executor's processes, rather than waiting for experiments
+        nobody waits for anymore. The other jobs they were running fail.
+        """
+        processes = executor._processes or {}  # type: ignore
+        if not processes:
+            return
+        logger.warning("Killing the processes running experiments")
+        for process in list(processes.values()):
+            process.kill()
+        if executor is self.executor:
+            self.executor = self.create_executor()
+        self.retire(executor)
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        """
+        Processes are spawned rather than forked from the agent, whose event
+        loop and connections they must not inherit.
+        """
+        self.executor_jobs = 0
+        kwargs: Dict[str, Any] = {}
+        if sys.version_info >= (3, 11):  # pragma: no cover
+            kwargs["max_tasks_per_child"] = \
+                self.config.inprocess_max_jobs_per_worker
+        return ProcessPoolExecutor(
+            max_workers=self.config.inprocess_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_up, **kwargs)
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        """
+        Executor to submit the next job to.
+
+        Before Python 3.11, processes cannot be replaced one by one after
+        a number of jobs, the whole pool is replaced instead once it ran
+        as many jobs as all of its processes should have.
+        """
+        executor: ProcessPoolExecutor = self.executor  # type: ignore
+        limit = self.config.inprocess_workers * \
+            self.config.inprocess_max_jobs_per_worker
+        if sys.version_info < (3, 11) and self.executor_jobs >= limit:
+            logger.info("Recycling the processes running experiments")
+            # jobs already submitted carry on in the previous processes
+            self.retire(executor)
+            executor = self.executor = self.create_executor()
+        self.executor_jobs += 1
+        return executor
+
+    async def process_job(self, job: Job) -> None:
+        """
+        Run the experiment in one of the pool's processes, the settings are
+        handed over in memory.
+
+        The job fails when the experiment did not complete or did not
+        complete in time. When the job is cancelled, the pool's processes
+        are killed.
+        """
+        if job.target_type == "verification":
+            if not self.bin:
+                raise RuntimeError(
+                    "Verifications need the 'chaos' binary to be set")
+            await ShellBackend.process_job(self, job)
+            return
+
+        settings = get_chaostoolkit_settings(
+            self.config, job.access_token,
+            org_id=job.org_id, team_id=job.team_id)
+        timeout = self.config.inprocess_job_timeout
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        try:
+            status = await loop.run_in_executor(
+                executor, run_experiment, job.target_url,
+                settings, self.config.verify_tls, timeout)
+        except JobTimeout:
+            raise RuntimeError(
+                f"Experiment did not complete within {timeout}s")
+        except asyncio.CancelledError:
+            # the experiment would carry on in the pool's process, and hold
+            # the agent's termination up until it ends
+            self.kill(executor)
+            raise
+
+        logger.info(f"Experiment of job '{job.id}' ended as '{status}'")
+        if status != "completed":
+            raise RuntimeError(f"Experiment ended as '{status}'")
+
+
+###############################################################################
+# Pool's processes
+###############################################################################
+
+def warm_up() -> None:
+    """
+    Import the toolkit once per process, and send its logs to stderr.
+    """
+    import chaoslib.experiment  # type: ignore # noqa: F401
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(
+        "[%(asctime)s %(levelname)s] [%(process)d] %(message)s"))
+    chaostoolkit_logger = logging.getLogger("chaostoolkit")
+    chaostoolkit_logger.addHandler(handler)
+    chaostoolkit_logger.setLevel(logging.INFO)
+
+
+def run_experiment(target_url: str, settings: str, verify_tls: bool,
+                   timeout: float) -> str:
+    """
+    Load and run the experiment, and return the status of its journal.
+    """
+    from chaoslib.control import (  # type: ignore
+        cleanup_global_controls, load_global_controls)
+    from chaoslib.experiment import (  # type: ignore
+        ensure_experiment_is_valid, run_experiment as run)
+    from chaoslib.loader import load_experiment  # type: ignore
+
+    signal.signal(signal.SIGALRM, timed_out)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        loaded = yaml.safe_load(settings)
+        load_global_controls(loaded)
+        try:
+            experiment = load_experiment(
+                target_url, loaded, verify_tls=verify_tls)
+            ensure_experiment_is_valid(experiment)
+            journal = run(experiment, settings=loaded)
+        finally:
+            cleanup_global_controls()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    status: str = journal["status"]
+    return status
+
+
+def timed_out(signum: int, frame: Any) -> None:
+    raise JobTimeout()
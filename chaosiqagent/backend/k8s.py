@@ -1,18 +1,26 @@
+import asyncio
+import copy
 import os
 import yaml
-from typing import Dict
+from typing import Any, Dict, Optional
 
 from kubernetes_asyncio import config
 from kubernetes_asyncio.config.incluster_config import load_incluster_config, \
     SERVICE_TOKEN_FILENAME
-from kubernetes_asyncio.client.api_client import ApiClient  # noqa: 0611 required by unit tests mock
-from kubernetes_asyncio.client.api import core_v1_api, custom_objects_api
+from kubernetes_asyncio.client.api_client import ApiClient
+from kubernetes_asyncio.client.api import custom_objects_api
+from kubernetes_asyncio.client.rest import ApiException
 
 from kubernetes_asyncio.config.kube_config import Configuration
 
 from ..ctk import get_chaostoolkit_settings
+from ..metrics import BACKEND_WAIT, K8S_SUBMISSION
 from ..types import Config, Job
 from .base import BaseBackend
+from .k8s_admission import Admission
+from .k8s_reaper import Reaper
+from .k8s_settings import SettingsSecrets, get_settings_secret_name
+from .k8s_watch import ExperimentFailed, ExperimentsWatch
 from ..log import logger
 
 __all__ = ["K8SBackend"]
@@ -23,12 +31,21 @@ SETTINGS_NAME = "chaostoolkit-settings"
 
 
 class K8SBackend(BaseBackend):
-    def __init__(self, config: Config) -> None:
+    def __init__(self, config: Config, context: Optional[str] = None) -> None:
         BaseBackend.__init__(self, config)
+        # kubeconfig context of the cluster, its current one when not set
+        self.context = context
 
         # we keep our own config for kubernetes rather than use their default
         # global one as it prevents weird side effects
         self.k8s_config = Configuration()
+        # shared by all jobs so that its connections to the API server are
+        # kept alive from one job to the next
+        self.k8s_client: Optional[ApiClient] = None
+        self.watch: Optional[ExperimentsWatch] = None
+        self.reaper: Optional[Reaper] = None
+        self.settings: Optional[SettingsSecrets] = None
+        self.admission: Optional[Admission] = None
 
     async def setup(self) -> None:
         if not self.config.ctk_docker_image:
@@ -37,9 +54,12 @@ class K8SBackend(BaseBackend):
 
         logger.info(f"Using CTK docker image '{self.config.ctk_docker_image}'")
 
-        if os.path.isfile(SERVICE_TOKEN_FILENAME):  # pragma: no cover
+        if os.path.isfile(SERVICE_TOKEN_FILENAME) and \
+                not self.context:  # pragma: no cover
             logger.info("Running from a Kubernetes pod")
-            self.k8s_config = load_incluster_config()
+            load_incluster_config()
+            # the in-cluster config can only be loaded as the default one
+            self.k8s_config = Configuration.get_default_copy()
             logger.info("Kubernetes config loaded successfully from pod")
         else:
             kubecfg = os.path.expanduser(
@@ -50,12 +70,46 @@ class K8SBackend(BaseBackend):
 
             await config.load_kube_config(
                 config_file=kubecfg,
+                context=self.context,
                 client_configuration=self.k8s_config,
                 persist_config=False)
-            logger.info(f"Kubernetes config '{kubecfg}' loaded successfully")
+            if self.context:
+                logger.info(
+                    f"Kubernetes config '{kubecfg}' loaded successfully "
+                    f"for context '{self.context}'")
+            else:
+                logger.info(
+                    f"Kubernetes config '{kubecfg}' loaded successfully")
+
+        self.k8s_config.connection_pool_maxsize = \
+            self.config.k8s_max_connections
+        self.k8s_client = ApiClient(configuration=self.k8s_config)
+        self.settings = SettingsSecrets(self.k8s_client)
+        self.reaper = Reaper(self.config, self.k8s_client)
+        await self.reaper.setup()
+        self.watch = ExperimentsWatch(
+            self.k8s_client, on_finished=self.reaper.job_finished)
+        await self.watch.setup()
+        self.admission = Admission(self.config, self.k8s_client, self.watch)
+        await self.admission.setup()
         # await self.create_default_namespaces()
 
     async def cleanup(self) -> None:
+        if self.admission:
+            await self.admission.cleanup()
+            self.admission = None
+        if self.watch:
+            await self.watch.cleanup()
+            self.watch = None
+        if self.reaper:
+            await self.reaper.cleanup()
+            self.reaper = None
+        if self.settings:
+            await self.settings.cleanup()
+            self.settings = None
+        if self.k8s_client:
+            await self.k8s_client.close()
+            self.k8s_client = None
         self.k8s_config = None
 
     # async def create_default_namespaces(self) -> None:
@@ -77,16 +131,24 @@ class K8SBackend(BaseBackend):
     async def process_job(self, job: Job) -> None:
         """
         Create the custom resource object that the Chaos Toolkit operator
-        can consume.
+        can consume, and wait for its experiment to complete.
+
+        The settings secret and the experiment are submitted together since
+        the secret's name is known beforehand: the experiment's pod does not
+        start until the secret it mounts exists.
+
+        The job is held, or declined, while the cluster is saturated. It
+        fails when the experiment's pod fails, when the experiment
+        is deleted or when it did not complete within `k8s_job_timeout`
+        seconds. Either way, its objects are reaped once the retention
+        period is over. When the submission fails, the experiment is
+        withdrawn right away.
         """
         settings = get_chaostoolkit_settings(
             self.config, job.access_token,
             org_id=job.org_id, team_id=job.team_id)
-        settings_name = f"settings-{job.id}"
+        settings_name = get_settings_secret_name(settings, str(job.agent_id))
 
-        labels = get_k8s_labels_for_job(job)
-        secret = render_secret_manifest(
-            settings, settings_name=settings_name, labels=labels)
         experiment = render_experiment_manifest(
             job,
             verify_tls=self.config.verify_tls,
@@ -94,99 +156,159 @@ class K8SBackend(BaseBackend):
             ctk_docker_image=self.config.ctk_docker_image,
         )
 
-        async with ApiClient(configuration=self.k8s_config) as k8s_client:
-            # create the secret containing the CTK settings
+        # nothing may be awaited between the admission and the tracking of
+        # the job, which accounts for it
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await self.admission.admit(job)  # type: ignore
+        completed = self.watch.track(job)  # type: ignore
+        BACKEND_WAIT.observe(loop.time() - start, self.name)
+        # the secret containing the CTK settings is shared by the jobs of
+        # the same agent, team and access token
+        start = loop.time()
+        acquired = asyncio.ensure_future(self.acquire_settings(job, settings))
+        created = asyncio.ensure_future(self.create_experiment(experiment))
+        try:
             try:
-                api = core_v1_api.CoreV1Api(k8s_client)
-                secret = await api.create_namespaced_secret(
-                    namespace="chaostoolkit-run", body=yaml.safe_load(secret))
-                assert secret is not None
-            except Exception:  # pragma: no cover
-                logger.exception("Cannot create the secret on K8s")
+                await asyncio.gather(acquired, created)
+            except BaseException:
+                await self.withdraw_experiment(job, created)
                 raise
+            K8S_SUBMISSION.observe(loop.time() - start)
 
-            # create the experiment custom resource
+            timeout = self.config.k8s_job_timeout
             try:
-                api = custom_objects_api.CustomObjectsApi(k8s_client)
-                co = await api.create_namespaced_custom_object(
-                    # group, version, namespace, plural, body
-                    "chaostoolkit.org",
-                    "v1",
-                    "chaostoolkit-crd",
-                    "chaosexperiments",
-                    yaml.safe_load(experiment),
-                )
-                assert co is not None
-                logger.info("CRO submitted to Chaos Toolkit operator")
-            except Exception:  # pragma: no cover
-                logger.exception("Cannot create the experiment on K8s")
-                raise
+                await asyncio.wait_for(completed, timeout)
+            except asyncio.TimeoutError:
+                raise ExperimentFailed(
+                    f"Experiment did not complete within {timeout}s")
+            logger.info(f"Experiment of job '{job.id}' completed")
+        finally:
+            self.watch.forget(job)  # type: ignore
+            self.reaper.job_finished(str(job.id))  # type: ignore
+            try:
+                await acquired
+            except Exception:
+                # the secret was released when it failed to be created
+                pass
+            else:
+                await self.settings.release(settings_name)  # type: ignore
+
+    async def acquire_settings(self, job: Job, settings: str) -> str:
+        try:
+            settings_name: str = await self.settings.acquire(  # type: ignore
+                settings, str(job.agent_id), str(job.org_id),
+                str(job.team_id) if job.team_id else None)
+            return settings_name
+        except Exception:
+            logger.exception("Cannot create the secret on K8s")
+            raise
+
+    async def create_experiment(self, experiment: Dict[str, Any]) -> None:
+        try:
+            api = custom_objects_api.CustomObjectsApi(self.k8s_client)
+            co = await api.create_namespaced_custom_object(
+                # group, version, namespace, plural, body
+                "chaostoolkit.org",
+                "v1",
+                "chaostoolkit-crd",
+                "chaosexperiments",
+                experiment,
+            )
+            assert co is not None
+            logger.info("CRO submitted to Chaos Toolkit operator")
+        except Exception:
+            logger.exception("Cannot create the experiment on K8s")
+            raise
+
+    async def withdraw_experiment(self, job: Job,
+                                  created: asyncio.Future) -> None:
+        """
+        Cancel the creation of the job's experiment, and delete it unless
+        its creation failed. Its pod must not start, even once the secret
+        it mounts is created by the next job of the team, since the job
+        failed.
+        """
+        created.cancel()
+        try:
+            await created
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            return
+
+        # the generated client cannot delete a custom object by name
+        try:
+            await self.k8s_client.call_api(  # type: ignore
+                "/apis/{group}/{version}/namespaces/{namespace}/{plural}/"
+                "{name}", "DELETE", path_params={
+                    "group": "chaostoolkit.org",
+                    "version": "v1",
+                    "namespace": "chaostoolkit-crd",
+                    "plural": "chaosexperiments",
+                    "name": str(job.id),
+                },
+                header_params={"Accept": "application/json"},
+                response_type="object", auth_settings=["BearerToken"],
+                _return_http_data_only=True)
+            logger.info(f"Experiment of job '{job.id}' withdrawn")
+        except ApiException as x:
+            if x.status != 404:
+                logger.error(
+                    f"Failed to delete experiment of job '{job.id}': {x}")
 
 
 ###############################################################################
 # Internals
 ###############################################################################
 
+def load_manifest_template(name: str) -> Dict[str, Any]:
+    with open(os.path.join(K8S_TEMPLATES, name)) as f:
+        template: Dict[str, Any] = yaml.safe_load(f)
+        return template
+
+
+# parsed once, each job gets its own copy to fill
+EXPERIMENT_TEMPLATE = load_manifest_template("experiment.yaml")
+SECRET_TEMPLATE = load_manifest_template("secret.yaml")
+
+
 def render_experiment_manifest(
         job: Job, verify_tls: bool = True,
         settings_name: str = SETTINGS_NAME,
         ctk_docker_image: str = 'chaosiq/chaostoolkit',
-        ) -> str:
-    with open(os.path.join(K8S_TEMPLATES, "experiment.yaml")) as f:
-        template = f.read()
-        labels = get_k8s_labels_for_job(job)
-        experiment = template.format(
-            name=job.id,  # we use the Job ID as the experiment name !
-            chaos_cmd="verify" if job.target_type == "verification" else "run",
-            asset_url=job.target_url,
-            # the leading dash indicates the optional list item for chaos args
-            no_verify_tls='- --no-verify-tls' if not verify_tls else '',
-            settings_name=settings_name,
-            ctk_docker_image=ctk_docker_image,
-            **labels,
-        )
-        return experiment
-
-
-# def render_secret_manifest(settings: str) -> str:
-#     """
-#     We load both settings & secret manifest as YAML, so that we can easily
-#     inject the multi-lines settings into the secret manifest
-#     """
-#     with open(os.path.join(K8S_TEMPLATES, "secret.yaml")) as f:
-#         template = f.read()
-#         secret = yaml.safe_load(template)
-#         secret['stringData']['settings.yaml'] = yaml.safe_load(settings)
-#         secret = yaml.safe_dump(secret)
-#         return secret
+        ) -> Dict[str, Any]:
+    experiment = copy.deepcopy(EXPERIMENT_TEMPLATE)
+    # we use the Job ID as the experiment name !
+    experiment["metadata"]["name"] = str(job.id)
+    experiment["metadata"]["labels"] = get_k8s_labels_for_job(job)
+
+    pod = experiment["spec"]["pod"]
+    pod["image"] = ctk_docker_image
+    pod["chaosArgs"] = [
+        "verify" if job.target_type == "verification" else "run",
+        job.target_url,
+    ]
+    if not verify_tls:
+        pod["chaosArgs"].append("--no-verify-tls")
+    pod["settings"]["secretName"] = settings_name
+    return experiment
 
 
 def render_secret_manifest(
         settings: str,
         settings_name: str = SETTINGS_NAME,
         labels: Dict[str, str] = None,
-        ) -> str:
+        ) -> Dict[str, Any]:
     """
-    We need to keep the settings as a multi-line string content
-    so that the K8s secret can base64 encode it on creation/update
+    The settings are kept as a multi-line string content so that the K8s
+    secret can base64 encode it on creation/update
     """
-    with open(os.path.join(K8S_TEMPLATES, "secret.yaml")) as f:
-        template = f.read()
-        labels = labels or {}
-        secret = template.format(
-            settings=_indent_settings(settings),
-            settings_name=settings_name,
-            job_id=labels.get("job_id", ""),
-            job_type=labels.get("job_type", "")
-        )
-        return secret
-
-
-def _indent_settings(settings: str, indent: int = 4) -> str:
-    spaces = ' ' * indent
-    lines = settings.split(os.linesep)
-    lines = [f"{spaces}{line}" for line in lines]
-    return str(os.linesep.join(lines))
+    secret = copy.deepcopy(SECRET_TEMPLATE)
+    secret["metadata"]["name"] = settings_name
+    secret["metadata"]["labels"] = labels or {}
+    secret["stringData"]["settings.yaml"] = settings
+    return secret
 
 
 # def render_namespace_manifest(name: str) -> str:
@@ -202,6 +324,6 @@ def get_k8s_labels_for_job(job: Job) -> Dict[str, str]:
     to insert into the metadata for Kubernetes objects
     """
     return {
-        "job_id": job.id,
-        "job_type": job.target_type,
+        "job": str(job.id),
+        "type": job.target_type,
     }
@@ -0,0 +1,187 @@
+import asyncio
+from decimal import Decimal
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Type
+
+import aiojobs
+from aiojobs import Scheduler
+from kubernetes_asyncio.client.api import core_v1_api
+from kubernetes_asyncio.client.api_client import ApiClient
+from kubernetes_asyncio.client.rest import ApiException
+
+from ..log import logger
+from ..types import Config, Job
+from .k8s_watch import ExperimentsWatch
+
+__all__ = ["Admission", "ClusterSaturated", "parse_quantity"]
+
+QUANTITY_SUFFIXES = {
+    "Ki": Decimal(2 ** 10), "Mi": Decimal(2 ** 20), "Gi": Decimal(2 ** 30),
+    "Ti": Decimal(2 ** 40), "Pi": Decimal(2 ** 50), "Ei": Decimal(2 ** 60),
+    "n": Decimal("1e-9"), "u": Decimal("1e-6"), "m": Decimal("1e-3"),
+    "k": Decimal("1e3"), "M": Decimal("1e6"), "G": Decimal("1e9"),
+    "T": Decimal("1e12"), "P": Decimal("1e15"), "E": Decimal("1e18"),
+}
+
+
+class ClusterSaturated(Exception):
+    pass
+
+
+class Admission:
+    """
+    Admission of the jobs on the cluster, so that a burst of jobs does not
+    flood the `chaostoolkit-run` namespace.
+
+    The cluster is saturated when `k8s_max_experiments` experiments are
+    already pending or running there, as told by the pods watch cache and
+    the jobs being submitted, or when a resource of the `k8s_resource_quota`
+    ResourceQuota is used up. The quota is read every `k8s_quota_interval`
+    seconds.
+
+    Jobs are then held until the cluster has room again, or declined,
+    depending on `k8s_saturation_policy`.
+    """
+    def __init__(self, config: Config, k8s_client: ApiClient,
+                 watch: ExperimentsWatch) -> None:
+        self.sched: Scheduler = None
+        self.config = config
+        self.k8s_client = k8s_client
+        self.watch = watch
+        # resources of the quota that are used up
+        self.exhausted: List[str] = []
+        self.held = 0
+        self.declined = 0
+        self._running = False
+
+    async def __aenter__(self) -> 'Admission':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when the resource quota is being followed.
+        """
+        return self._running
+
+    @property
+    def experiments(self) -> int:
+        """
+        Experiments pending or running on the cluster, including the ones
+        being submitted.
+        """
+        return len(self.watch.active | set(self.watch.in_flight))
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "experiments": self.experiments,
+            "exhausted": list(self.exhausted),
+            "held": self.held,
+            "declined": self.declined,
+        }
+
+    async def setup(self) -> None:
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        self._running = True
+        if self.config.k8s_resource_quota:
+            logger.info(
+                f"Following the '{self.config.k8s_resource_quota}' resource "
+                f"quota")
+            await self.sched.spawn(self.follow_quota())
+
+    async def cleanup(self) -> None:
+        self._running = False
+        if not self.sched.closed:
+            await asyncio.wait_for(self.sched.close(), None)
+
+    def saturation(self) -> Optional[str]:
+        """
+        Why the cluster is saturated, if it is.
+        """
+        limit = self.config.k8s_max_experiments
+        if limit and self.experiments >= limit:
+            return f"{self.experiments} experiments out of {limit}"
+        if self.exhausted:
+            return (
+                f"'{self.config.k8s_resource_quota}' resource quota used up "
+                f"({', '.join(self.exhausted)})")
+        return None
+
+    async def admit(self, job: Job) -> None:
+        """
+        Return once the job can be submitted to the cluster, which must be
+        done right away so that the job is accounted for.
+
+        Raises `ClusterSaturated` when the job is declined.
+        """
+        reason = self.saturation()
+        if reason is None:
+            return
+
+        if self.config.k8s_saturation_policy == "decline":
+            self.declined += 1
+            raise ClusterSaturated(f"Cluster is saturated: {reason}")
+
+        self.held += 1
+        logger.info(f"Holding job '{job.id}', cluster is saturated: {reason}")
+        while self.saturation():
+            self.watch.freed.clear()
+            await self.watch.freed.wait()
+        logger.info(f"Admitting job '{job.id}'")
+
+    async def follow_quota(self) -> None:
+        """
+        Periodically read the resource quota's usage.
+        """
+        api = core_v1_api.CoreV1Api(self.k8s_client)
+        while self._running:
+            try:
+                quota = await api.read_namespaced_resource_quota(
+                    self.config.k8s_resource_quota, "chaostoolkit-run")
+                hard = quota.status.hard or {}
+                used = quota.status.used or {}
+                self.exhausted = [
+                    resource for resource, limit in hard.items()
+                    if parse_quantity(used.get(resource, "0")) >=
+                    parse_quantity(limit)
+                ]
+                # jobs held by the quota may be admitted now
+                self.watch.freed.set()
+            except ApiException as x:
+                logger.error(
+                    f"Failed to read the "
+                    f"'{self.config.k8s_resource_quota}' resource quota: "
+                    f"{x.status} {x.reason}")
+            except Exception as x:
+                # keep polling, the quota may be readable again later
+                logger.error(
+                    f"Failed to read the "
+                    f"'{self.config.k8s_resource_quota}' resource quota: "
+                    f"{type(x).__name__} {x}")
+            await asyncio.sleep(self.config.k8s_quota_interval)
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
+
+
+def parse_quantity(quantity: str) -> Decimal:
+    """
+    Value of a Kubernetes resource quantity, such as `500m` or `2Gi`.
+    """
+    for suffix in (quantity[-2:], quantity[-1:]):
+        if suffix in QUANTITY_SUFFIXES:
+            number = quantity[:-len(suffix)]
+            return Decimal(number) * QUANTITY_SUFFIXES[suffix]
+    return Decimal(quantity)
@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Dict, List
+
+from ..log import logger
+from ..types import Config, Job
+from .base import BaseBackend
+from .k8s import K8SBackend
+
+__all__ = ["K8SFleetBackend", "get_eligible_clusters"]
+
+
+class K8SFleetBackend(BaseBackend):
+    """
+    Kubernetes backend spreading jobs over the clusters of the
+    `k8s_contexts` kubeconfig contexts.
+
+    Each job runs on the eligible cluster with the fewest experiments in
+    flight, the first one listed on a tie. Jobs may restrict the eligible
+    clusters with the `k8s_clusters` hint of their payload.
+    """
+    def __init__(self, config: Config) -> None:
+        BaseBackend.__init__(self, config)
+        self.clusters: Dict[str, K8SBackend] = {
+            context: K8SBackend(config, context=context)
+            for context in config.k8s_contexts
+        }
+        # experiments in flight on each cluster
+        self.in_flight: Dict[str, int] = {
+            context: 0 for context in self.clusters}
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": dict(self.in_flight)}
+
+    async def setup(self) -> None:
+        logger.info(
+            f"Spreading jobs over the Kubernetes contexts "
+            f"{', '.join(self.clusters)}")
+        await asyncio.gather(*[c.setup() for c in self.clusters.values()])
+
+    async def cleanup(self) -> None:
+        await asyncio.gather(*[c.cleanup() for c in self.clusters.values()])
+
+    def place(self, job: Job) -> str:
+        """
+        Context of the least loaded cluster the job can run on.
+        """
+        eligible = get_eligible_clusters(job, list(self.clusters))
+        if not eligible:
+            raise ValueError(
+                f"None of the Kubernetes contexts "
+                f"{', '.join(self.clusters)} is eligible for the job")
+        return min(eligible, key=lambda context: self.in_flight[context])
+
+    async def process_job(self, job: Job) -> None:
+        context = self.place(job)
+        logger.info(
+            f"Running job '{job.id}' on Kubernetes context '{context}'")
+        self.in_flight[context] += 1
+        try:
+            await self.clusters[context].process_job(job)
+        finally:
+            self.in_flight[context] -= 1
+
+
+def get_eligible_clusters(job: Job, contexts: List[str]) -> List[str]:
+    """
+    Contexts the job's `k8s_clusters` payload hint allows, a single context
+    or a list of them, every context without a hint.
+    """
+    hint = (job.payload or {}).get("k8s_clusters")
+    if not hint:
+        return contexts
+    if isinstance(hint, str):
+        hint = [hint]
+    return [context for context in contexts if context in hint]
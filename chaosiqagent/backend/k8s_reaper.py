@@ -0,0 +1,157 @@
+import asyncio
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Type
+
+import aiojobs
+from aiojobs import Scheduler
+from kubernetes_asyncio.client.api_client import ApiClient
+
+from ..log import logger
+from ..types import Config
+
+__all__ = ["Reaper"]
+
+# the generated client cannot select the custom objects to delete by label
+COLLECTIONS = {
+    "experiments": ("/apis/{group}/{version}/namespaces/{namespace}/{plural}", {
+        "group": "chaostoolkit.org",
+        "version": "v1",
+        "namespace": "chaostoolkit-crd",
+        "plural": "chaosexperiments",
+    }),
+}
+
+
+class Reaper:
+    """
+    Delete the experiment resources of the jobs that finished more than
+    `k8s_retention` seconds ago. Settings secrets are shared by the jobs of
+    a team, they are deleted by `SettingsSecrets` instead.
+
+    Objects are deleted by batch, with a `deletecollection` call per kind of
+    objects selecting up to `k8s_reaper_batch_size` jobs by their `job`
+    label, and at most one batch every `k8s_reaper_interval` seconds so that
+    the API server is not flooded.
+    """
+    def __init__(self, config: Config, k8s_client: ApiClient) -> None:
+        self.sched: Scheduler = None
+        self.config = config
+        self.k8s_client = k8s_client
+        # when jobs finished, by identifier, oldest first
+        self.finished: Dict[str, float] = {}
+        self.reclaimed = 0
+        self._running = False
+
+    async def __aenter__(self) -> 'Reaper':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when finished jobs are being reaped.
+        """
+        return self._running
+
+    async def setup(self) -> None:
+        logger.info(
+            f"Reaping Kubernetes objects of jobs finished for more than "
+            f"{self.config.k8s_retention}s")
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        self._running = True
+        await self.sched.spawn(self.reap())
+
+    async def cleanup(self) -> None:
+        self._running = False
+        if not self.sched.closed:
+            logger.info("Closing Kubernetes objects reaper")
+            await asyncio.wait_for(self.sched.close(), None)
+
+    def job_finished(self, job_id: str) -> None:
+        """
+        Mark the job's objects for deletion once the retention period is
+        over.
+        """
+        if job_id not in self.finished:
+            self.finished[job_id] = asyncio.get_running_loop().time()
+
+    async def reap(self) -> None:
+        """
+        Periodically delete a batch of objects that are due.
+        """
+        while self._running:
+            await asyncio.sleep(self.config.k8s_reaper_interval)
+            await self.collect()
+
+    async def collect(self) -> int:
+        """
+        Delete the objects of a batch of jobs whose retention period is over,
+        and return how many objects were deleted.
+        """
+        due = self.due_jobs()
+        if not due:
+            return 0
+
+        selector = f"job in ({','.join(due)})"
+        try:
+            counts = await asyncio.gather(*[
+                self.delete_collection(kind, selector)
+                for kind in COLLECTIONS])
+        except Exception as x:
+            # such as an API or a connection error, these jobs are tried
+            # again with the next batch
+            logger.error(
+                f"Failed to delete finished jobs objects: "
+                f"{type(x).__name__} {x}")
+            return 0
+
+        for job_id in due:
+            del self.finished[job_id]
+        reclaimed: int = sum(counts)
+        self.reclaimed += reclaimed
+        logger.info(
+            f"Reclaimed {reclaimed} Kubernetes objects of {len(due)} "
+            f"finished jobs ({self.reclaimed} overall)")
+        return reclaimed
+
+    def due_jobs(self) -> List[str]:
+        """
+        Oldest finished jobs whose retention period is over, a batch at most.
+        """
+        deadline = asyncio.get_running_loop().time() - \
+            self.config.k8s_retention
+        due: List[str] = []
+        for job_id, finished_at in self.finished.items():
+            if finished_at > deadline or \
+                    len(due) >= self.config.k8s_reaper_batch_size:
+                return due
+            due.append(job_id)
+        return due
+
+    async def delete_collection(self, kind: str, selector: str) -> int:
+        """
+        Delete the objects of that kind matching the label selector and
+        return how many were deleted.
+        """
+        path, params = COLLECTIONS[kind]
+        deleted = await self.k8s_client.call_api(
+            path, "DELETE", path_params=params,
+            query_params=[("labelSelector", selector)],
+            header_params={"Accept": "application/json"},
+            response_type="object", auth_settings=["BearerToken"],
+            _return_http_data_only=True)
+        items = (deleted or {}).get("items") or []
+        return len(items)
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+from collections import Counter
+from typing import Any, Dict, Optional, Set, Tuple
+
+from kubernetes_asyncio.client.api import core_v1_api
+from kubernetes_asyncio.client.api_client import ApiClient
+from kubernetes_asyncio.client.rest import ApiException
+
+from ..log import logger
+
+__all__ = ["SettingsSecrets", "get_settings_secret_name"]
+
+
+class SettingsSecrets:
+    """
+    Secrets holding the Chaos Toolkit settings, shared by the jobs of the
+    same organization and team run with the same access token, so that most
+    jobs do not have to write a secret of their own.
+
+    Secrets are named after the digest of their settings and of the agent,
+    which they are labelled with too, so that agents sharing the namespace
+    never delete the secrets of one another. When the access token of a
+    team changes, jobs get a new secret, and the previous one is
+    deleted once the last job using it is done. The secrets of a team left
+    by a previous run of the agent are deleted, in the background, once its
+    first job got its secret.
+    """
+    def __init__(self, k8s_client: ApiClient) -> None:
+        self.k8s_client = k8s_client
+        # current secret of each agent, organization and team
+        self.current: Dict[Tuple[str, str, str], str] = {}
+        # secrets created, or being created, by name
+        self.created: Dict[str, asyncio.Future] = {}
+        # in-flight jobs using each secret
+        self.users: Counter = Counter()
+        # deletions of the secrets left by a previous run
+        self.sweeps: Set[asyncio.Future] = set()
+        self.writes = 0
+        self.reused = 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "secrets": len(self.created),
+            "writes": self.writes,
+            "reused": self.reused,
+        }
+
+    async def cleanup(self) -> None:
+        for sweep in self.sweeps:
+            sweep.cancel()
+        await asyncio.gather(*self.sweeps, return_exceptions=True)
+        self.sweeps.clear()
+
+    async def acquire(self, settings: str, agent_id: str,
+                      org_id: Optional[str], team_id: Optional[str]) -> str:
+        """
+        Name of the secret holding these settings, created when needed.
+        The secret must be released once the job is done.
+        """
+        name = get_settings_secret_name(settings, agent_id)
+        key = (agent_id, org_id or "", team_id or "")
+        previous = self.current.get(key)
+        self.current[key] = name
+        self.users[name] += 1
+
+        creating = self.created.get(name)
+        if creating is None:
+            labels = {"agent": key[0], "org": key[1], "team": key[2]}
+            creating = asyncio.ensure_future(
+                self.create(name, settings, labels))
+            self.created[name] = creating
+        else:
+            self.reused += 1
+
+        if previous and previous != name:
+            logger.info(
+                f"Settings of organization '{key[1]}' and team '{key[2]}' "
+                f"changed, rotating their secret")
+            await self.release(previous, used=False)
+
+        try:
+            await asyncio.shield(creating)
+        except BaseException:
+            if creating.done() and self.created.get(name) is creating:
+                # the next job tries again
+                del self.created[name]
+            await self.release(name)
+            raise
+
+        if previous is None:
+            # first job of the team since the agent started
+            sweep = asyncio.ensure_future(self.sweep(key))
+            self.sweeps.add(sweep)
+            sweep.add_done_callback(self.sweeps.discard)
+        return name
+
+    async def release(self, name: str, used: bool = True) -> None:
+        """
+        The job is done with the secret. It is deleted once no job uses it
+        and it is no longer current.
+        """
+        if used:
+            self.users[name] -= 1
+        if self.users[name] > 0 or name in self.current.values():
+            return
+
+        del self.users[name]
+        if self.created.pop(name, None) is None:
+            return
+        api = core_v1_api.CoreV1Api(self.k8s_client)
+        try:
+            await api.delete_namespaced_secret(name, "chaostoolkit-run")
+        except ApiException as x:
+            if x.status != 404:
+                logger.error(f"Failed to delete secret '{name}': {x}")
+
+    async def sweep(self, key: Tuple[str, str, str]) -> None:
+        """
+        Delete the secrets of the agent, organization and team that are
+        neither current nor in use, those left by a previous run of the
+        agent.
+        """
+        api = core_v1_api.CoreV1Api(self.k8s_client)
+        try:
+            secrets = await api.list_namespaced_secret(
+                "chaostoolkit-run",
+                label_selector=f"agent={key[0]},org={key[1]},team={key[2]}")
+        except Exception as x:
+            logger.error(
+                f"Failed to list the secrets of organization '{key[1]}' "
+                f"and team '{key[2]}': {x}")
+            return
+
+        names = [secret.metadata.name for secret in secrets.items]
+        left = [
+            name for name in names if name.startswith("settings-") and
+            name not in self.created and name not in self.current.values()]
+        for name in left:
+            logger.info(f"Deleting secret '{name}' left by a previous run")
+            try:
+                await api.delete_namespaced_secret(name, "chaostoolkit-run")
+            except ApiException as x:
+                if x.status != 404:
+                    logger.error(f"Failed to delete secret '{name}': {x}")
+
+    async def create(self, name: str, settings: str,
+                     labels: Dict[str, str]) -> None:
+        # imported here as the backend's module depends on this one
+        from .k8s import render_secret_manifest
+
+        secret = render_secret_manifest(
+            settings, settings_name=name, labels=labels)
+        api = core_v1_api.CoreV1Api(self.k8s_client)
+        self.writes += 1
+        try:
+            await api.create_namespaced_secret(
+                namespace="chaostoolkit-run", body=secret)
+        except ApiException as x:
+            # left by a previous run of the agent, with the same settings
+            if x.status != 409:
+                raise
+
+
+def get_settings_secret_name(settings: str, agent_id: str) -> str:
+    digest = hashlib.sha256(
+        f"{agent_id}\n{settings}".encode("utf-8")).hexdigest()
+    return f"settings-{digest[:32]}"
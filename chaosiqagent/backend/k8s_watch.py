@@ -0,0 +1,313 @@
+import asyncio
+import json
+from types import TracebackType
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Type
+
+import aiohttp
+import aiojobs
+from aiojobs import Scheduler
+from kubernetes_asyncio.client.api import core_v1_api, custom_objects_api
+from kubernetes_asyncio.client.api_client import ApiClient
+
+from ..log import logger
+from ..types import Job
+
+__all__ = ["ExperimentsWatch", "ExperimentFailed", "WatchForbidden"]
+
+# watches are closed by the API server after that many seconds, and resumed
+WATCH_TIMEOUT = 240
+LABEL_SELECTOR = "job,type"
+
+
+class ExperimentFailed(Exception):
+    pass
+
+
+class WatchForbidden(Exception):
+    pass
+
+
+class ExperimentsWatch:
+    """
+    Watch of the `chaosexperiments` custom resources and of the pods running
+    them, shared by all in-flight jobs, to tell when their experiment
+    completed.
+
+    A single watch request per kind of resource covers every job, matched by
+    their `job` label. Watches are resumed from the last resource version
+    seen, kept fresh by bookmarks, or from scratch when the API server no
+    longer has it.
+
+    `on_finished` is called with the identifier of every job whose pod is
+    seen terminated, including the jobs of previous runs of the agent.
+
+    The jobs whose pod is pending or running are cached in `active`, and
+    `freed` is set whenever one of them, or of the in-flight jobs, is done.
+
+    The setup fails with `WatchForbidden` when the API server does not let
+    the agent watch them, as no job could ever tell its experiment
+    completed.
+    """
+    def __init__(self, k8s_client: ApiClient,
+                 on_finished: Callable[[str], None] = None) -> None:
+        self.sched: Scheduler = None
+        self.k8s_client = k8s_client
+        self.on_finished = on_finished
+        # jobs waiting for their experiment to complete, by identifier
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        # jobs whose pod is pending or running, whoever started them
+        self.active: Set[str] = set()
+        self.freed: asyncio.Event = None  # type: ignore
+        self.resource_versions: Dict[str, Optional[str]] = {
+            "experiments": None, "pods": None}
+        # watch requests made, by kind of resource
+        self.connections: Dict[str, int] = {"experiments": 0, "pods": 0}
+        # done once the first watch request of a kind got its answer
+        self.opened: Dict[str, asyncio.Future] = {}
+        self._running = False
+
+    async def __aenter__(self) -> 'ExperimentsWatch':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when the resources are being watched.
+        """
+        return self._running
+
+    async def setup(self) -> None:
+        """
+        Start watching the experiments and their pods.
+        """
+        logger.info("Watching Chaos Toolkit experiments")
+        self.freed = asyncio.Event()
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        self._running = True
+        loop = asyncio.get_running_loop()
+        self.opened = {kind: loop.create_future() for kind in self.connections}
+
+        custom_objects = custom_objects_api.CustomObjectsApi(self.k8s_client)
+        core = core_v1_api.CoreV1Api(self.k8s_client)
+        await self.sched.spawn(self.watch(
+            "experiments", self.on_experiment,
+            custom_objects.list_namespaced_custom_object,
+            "chaostoolkit.org", "v1", "chaostoolkit-crd", "chaosexperiments"))
+        await self.sched.spawn(self.watch(
+            "pods", self.on_pod, core.list_namespaced_pod,
+            "chaostoolkit-run", allow_watch_bookmarks=True))
+        try:
+            await asyncio.gather(*self.opened.values())
+        except WatchForbidden:
+            await self.cleanup()
+            raise
+
+    async def cleanup(self) -> None:
+        """
+        Stop watching. Jobs still waiting for their experiment are cancelled.
+        """
+        self._running = False
+        if not self.sched.closed:
+            logger.info("Closing Chaos Toolkit experiments watch")
+            await asyncio.wait_for(self.sched.close(), None)
+
+        for future in self.in_flight.values():
+            future.cancel()
+        self.in_flight.clear()
+
+    def track(self, job: Job) -> asyncio.Future:
+        """
+        Start tracking the job, before its experiment is created so that no
+        event is missed. The future is done once the experiment completed,
+        or failed with `ExperimentFailed`.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[str(job.id)] = future
+        return future
+
+    def forget(self, job: Job) -> None:
+        self.in_flight.pop(str(job.id), None)
+        self.freed.set()
+
+    async def watch(self, kind: str,
+                    on_event: Callable[[str, Dict[str, Any]], None],
+                    list_resources: Callable[..., Awaitable[Any]],
+                    *args: Any, **kwargs: Any) -> None:
+        """
+        Watch a kind of resources until the watch is stopped, re-opening the
+        watch request whenever the API server closes it.
+        """
+        wait = default = 0.3
+        while self._running:
+            params = dict(
+                label_selector=LABEL_SELECTOR, watch=True,
+                timeout_seconds=WATCH_TIMEOUT,
+                _request_timeout=WATCH_TIMEOUT + 30,
+                _preload_content=False, **kwargs)
+            if self.resource_versions[kind]:
+                params["resource_version"] = self.resource_versions[kind]
+
+            try:
+                self.connections[kind] += 1
+                resp = await list_resources(*args, **params)
+                try:
+                    if await self.consume(kind, on_event, resp):
+                        wait = default
+                        continue
+                finally:
+                    resp.release()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as x:
+                logger.warning(f"Watch of {kind} interrupted: {str(x)}")
+                self.open(kind)
+            except Exception:
+                # such as an invalid or overlong event, which may have been
+                # missed, the watch must carry on nonetheless
+                logger.exception(
+                    f"Watch of {kind} failed, watching again from scratch")
+                self.open(kind)
+                self.reset(kind)
+
+            # back off before watching again (max 5sec.)
+            await asyncio.sleep(wait)
+            wait = wait * 2
+            wait = wait if wait < 5 else 5
+
+    async def consume(self, kind: str,
+                      on_event: Callable[[str, Dict[str, Any]], None],
+                      resp: aiohttp.ClientResponse) -> bool:
+        """
+        Handle the events of a single watch request. Tells whether it went
+        well, and the watch can be resumed right away.
+        """
+        if resp.status >= 400:
+            return self.failed(kind, resp.status, await resp.text())
+        self.open(kind)
+
+        async for line in resp.content:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event_type = event["type"]
+            obj = event["object"]
+            if event_type == "ERROR":
+                return self.failed(kind, obj.get("code"), obj.get("message"))
+
+            version = obj.get("metadata", {}).get("resourceVersion")
+            if version:
+                self.resource_versions[kind] = version
+            if event_type != "BOOKMARK":
+                on_event(event_type, obj)
+        return True
+
+    def failed(self, kind: str, code: int, message: str) -> bool:
+        """
+        Handle a watch request the API server answered with an error. Tells
+        whether the watch can be resumed right away.
+        """
+        if code in (401, 403):
+            self.forbidden(kind, message)
+            return False
+        self.open(kind)
+        if code == 410:
+            return self.expired(kind)
+        logger.error(f"Failed to watch {kind}: {message}")
+        return False
+
+    def open(self, kind: str) -> None:
+        if not self.opened[kind].done():
+            self.opened[kind].set_result(None)
+
+    def forbidden(self, kind: str, reason: str) -> None:
+        """
+        The agent is not allowed to watch that kind of resources, the Role
+        of its service account lacks the permissions.
+        """
+        error = WatchForbidden(
+            f"Not allowed to watch {kind}, the agent's role must grant get, "
+            f"list and watch on them: {reason}")
+        logger.critical(str(error))
+        if not self.opened[kind].done():
+            self.opened[kind].set_exception(error)
+
+    def expired(self, kind: str) -> bool:
+        # events since then were compacted, the whole state is listed again
+        logger.info(f"Watch of {kind} expired, watching again from scratch")
+        self.reset(kind)
+        return True
+
+    def reset(self, kind: str) -> None:
+        """
+        List the whole state of that kind of resources again.
+        """
+        self.resource_versions[kind] = None
+        if kind == "pods":
+            # pods deleted in the meantime would never be reported
+            self.active.clear()
+
+    def on_experiment(self, event_type: str, obj: Dict[str, Any]) -> None:
+        if event_type == "DELETED":
+            self.fail(obj, "Experiment was deleted before it completed")
+
+    def on_pod(self, event_type: str, obj: Dict[str, Any]) -> None:
+        status = obj.get("status") or {}
+        phase = status.get("phase")
+        if phase in ("Succeeded", "Failed") or event_type == "DELETED":
+            self.active.discard(_job_of(obj))
+            self.freed.set()
+        else:
+            self.active.add(_job_of(obj))
+
+        if phase in ("Succeeded", "Failed") and self.on_finished:
+            self.on_finished(_job_of(obj))
+
+        if phase == "Succeeded":
+            self.complete(obj)
+        elif phase == "Failed":
+            reason = status.get("reason") or status.get("message")
+            for c in status.get("containerStatuses") or []:
+                terminated = (c.get("state") or {}).get("terminated") or {}
+                if terminated.get("exitCode"):
+                    reason = f"exit code {terminated['exitCode']}"
+            self.fail(obj, f"Experiment pod failed ({reason or 'unknown'})")
+        elif event_type == "DELETED":
+            self.fail(obj, "Experiment pod was deleted before it completed")
+
+    def complete(self, obj: Dict[str, Any]) -> None:
+        future = self._future_of(obj)
+        if future:
+            future.set_result(None)
+
+    def fail(self, obj: Dict[str, Any], reason: str) -> None:
+        future = self._future_of(obj)
+        if future:
+            future.set_exception(ExperimentFailed(reason))
+
+    ###########################################################################
+    # Internals
+    ###########################################################################
+    def _future_of(self, obj: Dict[str, Any]) -> Optional[asyncio.Future]:
+        future = self.in_flight.get(_job_of(obj))
+        if future is None or future.done():
+            return None
+        return future
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
+
+
+def _job_of(obj: Dict[str, Any]) -> str:
+    # watched resources are all selected by their `job` label
+    labels = obj.get("metadata", {}).get("labels") or {}
+    job_id: str = labels["job"]
+    return job_id
@@ -0,0 +1,155 @@
+import asyncio
+from typing import Any, Dict
+
+from ..log import logger
+from ..metrics import BACKEND_WAIT
+from ..types import Capacity, Config, Job, Route
+from .base import BaseBackend, JobDeclined
+
+__all__ = ["RouterBackend", "BackendSaturated", "match_route"]
+
+
+class BackendSaturated(JobDeclined):
+    pass
+
+
+class Lane:
+    """
+    Backend of the router, with its own job slots and queue.
+    """
+    def __init__(self, backend: BaseBackend, capacity: Capacity) -> None:
+        self.backend = backend
+        self.capacity = capacity
+        self.slots: asyncio.Semaphore = None  # type: ignore
+        self.running = 0
+        self.waiting = 0
+        self.declined = 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "declined": self.declined,
+        }
+
+    async def setup(self) -> None:
+        self.slots = asyncio.Semaphore(self.capacity.limit)
+        await self.backend.setup()
+
+    async def cleanup(self) -> None:
+        await self.backend.cleanup()
+
+    async def process_job(self, job: Job) -> None:
+        """
+        Run the job once the backend has a free slot.
+
+        Raises `BackendSaturated` when its queue is full already.
+        """
+        if self.slots.locked() and self.waiting >= self.capacity.queue:
+            self.declined += 1
+            raise BackendSaturated(
+                f"Backend '{self.backend.name}' is saturated: "
+                f"{self.running} jobs running and {self.waiting} waiting")
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        BACKEND_WAIT.observe(loop.time() - start, self.backend.name)
+
+        self.running += 1
+        try:
+            await self.backend.process_job(job)
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+
+class RouterBackend(BaseBackend):
+    """
+    Backend dispatching each job to the backend of the first of the
+    `router_routes` it matches.
+
+    Each of those backends runs up to the `limit` of its
+    `router_capacities` entry at once, and up to `queue` more jobs wait
+    for one of its slots, so that a slow backend does not hold up the jobs
+    of the others. The agent runs as many jobs at once as all of them
+    hold, and hands the jobs a saturated backend declines back to ChaosIQ.
+    """
+    def __init__(self, config: Config) -> None:
+        from . import get_backend
+
+        BaseBackend.__init__(self, config)
+        self.routes = config.router_routes
+        self.lanes: Dict[str, Lane] = {}
+        for route in self.routes:
+            name = route.backend
+            if name == "router":
+                raise ValueError("The router backend cannot route to itself")
+            if name in self.lanes:
+                continue
+            backend = get_backend(config.copy(update={"agent_backend": name}))
+            capacity = config.router_capacities.get(name, Capacity())
+            self.lanes[name] = Lane(backend, capacity)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {name: lane.stats for name, lane in self.lanes.items()}
+
+    @property
+    def capacity(self) -> int:
+        """
+        Jobs all the backends run or queue at once.
+        """
+        return sum(
+            lane.capacity.limit + lane.capacity.queue
+            for lane in self.lanes.values())
+
+    async def setup(self) -> None:
+        logger.info(
+            f"Routing jobs to backends {', '.join(self.lanes)}, up to "
+            f"{self.capacity} at once")
+        await asyncio.gather(*[lane.setup() for lane in self.lanes.values()])
+
+    async def cleanup(self) -> None:
+        await asyncio.gather(
+            *[lane.cleanup() for lane in self.lanes.values()])
+
+    def route(self, job: Job) -> str:
+        """
+        Name of the backend to run the job.
+        """
+        for route in self.routes:
+            if match_route(route, job):
+                name: str = route.backend
+                return name
+        raise ValueError("No route matches the job")
+
+    def backend_name(self, job: Job) -> str:
+        try:
+            return self.route(job)
+        except ValueError:
+            name: str = self.name
+            return name
+
+    async def process_job(self, job: Job) -> None:
+        name = self.route(job)
+        logger.info(f"Routing job '{job.id}' to backend '{name}'")
+        await self.lanes[name].process_job(job)
+
+
+def match_route(route: Route, job: Job) -> bool:
+    """
+    Whether the job is of the route's target type and its payload holds the
+    route's payload items.
+    """
+    if route.target_type and route.target_type != job.target_type:
+        return False
+    payload = job.payload or {}
+    return all(
+        key in payload and payload[key] == value
+        for key, value in route.payload.items())
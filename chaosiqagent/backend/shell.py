@@ -1,12 +1,14 @@
+import asyncio
 import os
-import shlex
 import subprocess
 import tempfile
+from typing import List, Optional
 
 from ..types import Config, Job
 from .base import BaseBackend
 from ..ctk import get_chaostoolkit_settings
 from ..log import logger
+from .workers import WorkerPool
 
 __all__ = ["ShellBackend"]
 
@@ -15,6 +17,7 @@ class ShellBackend(BaseBackend):
     def __init__(self, config: Config) -> None:
         BaseBackend.__init__(self, config)
         self.bin = self.config.chaos_binary
+        self.pool: Optional[WorkerPool] = None
 
     async def setup(self) -> None:
         # ensure the `chaos` binary path is defined & exists
@@ -30,29 +33,84 @@ class ShellBackend(BaseBackend):
         logger.info(f"Backend '{self.name}' configured with "
                     f"Chaos Toolkit binary: {self.bin}")
 
+        if self.config.chaos_workers:
+            self.pool = WorkerPool(self.config)
+            await self.pool.setup()
+
     async def cleanup(self) -> None:
+        if self.pool:
+            await self.pool.cleanup()
+            self.pool = None
         self.bin = None
 
     async def process_job(self, job: Job) -> None:
         """
         Uses the Chaos Toolkit's `chaos` command on the local shell
         to run the experiments.
+
+        The command runs as an asyncio subprocess so that the agent keeps
+        serving other jobs and heartbeats meanwhile. Its output is logged
+        line by line as it is produced. When `chaos_workers` is set, the
+        command runs in one of the pool's warm processes instead, and reads
+        its settings from a pipe rather than from a temporary file.
         """
         settings = get_chaostoolkit_settings(
             self.config, job.access_token,
             org_id=job.org_id, team_id=job.team_id)
 
-        with tempfile.NamedTemporaryFile(mode="w") as f:
-            f.write(settings)
-            f.seek(0)
+        cmd = "verify" if job.target_type == "verification" else "run"
+        args = [cmd, job.target_url]
+
+        # handle no verify TLS option
+        if not self.config.verify_tls:
+            args.append("--no-verify-tls")
+
+        if self.pool:
+            # the settings are handed over to the worker in memory
+            returncode = await self.pool.run(job, args, settings)
+        else:
+            with tempfile.NamedTemporaryFile(mode="w") as f:
+                f.write(settings)
+                f.flush()
+                args = [self.bin, "--settings", f.name, *args]  # type: ignore
+                returncode = await self.run_binary(job, args)
 
-            # full_cmd = f"{self.bin} --settings {f.name} info settings"
-            cmd = "verify" if job.target_type == "verification" else "run"
-            full_cmd = f"{self.bin} --settings {f.name} {cmd} {job.target_url}"
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args)
 
-            # handle no verify TLS option
-            if not self.config.verify_tls:
-                full_cmd = f"{full_cmd} --no-verify-tls"
+    async def run_binary(self, job: Job, args: List[str]) -> int:
+        """
+        Run the `chaos` binary in a new process and return its exit code.
+        """
+        p = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        try:
+            await asyncio.gather(
+                self.log_output(job, p.stdout),  # type: ignore
+                self.log_output(job, p.stderr))  # type: ignore
+            returncode: int = await p.wait()
+        except BaseException:
+            # do not leave the experiment running on its own
+            if p.returncode is None:
+                p.kill()
+            await p.wait()
+            raise
+        return returncode
 
-            p = subprocess.run(shlex.split(full_cmd))
-            p.check_returncode()
+    async def log_output(self, job: Job,
+                         stream: asyncio.StreamReader) -> None:
+        """
+        Log the lines of the `chaos` command's output as they come. Lines
+        longer than the stream's limit are dropped.
+        """
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                logger.warning(f"[{job.id}] Skipped an output line too long")
+                continue
+            if not line:
+                return
+            text = line.decode("utf-8", errors="replace").rstrip()
+            logger.info(f"[{job.id}] {text}")
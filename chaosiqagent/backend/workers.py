@@ -0,0 +1,285 @@
+import asyncio
+import json
+import os
+import shlex
+import sys
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Set, Type
+
+import aiojobs
+from aiojobs import Scheduler
+
+from ..log import logger
+from ..types import Config, Job
+
+__all__ = ["WorkerPool", "get_worker_python"]
+
+WORKER_PATH = os.path.join(os.path.dirname(__file__), "ctk_worker.py")
+
+
+class Worker:
+    """
+    A warm Chaos Toolkit process, running one job at a time.
+    """
+    def __init__(self, proc: asyncio.subprocess.Process) -> None:
+        self.proc = proc
+        self.jobs = 0
+        self.rss = 0
+        # last job handed to the worker, its output is logged under its id
+        self.job: Optional[Job] = None
+
+    @property
+    def pid(self) -> int:
+        return self.proc.pid
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        stdin: asyncio.StreamWriter = self.proc.stdin  # type: ignore
+        stdin.write(json.dumps(message).encode("utf-8") + b"\n")
+        await stdin.drain()
+
+    async def receive(self) -> Optional[Dict[str, Any]]:
+        """
+        Next message of the worker, `None` once the worker has exited.
+        """
+        stdout: asyncio.StreamReader = self.proc.stdout  # type: ignore
+        line = await stdout.readline()
+        if not line:
+            return None
+        message: Dict[str, Any] = json.loads(line)
+        return message
+
+
+class WorkerPool:
+    """
+    Pool of `chaos_workers` processes that have already imported the Chaos
+    Toolkit, so that jobs do not pay for the interpreter's startup and the
+    imports of the toolkit and its extensions.
+
+    Each worker runs one job at a time. It is replaced by a fresh one after
+    `chaos_worker_max_jobs` jobs, or once its memory grew past
+    `chaos_worker_max_rss` MiB, since experiments run in the worker itself.
+    """
+    # seconds a worker has to finish its job and exit before being killed
+    stop_timeout = 5.0
+
+    def __init__(self, config: Config) -> None:
+        self.sched: Scheduler = None
+        self.config = config
+        self.size = config.chaos_workers
+        self.command = [*get_worker_python(config), WORKER_PATH]
+        self.workers: Set[Worker] = set()
+        self.started = 0
+        self.recycled = 0
+        # workers being replaced, the pool is not empty in the meantime
+        self._replacing = 0
+        self._idle: asyncio.Queue = None  # type: ignore
+        self._running = False
+
+    async def __aenter__(self) -> 'WorkerPool':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when the pool accepts jobs.
+        """
+        return self._running
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self.workers),
+            # the queue holds a `None` once the pool is empty
+            "idle": self._idle.qsize() if self.workers else 0,
+            "started": self.started,
+            "recycled": self.recycled,
+        }
+
+    async def setup(self) -> None:
+        """
+        Start the workers and wait for them to be warm.
+        """
+        logger.info(
+            f"Starting {self.size} Chaos Toolkit workers with "
+            f"{' '.join(self.command)}")
+        self._idle = asyncio.Queue()
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        self._running = True
+        await asyncio.gather(*[self.spawn() for _ in range(self.size)])
+
+        if not self.workers:
+            logger.critical("No Chaos Toolkit worker could be started")
+
+    async def cleanup(self) -> None:
+        """
+        Let the workers finish their jobs and exit.
+        """
+        self._running = False
+        await asyncio.gather(*[self.stop(w) for w in list(self.workers)])
+        if not self.sched.closed:
+            logger.info("Closing Chaos Toolkit workers pool")
+            await asyncio.wait_for(self.sched.close(), None)
+
+    async def run(self, job: Job, args: List[str],
+                  settings: Optional[str] = None) -> int:
+        """
+        Run the `chaos` command's arguments in the next idle worker and
+        return its exit code. The settings are sent along with them.
+        """
+        if not self.workers and not self._replacing:
+            raise RuntimeError("No Chaos Toolkit worker is available")
+
+        worker: Optional[Worker] = await self._idle.get()
+        if worker is None:
+            # the pool is empty for good, let the next waiting job know
+            self._idle.put_nowait(None)
+            raise RuntimeError("No Chaos Toolkit worker is available")
+
+        worker.job = job
+        try:
+            await worker.send({"args": args, "settings": settings})
+            message = await worker.receive()
+        except (BrokenPipeError, ConnectionResetError):
+            message = None
+        except asyncio.CancelledError:
+            # the experiment would otherwise carry on in the worker
+            await self.retire(worker, kill=True)
+            raise
+
+        if message is None:
+            await worker.proc.wait()
+            logger.error(
+                f"Chaos Toolkit worker {worker.pid} died while running "
+                f"job '{job.id}' ({worker.proc.returncode})")
+            await self.retire(worker)
+            return worker.proc.returncode or 1
+
+        worker.jobs += 1
+        worker.rss = message["rss"]
+        if worker.jobs >= self.config.chaos_worker_max_jobs or \
+                worker.rss >= self.config.chaos_worker_max_rss:
+            logger.info(
+                f"Recycling Chaos Toolkit worker {worker.pid} after "
+                f"{worker.jobs} jobs using {worker.rss}MiB")
+            await self.retire(worker)
+        else:
+            self._idle.put_nowait(worker)
+
+        returncode: int = message["returncode"]
+        return returncode
+
+    async def spawn(self) -> None:
+        """
+        Start a worker and make it available once warm.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *self.command, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        worker = Worker(proc)
+        self.workers.add(worker)
+        self.started += 1
+        await self.sched.spawn(self.log_output(worker))
+
+        if await worker.receive() is None:
+            await proc.wait()
+            logger.error(
+                f"Chaos Toolkit worker {worker.pid} failed to start "
+                f"({proc.returncode})")
+            self.workers.discard(worker)
+            return
+
+        logger.debug(f"Chaos Toolkit worker {worker.pid} is ready")
+        self._idle.put_nowait(worker)
+
+    async def retire(self, worker: Worker, kill: bool = False) -> None:
+        """
+        Stop the worker and replace it, in the background.
+        """
+        self.workers.discard(worker)
+        if not self._running:
+            # the pool's cleanup is already stopping every worker
+            return
+
+        self.recycled += 1
+        self._replacing += 1
+        await self.sched.spawn(self.replace(worker, kill))
+
+    async def replace(self, worker: Worker, kill: bool) -> None:
+        try:
+            await self.stop(worker, kill)
+            if self._running:
+                await self.spawn()
+        finally:
+            self._replacing -= 1
+            if not self.workers and not self._replacing:
+                # no worker will come back, wake up the jobs waiting for one
+                logger.critical("No Chaos Toolkit worker is left")
+                self._idle.put_nowait(None)
+
+    async def stop(self, worker: Worker, kill: bool = False) -> None:
+        self.workers.discard(worker)
+        if kill and worker.proc.returncode is None:
+            worker.proc.kill()
+        else:
+            stdin: asyncio.StreamWriter = worker.proc.stdin  # type: ignore
+            stdin.close()
+
+        try:
+            await asyncio.wait_for(worker.proc.wait(), self.stop_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Chaos Toolkit worker {worker.pid} did not exit, killing it")
+            worker.proc.kill()
+            await worker.proc.wait()
+
+    async def log_output(self, worker: Worker) -> None:
+        """
+        Log the output of the experiments run by the worker, line by line.
+        """
+        stderr: asyncio.StreamReader = worker.proc.stderr  # type: ignore
+        while True:
+            try:
+                line = await stderr.readline()
+            except ValueError:
+                # longer than the stream's limit, which drops it
+                line = b"Skipped an output line too long\n"
+            if not line:
+                return
+            text = line.decode("utf-8", errors="replace").rstrip()
+            if worker.job:
+                logger.info(f"[{worker.job.id}] {text}")
+            else:
+                logger.info(f"[worker {worker.pid}] {text}")
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
+
+
+def get_worker_python(config: Config) -> List[str]:
+    """
+    Command of the Python interpreter the workers run with.
+
+    Unless `chaos_worker_python` is set, it is the interpreter of the
+    `chaos` binary, when it is a Python script, or the agent's.
+    """
+    if config.chaos_worker_python:
+        return shlex.split(config.chaos_worker_python)
+
+    if config.chaos_binary and os.path.isfile(config.chaos_binary):
+        with open(config.chaos_binary, "rb") as f:
+            shebang = f.readline().decode("utf-8", errors="replace")
+        if shebang.startswith("#!") and "python" in shebang:
+            return shlex.split(shebang[2:])
+
+    return [sys.executable]
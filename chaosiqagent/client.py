@@ -1,3 +1,7 @@
+import time
+from typing import Any
+
+import httpcore
 import httpx
 
 from .types import Config
@@ -6,7 +10,23 @@ __all__ = ["get_client", "ChaosIQClient"]
 
 
 class ChaosIQClient(httpx.AsyncClient):
+    """
+    HTTP client to talk to ChaosIQ.
+
+    A single instance is meant to be shared by all the agent's components for
+    its whole lifetime so that connections are pooled and kept alive rather
+    than opened for every single request.
+
+    It remembers when ChaosIQ last accepted a request, which proves the
+    agent is alive as well as a heartbeat does.
+    """
     def __init__(self, config: Config):
+        transport = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(verify=config.verify_tls),
+            max_connections=config.http_max_connections,
+            max_keepalive_connections=config.http_max_keepalive_connections,
+            keepalive_expiry=config.http_keepalive_expiry,
+        )
 
         super().__init__(
             headers={
@@ -16,7 +36,17 @@ class ChaosIQClient(httpx.AsyncClient):
             base_url=config.agent_url,
             verify=config.verify_tls,
             timeout=2,
+            transport=transport,
         )
+        # monotonic time of the last successful response from ChaosIQ
+        self.last_seen = 0.0
+
+    async def send(self, *args: Any, **kwargs: Any) -> httpx.Response:
+        response = await super().send(*args, **kwargs)
+        # a rejected token or a failing ChaosIQ does not prove anything
+        if 200 <= response.status_code < 300:
+            self.last_seen = time.monotonic()
+        return response
 
 
 def get_client(config: Config) -> ChaosIQClient:
@@ -0,0 +1,179 @@
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime, timezone
+from types import TracebackType
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, \
+    Type
+
+import aiojobs
+from aiojobs import Scheduler
+
+from .log import logger
+from .metrics import DEFERRED_LATENESS
+from .types import Job
+
+__all__ = ["DeferredJobs", "seconds_until"]
+
+
+class DeferredJobs:
+    """
+    Hold the jobs that must only run at a later time (`Job.run_at`).
+
+    Jobs are kept in a heap ordered by deadline and a single loop sleeps
+    until the earliest one is due, so that a sleeping job costs a heap entry
+    rather than a coroutine.
+
+    The lateness of each job, between its deadline and the moment it was
+    actually handed over, is recorded to report the timer's accuracy.
+    """
+    def __init__(self, on_due: Callable[[Job], Awaitable[None]]) -> None:
+        self.sched: Scheduler = None
+        self.on_due = on_due
+        self.aiojob: aiojobs._job.Job = None
+        self.fired = 0
+        self.lateness_total = 0.0
+        self.lateness_max = 0.0
+        self._heap: List[Tuple[float, int, Job]] = []
+        self._counter = itertools.count()
+        self._running = False
+        self._wakeup: asyncio.Event = None  # type: ignore
+
+    async def __aenter__(self) -> 'DeferredJobs':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when deferred jobs are being fired.
+        """
+        return self._running
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """
+        Accuracy of the timer, lateness are in seconds.
+        """
+        mean = self.lateness_total / self.fired if self.fired else 0.0
+        return {
+            "deferred": len(self),
+            "fired": self.fired,
+            "lateness_mean": mean,
+            "lateness_max": self.lateness_max,
+        }
+
+    async def setup(self) -> None:
+        """
+        Spawn the loop firing the deferred jobs when they are due.
+        """
+        logger.info("Creating deferred jobs timer")
+        self._wakeup = asyncio.Event()
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        self._running = True
+        self.aiojob = await self.sched.spawn(self.fire())
+
+    async def cleanup(self) -> None:
+        """
+        Stop the timer. Jobs not yet due are left in the heap.
+        """
+        self._running = False
+        self._wakeup.set()
+        if not self.sched.closed:
+            logger.info("Closing deferred jobs timer")
+            await asyncio.wait_for(self.sched.close(), None)
+
+        if self.fired:
+            stats = self.stats
+            logger.info(
+                f"Fired {self.fired} deferred jobs, late by "
+                f"{stats['lateness_mean']:.3f}s on average and "
+                f"{stats['lateness_max']:.3f}s at most")
+        if self._heap:
+            logger.warning(
+                f"{len(self._heap)} deferred jobs were not run")
+
+    def defer(self, job: Job, delay: float) -> None:
+        """
+        Hand the job over in `delay` seconds.
+        """
+        deadline = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self._heap, (deadline, next(self._counter), job))
+
+        # the timer must be rescheduled when it is now due earlier
+        if self._heap[0][2] is job:
+            self._wakeup.set()
+
+    def jobs(self) -> List[Job]:
+        """
+        The jobs not yet due, by deadline.
+        """
+        return [job for _, _, job in sorted(self._heap)]
+
+    def pop_all(self) -> List[Job]:
+        """
+        Remove the jobs not yet due, and return them by deadline.
+        """
+        jobs = self.jobs()
+        self._heap = []
+        return jobs
+
+    async def fire(self) -> None:
+        """
+        Hand over the deferred jobs once they are due.
+        """
+        loop = asyncio.get_running_loop()
+        while self._running:
+            timeout = None
+            if self._heap:
+                timeout = self._heap[0][0] - loop.time()
+
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            deadline, _, job = heapq.heappop(self._heap)
+            lateness = loop.time() - deadline
+            self.fired += 1
+            self.lateness_total += lateness
+            self.lateness_max = max(self.lateness_max, lateness)
+            DEFERRED_LATENESS.observe(lateness)
+
+            try:
+                await self.on_due(job)
+            except Exception:  # noqa: 0703
+                logger.error(
+                    f"Failed to hand over deferred job {job.id}",
+                    exc_info=True)
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
+
+
+def seconds_until(when: datetime) -> float:
+    """
+    Seconds from now until the given date, negative when it is in the past.
+
+    Dates without timezone are considered as UTC.
+    """
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp() - time.time()
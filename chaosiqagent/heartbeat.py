@@ -1,25 +1,50 @@
 import asyncio
 import contextlib
+import time
 from types import TracebackType
-from typing import Optional, Type, Dict, Any
+from typing import Optional, Tuple, Type, Dict, Any
 
 import aiojobs
 from aiojobs import Scheduler
 
 from .client import ChaosIQClient
+from .job import Jobs
 from .log import logger
+from .metrics import HEARTBEAT
 from .types import Config
+from .utils import Stop
+from .watchdog import LoopWatchdog
 
 
 __all__ = ["Heartbeat"]
 
 
 class Heartbeat:
-    def __init__(self, config: Config) -> None:
+    """
+    Periodically tell ChaosIQ the agent is alive, along with its load so that
+    work can be sent to the least loaded agent.
+
+    A pulse is skipped when ChaosIQ heard from the agent since the previous
+    one while the jobs in flight and free slots did not change.
+
+    The event loop lag it reports is the largest one the watchdog measured
+    since the previous pulse.
+    """
+    def __init__(self, config: Config, client: ChaosIQClient, jobs: Jobs,
+                 stop: Optional[Stop] = None,
+                 watchdog: Optional[LoopWatchdog] = None) -> None:
         self.sched: Scheduler = None
         self.config = config
+        self.client = client
+        self.jobs = jobs
+        self.stop = stop or Stop()
+        self.watchdog = watchdog
         self._running = False
         self.aiojob = None
+        self.last_pulse = 0.0
+        # jobs in flight and free slots as of the last pulse sent
+        self.last_summary: Optional[Tuple[int, ...]] = None
+        self.skipped = 0
 
     async def __aenter__(self) -> 'Heartbeat':
         await self.setup()
@@ -59,6 +84,7 @@ class Heartbeat:
         """
         Gracefully terminate the scheduler.
         """
+        self.stop.set()
         if self.aiojob:
             logger.info("Stopping heartbeat pulse...")
             await self.aiojob.close()
@@ -80,13 +106,47 @@ class Heartbeat:
         wait = self.config.heartbeat_interval
         logger.info(f"Sending heartbeat every {wait} seconds")
 
+        self.last_pulse = time.monotonic()
         while self._running and not self.sched.closed:
-            await asyncio.sleep(wait)
-
+            await self.idle(wait)
+            if not self._running or self.stop.is_set():
+                return
+
+            load = self.jobs.load
+            if self.client.last_seen > self.last_pulse and \
+                    self.summary(load) == self.last_summary:
+                logger.debug("Skipping heartbeat, ChaosIQ heard from us")
+                self.skipped += 1
+                HEARTBEAT.observe(0.0, "skipped")
+                self.last_pulse = time.monotonic()
+                continue
+
+            lag = self.watchdog.take_lag() if self.watchdog else 0.0
+            load["loop_lag"] = round(lag, 6)
+            start = time.monotonic()
+            result = "error"
             with contextlib.suppress(Exception):
-                async with ChaosIQClient(self.config) as client:
-                    await client.post(
-                        "/agent/actions", json={"action": "heartbeat"})
+                resp = await self.client.post(
+                    "/agent/actions",
+                    json={"action": "heartbeat", "payload": load})
+                if resp.status_code < 400:
+                    result = "sent"
+            HEARTBEAT.observe(time.monotonic() - start, result)
+            self.last_summary = self.summary(load)
+            self.last_pulse = time.monotonic()
+
+    async def idle(self, period: float) -> None:
+        """
+        Wait for the next pulse, less when the agent is stopped meanwhile.
+        """
+        await self.stop.sleep(period)
+
+    @staticmethod
+    def summary(load: Dict[str, Any]) -> Tuple[int, ...]:
+        """
+        Part of the load that is worth a pulse when it changed.
+        """
+        return load["in_flight"], load["pending"], load["free_slots"]
 
     @staticmethod
     def aiojobs_exception(
@@ -0,0 +1,95 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable
+
+from .metrics import SEEN_JOBS, SEEN_JOBS_EVICTIONS
+
+__all__ = ["SeenJobs"]
+
+
+class SeenJobs:
+    """
+    Bounded set of the identifiers of the jobs recently received, so that a
+    job redelivered by ChaosIQ, for instance because its acknowledgement
+    was lost, is not run twice.
+
+    Identifiers are forgotten `ttl` seconds after they were first seen, or
+    earlier, oldest first, when more than `max_size` are held. Identifiers
+    are kept in the order they were seen so that both evictions only ever
+    look at the oldest entries.
+    """
+    def __init__(self, ttl: float, max_size: int,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._seen: 'OrderedDict[str, float]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def __contains__(self, job_id: str) -> bool:
+        self._expire()
+        return job_id in self._seen
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def seen(self, job_id: str) -> bool:
+        """
+        Tell whether the job was already seen, remembering it when not.
+        """
+        if job_id in self:
+            self.hits += 1
+            SEEN_JOBS.inc("hit")
+            return True
+
+        self.misses += 1
+        SEEN_JOBS.inc("miss")
+        self.add(job_id)
+        return False
+
+    def add(self, job_id: str) -> None:
+        """
+        Remember the job without accounting for a hit or a miss.
+        """
+        if job_id in self._seen:
+            return
+
+        self._seen[job_id] = self.clock()
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+            self.evictions += 1
+            SEEN_JOBS_EVICTIONS.inc()
+
+    def discard(self, job_id: str) -> None:
+        """
+        Forget the job, so that it is run when it is delivered again.
+        """
+        self._seen.pop(job_id, None)
+
+    def update(self, job_ids: Iterable[str]) -> None:
+        for job_id in job_ids:
+            self.add(job_id)
+
+    ###########################################################################
+    # Internals
+    ###########################################################################
+    def _expire(self) -> None:
+        deadline = self.clock() - self.ttl
+        while self._seen:
+            job_id, seen_at = next(iter(self._seen.items()))
+            if seen_at > deadline:
+                return
+            del self._seen[job_id]
+            self.evictions += 1
+            SEEN_JOBS_EVICTIONS.inc()
@@ -1,26 +1,53 @@
 import asyncio
+import contextlib
 import json
+from collections import deque
 from types import TracebackType
-from typing import Optional, Type, Dict, Any
+from typing import Deque, Optional, Type, Dict, Any
 
 import aiojobs
 from aiojobs import Scheduler
+import httpx
 from pydantic import ValidationError
 
 from .backend import BaseBackend
+from .backend.base import JobDeclined
 from .client import ChaosIQClient
+from .deferred import DeferredJobs, seconds_until
+from .idempotency import SeenJobs
+from .journal import Journal
 from .log import logger
+from .metrics import FETCH_TO_SPAWN, JOB_DURATION, JOBS_ACTIVE, \
+    JOBS_PENDING, POLL_DURATION
+from .outbox import Outbox
 from .types import Config, Job
+from .utils import Stop, percentiles
 
 __all__ = ["Jobs"]
 
+# durations of the last jobs the latency percentiles are computed over
+LATENCY_WINDOW = 100
+
 
 class Jobs:
-    def __init__(self, config: Config, backend: BaseBackend) -> None:
+    def __init__(self, config: Config, backend: BaseBackend,
+                 client: ChaosIQClient, stop: Optional[Stop] = None) -> None:
         self.sched: Scheduler = None
         self.config = config
         self.backend = backend
+        self.client = client
+        self.journal = Journal(config)
+        self.outbox = Outbox(config, client, self.journal)
+        self.deferred = DeferredJobs(self.start_job)
+        self.seen = SeenJobs(config.seen_jobs_ttl, config.seen_jobs_max_size)
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        # cuts the consumer's sleeps short when the agent is terminated
+        self.stop = stop or Stop()
+        # jobs handed over to the scheduler, but not started yet
+        self.queued: Dict[str, Job] = {}
+        self.in_flight: Dict[str, Job] = {}
         self._running = False
+        self._slot_freed: asyncio.Event = None  # type: ignore
 
     async def __aenter__(self) -> 'Jobs':
         await self.setup()
@@ -41,43 +68,208 @@ class Jobs:
     async def setup(self) -> None:
         """
         Create the underlying scheduler to handle jobs.
+
+        The scheduler runs up to `max_concurrent_jobs` jobs at once, or as
+        many as the backend holds when it bounds them itself, up to
+        `max_pending_jobs` more wait for a free slot. As jobs are only
+        fetched for free slots, the waiting ones are deferred jobs coming
+        due and jobs resumed on startup.
         """
         logger.info("Creating job consumer queue")
+        self._slot_freed = asyncio.Event()
+        limit = self.backend.capacity or self.config.max_concurrent_jobs
         self.sched = await asyncio.wait_for(
             aiojobs.create_scheduler(
+                limit=limit,
+                pending_limit=self.config.max_pending_jobs,
                 exception_handler=self.aiojobs_exception), None)
+        await self.journal.setup()
+        # jobs journaled by a previous run must not be run again either
+        self.seen.update(self.journal.known)
+        await self.outbox.setup()
+        await self.deferred.setup()
+        JOBS_ACTIVE.set_function(lambda: int(self.sched.active_count))
+        JOBS_PENDING.set_function(lambda: int(self.sched.pending_count))
 
     async def cleanup(self) -> None:
         """
-        Gracefully terminate the scheduler.
+        Gracefully terminate the deferred jobs timer and the scheduler, then
+        the outbox so that the status of the last jobs are sent, and finally
+        the journal.
         """
+        self._running = False
+        self.stop.set()
+        # wake up the consumer if it waits for a free slot
+        self._slot_freed.set()
+        await self.deferred.cleanup()
         if not self.sched.closed:
             logger.info("Closing job consumer queue")
             await asyncio.wait_for(self.sched.close(), None)
+        await self.outbox.cleanup()
+        await self.journal.cleanup()
+        stats = self.seen.stats
+        logger.info(
+            f"Seen {stats['misses']} jobs, ignored {stats['hits']} received "
+            f"again and forgot {stats['evictions']}")
+
+    async def drain(self) -> None:
+        """
+        Stop fetching jobs and give the running ones `drain_timeout` seconds
+        to complete. The ones that had to be cut off are reported as
+        interrupted.
+
+        Jobs not started yet, deferred ones included, are handed back to the
+        ChaosIQ queue so that another agent can run them.
+        """
+        self.stop.set()
+        for job in self.deferred.pop_all() + list(self.queued.values()):
+            self.hand_back(job, "agent was stopped before running the job")
+        # the scheduler skips them once it gets to them
+        self.queued.clear()
+
+        if self.in_flight:
+            logger.info(
+                f"Draining {len(self.in_flight)} running jobs, for "
+                f"{self.config.drain_timeout}s at most")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.config.drain_timeout
+        while self.in_flight and loop.time() < deadline:
+            self._slot_freed.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self._slot_freed.wait(), deadline - loop.time())
+
+        for job in self.in_flight.values():
+            logger.warning(f"Job '{job.id}' was cut off")
+            self.update_job_status(
+                job, status="interrupted",
+                info={"reason": "agent was stopped while running the job"})
+        # cuts them off before they report anything else
+        await asyncio.wait_for(self.sched.close(), None)
+        await self.outbox.flush()
+
+    async def resume(self) -> None:
+        """
+        Resume the jobs the agent received before it was last stopped, and
+        report the ones that were interrupted while running.
+        """
+        received, interrupted = self.journal.jobs()
+        for job in interrupted:
+            logger.warning(f"Job '{job.id}' was interrupted")
+            self.update_job_status(
+                job, status="interrupted",
+                info={"reason": "agent was stopped while running the job"})
+            self.journal.record(job, "finished")
+
+        for job in received:
+            logger.info(f"Resuming job '{job.id}'")
+            await self.handle_job(job)
+
+    @property
+    def free_slots(self) -> int:
+        """
+        Number of jobs the scheduler can still start right away.
+
+        Pending jobs count as busy slots so that the agent stops fetching
+        jobs while deferred or resumed ones are waiting for a slot.
+        """
+        limit: int = self.sched.limit
+        busy: int = self.sched.active_count + self.sched.pending_count
+        return max(0, limit - busy)
+
+    @property
+    def load(self) -> Dict[str, Any]:
+        """
+        Jobs running and waiting for a slot, free slots and the percentiles
+        of the last jobs' durations in seconds.
+        """
+        return {
+            "backend": self.backend.name,
+            "in_flight": self.sched.active_count,
+            "pending": self.sched.pending_count,
+            "free_slots": self.free_slots,
+            "latency": percentiles(self.latencies, (50, 90, 99)),
+        }
+
+    @property
+    def batch_size(self) -> int:
+        """
+        How many jobs to fetch at once from ChaosIQ.
+
+        It follows the free local capacity so that bursts are drained quickly
+        without fetching jobs we could not start.
+        """
+        size: int = self.config.job_batch_size
+        return max(1, min(size, self.free_slots))
+
+    async def wait_for_free_slot(self) -> None:
+        """
+        Wait while the agent is saturated, and not stopped.
+
+        Jobs are not pulled from ChaosIQ in the meantime so that they stay in
+        its queue, where another agent can take them.
+        """
+        if self.free_slots:
+            return
+
+        logger.debug("All job slots are busy, waiting for one to be freed")
+        while self.running and not self.sched.closed and \
+                not self.stop.is_set() and not self.free_slots:
+            self._slot_freed.clear()
+            await self.stop.interrupt(self._slot_freed.wait())
 
     async def consume(self) -> None:
         """
         Consume jobs.
+
+        When the `"stream"` delivery is configured, jobs are pushed by ChaosIQ
+        over a long-lived connection. Polling remains the fallback whenever
+        ChaosIQ does not support streaming.
         """
         logger.info("Consuming jobs...")
 
         self._running = True
+        if self.config.job_delivery == "stream":
+            await self.consume_stream()
+        await self.consume_poll()
+        self._running = False
+
+    async def consume_poll(self) -> None:
+        """
+        Periodically poll the ChaosIQ job queue, fetching up to
+        `batch_size` jobs at once.
+        """
+        loop = asyncio.get_running_loop()
         wait = default = 0.3
-        while self.running and not self.sched.closed:
+        while self.running and not self.sched.closed and \
+                not self.stop.is_set():
             # wait between jobs to allow other functions to execute
             # NB: needs to be at top of while loop, due to multiple 'continue'
-            await asyncio.sleep(wait)
-
-            async with ChaosIQClient(self.config) as client:
-                resp = await client.get("/agent/jobs/queue/next")
-                if resp.status_code == 204:
-                    # increase wait when queue is empty (max 5sec.)
-                    wait = wait * 2
-                    wait = wait if wait < 5 else 5
-                    continue
-                else:
-                    # reset initial wait before jobs
-                    wait = default
+            await self.stop.sleep(wait)
+            await self.wait_for_free_slot()
+            # the agent may have been terminated while we were waiting, in
+            # which case the shared client may not be usable anymore
+            if not self.running or self.sched.closed or self.stop.is_set():
+                return
+
+            limit = self.batch_size
+            params = {"limit": limit} if limit > 1 else None
+            start = loop.time()
+            resp = await self.stop.interrupt(self.client.get(
+                "/agent/jobs/queue/next", params=params))
+            if resp is None:
+                return
+            result = "empty" if resp.status_code == 204 else \
+                "error" if resp.status_code >= 400 else "jobs"
+            POLL_DURATION.observe(loop.time() - start, result)
+            if resp.status_code == 204:
+                # increase wait when queue is empty (max 5sec.)
+                wait = wait * 2
+                wait = wait if wait < 5 else 5
+                continue
+            else:
+                # reset initial wait before jobs
+                wait = default
 
             if resp.status_code >= 400:
                 logger.info(
@@ -92,50 +284,195 @@ class Jobs:
                     exc_info=True)
                 continue
 
-            try:
-                job = Job.parse_obj(body)
-                logger.info(f"Got job '{job.id}' to process")
-            except ValidationError as x:
-                logger.error(f"Failed to parse job: {str(x)}")
-                continue
+            # consoles not supporting batches reply with a single job
+            bodies = body if isinstance(body, list) else [body]
+            for body in bodies:
+                await self.dispatch(body)
+
+            # more jobs are likely waiting when we got a full batch
+            if len(bodies) >= limit:
+                wait = 0
+
+    async def consume_stream(self) -> None:
+        """
+        Consume jobs as soon as ChaosIQ pushes them on the stream.
+
+        The stream is made of one JSON job per line (NDJSON), Server-Sent
+        Events `data:` lines are accepted too. Anything else, such as empty
+        lines, is considered a keep-alive.
 
+        The connection is re-opened whenever it drops. Leaves when the agent
+        is terminated or when ChaosIQ does not support streaming.
+        """
+        timeout = httpx.Timeout(
+            self.client.timeout.connect, read=self.config.job_stream_timeout)
+        wait = default = 0.3
+        while self.running and not self.sched.closed and \
+                not self.stop.is_set():
             try:
-                await self.handle_job(job)
-            finally:
-                await self.ack_job(job)
+                async with self.client.stream(
+                        "GET", "/agent/jobs/queue/stream",
+                        timeout=timeout) as resp:
+                    if resp.status_code in (404, 405, 501):
+                        logger.warning(
+                            "ChaosIQ does not support streaming jobs, "
+                            "falling back to polling")
+                        return
 
-        self._running = False
+                    if resp.status_code >= 400:
+                        await resp.aread()
+                        logger.info(
+                            f"Failed to stream jobs from ChaosIQ: "
+                            f"{resp.text}")
+                    else:
+                        logger.info("Streaming jobs from ChaosIQ")
+                        wait = default
+                        async for line in self.stop.iterate(
+                                resp.aiter_lines()):
+                            await self.wait_for_free_slot()
+                            if not self.running or self.sched.closed or \
+                                    self.stop.is_set():
+                                return
+                            await self.dispatch_line(line)
+            except httpx.HTTPError as x:
+                logger.warning(f"Jobs stream interrupted: {str(x)}")
+
+            # back off before re-opening the stream (max 5sec.)
+            await self.stop.sleep(wait)
+            wait = wait * 2
+            wait = wait if wait < 5 else 5
+
+    async def dispatch_line(self, line: str) -> None:
+        """
+        Dispatch the job carried by a single line of the jobs stream.
+        """
+        line = line.strip()
+        if line.startswith("data:"):
+            line = line[5:].strip()
+
+        if not line.startswith("{"):
+            return
+
+        try:
+            body = json.loads(line)
+        except json.JSONDecodeError:
+            logger.error(
+                f"Failed to decode ChaosIQ's streamed job {line}",
+                exc_info=True)
+            return
+
+        await self.dispatch(body)
+
+    async def dispatch(self, body: Dict[str, Any]) -> None:
+        """
+        Parse the job received from ChaosIQ, hand it over to the scheduler
+        and acknowledge it.
+
+        Jobs already received recently are only acknowledged again.
+        """
+        received = asyncio.get_running_loop().time()
+        try:
+            job = Job.parse_obj(body)
+            logger.info(f"Got job '{job.id}' to process")
+        except ValidationError as x:
+            logger.error(f"Failed to parse job: {str(x)}")
+            return
+
+        if self.seen.seen(str(job.id)):
+            # its previous acknowledgement was likely lost, try again
+            logger.warning(f"Dropping job '{job.id}' received more than once")
+            self.ack_job(job)
+            return
+
+        self.journal.record(job, "received")
+        try:
+            await self.handle_job(job)
+            FETCH_TO_SPAWN.observe(
+                asyncio.get_running_loop().time() - received)
+        finally:
+            self.ack_job(job)
 
     async def handle_job(self, job: Job) -> None:
-        # await self.sched.spawn(self.backend.process_job(job=job))
-        await self.sched.spawn(self.__handle_job(job=job))
+        """
+        Start the job right away or hold it until its `run_at` date.
+        """
+        if job.run_at:
+            delay = seconds_until(job.run_at)
+            if delay > 0:
+                logger.info(f"Job '{job.id}' deferred until {job.run_at}")
+                self.deferred.defer(job, delay)
+                return
+
+        await self.start_job(job)
 
-    async def __handle_job(self, job: Job) -> None:
+    async def start_job(self, job: Job) -> None:
+        started = asyncio.get_running_loop().time()
+        self.queued[str(job.id)] = job
+        await self.sched.spawn(self.__handle_job(job=job, started=started))
+
+    async def __handle_job(self, job: Job, started: float) -> None:
+        """
+        Run the job. Its latency is measured from `started`, so that it
+        includes the wait for a free slot.
+        """
+        job_id = str(job.id)
+        if self.queued.pop(job_id, None) is None:
+            # handed back to ChaosIQ while the agent was draining
+            return
+
+        self.journal.record(job, "started")
+        self.in_flight[job_id] = job
+        loop = asyncio.get_running_loop()
+        processing = loop.time()
+        declined = False
         try:
             await self.backend.process_job(job=job)
-            await self.update_job_status(job, status="processed")
+            self.update_job_status(job, status="processed")
+        except JobDeclined as x:
+            self.hand_back(job, str(x))
+            declined = True
         except Exception as exc:  # noqa: 0703
             logger.error(f"Failed to handle job {job.id}", exc_info=True)
-            await self.update_job_status(
+            self.update_job_status(
                 job, status="failed", info={"exception": str(exc)})
+        finally:
+            del self.in_flight[job_id]
+            # a declined job did not run
+            if not declined:
+                JOB_DURATION.observe(
+                    loop.time() - processing, self.backend.backend_name(job))
+                self.latencies.append(loop.time() - started)
+                self.journal.record(job, "finished")
+            # deferred so that the scheduler has released the slot by the
+            # time the consumer wakes up
+            asyncio.get_running_loop().call_soon(self._slot_freed.set)
 
-    async def ack_job(self, job: Job) -> None:
+    def hand_back(self, job: Job, reason: str) -> None:
+        """
+        Report the job as requeued, so that ChaosIQ delivers it again, to
+        this agent or to another one, which then runs it.
+        """
+        logger.info(f"Handing job '{job.id}' back to ChaosIQ: {reason}")
+        self.update_job_status(job, status="requeued", info={"reason": reason})
+        self.journal.record(job, "requeued")
+        self.seen.discard(str(job.id))
+
+    def ack_job(self, job: Job) -> None:
         """
         This ACK is to remove the processed job from the job queue
+
+        It is sent in the background by the outbox.
         """
-        async with ChaosIQClient(self.config) as client:
-            await client.delete(f"/agent/jobs/queue/{job.id}")
+        self.outbox.ack(str(job.id))
 
-    async def update_job_status(
+    def update_job_status(
             self, job: Job, status: str, info: Dict[str, Any] = None) -> None:
         """
         Reports the status of the current job to ChaosIQ
+
+        It is sent in the background by the outbox.
         """
-        async with ChaosIQClient(self.config) as client:
-            await client.put(
-                f"/agent/jobs/{job.id}/status",
-                json={"status": status, "info": info},
-            )
+        self.outbox.update_status(str(job.id), status, info)
 
     @staticmethod
     def aiojobs_exception(
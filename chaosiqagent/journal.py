@@ -0,0 +1,271 @@
+import asyncio
+import json
+import os
+from types import TracebackType
+from typing import Any, Dict, List, Literal, Optional, TextIO, Tuple, Type
+
+import aiojobs
+from aiojobs import Scheduler
+from pydantic import ValidationError
+
+from .json import JSONEncoder
+from .log import logger
+from .types import Config, Job
+
+__all__ = ["Journal", "JobState"]
+
+
+JobState = Literal["received", "started", "finished", "requeued"]
+
+
+class Journal:
+    """
+    Append-only, on-disk, record of the jobs transitions so that the jobs
+    received by the agent are not lost when it is killed.
+
+    Records are buffered in memory and written by batch, with a single
+    `fsync` every `journal_sync_interval` seconds, off the event loop. Once
+    `journal_compact_threshold` records were written, the file is rewritten
+    with only the jobs not yet finished.
+
+    Jobs handed back to ChaosIQ are recorded as `requeued`: they are not
+    `known` to the next run, which must run them when they are redelivered.
+
+    The journal is readable by the agent's user only, since it holds the
+    jobs' access tokens. It is disabled when no `journal_path` is
+    configured.
+    """
+    def __init__(self, config: Config) -> None:
+        self.sched: Scheduler = None
+        self.config = config
+        # empty when the journal is disabled
+        self.path: str = config.journal_path or ""
+        self.aiojob: aiojobs._job.Job = None
+        # jobs that are not finished yet, by identifier
+        self.unfinished: Dict[str, Dict[str, Any]] = {}
+        # jobs left unfinished when the agent was last stopped
+        self.recovered: Dict[str, Dict[str, Any]] = {}
+        # every job found in the journal, finished or not, in order
+        self.known: List[str] = []
+        self._buffer: List[str] = []
+        self._records = 0
+        self._file: Optional[TextIO] = None
+        self._running = False
+        self._wakeup: asyncio.Event = None  # type: ignore
+        # one write at a time, so that a flush returns once the records
+        # buffered before it are on disk
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self) -> 'Journal':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when records are being written to disk.
+        """
+        return self._running
+
+    async def setup(self) -> None:
+        """
+        Load the jobs left unfinished by a previous run, compact the journal
+        and start writing the new records.
+        """
+        if not self.enabled:
+            logger.info("Jobs journal is disabled")
+            return
+
+        logger.info(f"Opening jobs journal at '{self.path}'")
+        loop = asyncio.get_running_loop()
+        self.recovered, self.known = await loop.run_in_executor(
+            None, self._load)
+        self.unfinished = {k: dict(v) for k, v in self.recovered.items()}
+        await self.compact()
+
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        self._running = True
+        self.aiojob = await self.sched.spawn(self.sync())
+
+    async def cleanup(self) -> None:
+        """
+        Write the last records and close the journal.
+        """
+        if not self.enabled or not self._running:
+            return
+
+        self._running = False
+        self._wakeup.set()
+        if not self.sched.closed:
+            logger.info("Closing jobs journal")
+            await self.aiojob.wait()
+            await asyncio.wait_for(self.sched.close(), None)
+
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def jobs(self) -> Tuple[List[Job], List[Job]]:
+        """
+        Jobs left unfinished by a previous run: the ones that were received
+        but not started yet, and the ones that were interrupted while
+        running.
+        """
+        received: List[Job] = []
+        interrupted: List[Job] = []
+        for job_id, entry in self.recovered.items():
+            try:
+                job = Job.parse_obj(entry["job"])
+            except ValidationError as x:
+                logger.error(
+                    f"Failed to parse journaled job {job_id}: {str(x)}")
+                continue
+
+            if entry["state"] == "received":
+                received.append(job)
+            else:
+                interrupted.append(job)
+        return received, interrupted
+
+    def record(self, job: Job, state: JobState) -> None:
+        """
+        Record the job's transition. It is written to disk in the background.
+        """
+        if not self.enabled:
+            return
+
+        job_id = str(job.id)
+        entry: Dict[str, Any] = {"id": job_id, "state": state}
+        if state == "received":
+            self.unfinished[job_id] = {**entry, "job": job}
+            entry["job"] = job
+        elif state in ("finished", "requeued"):
+            self.unfinished.pop(job_id, None)
+        elif job_id in self.unfinished:
+            self.unfinished[job_id]["state"] = state
+
+        self._buffer.append(json.dumps(entry, cls=JSONEncoder))
+
+    async def sync(self) -> None:
+        """
+        Periodically write the buffered records to disk.
+        """
+        while self._running:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), self.config.journal_sync_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Write and `fsync` the buffered records, compacting the journal when
+        it has grown too large.
+        """
+        if self._lock is None:
+            return
+
+        async with self._lock:
+            if not self._buffer:
+                return
+
+            lines, self._buffer = self._buffer, []
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write, lines)
+
+            self._records += len(lines)
+            if self._records >= self.config.journal_compact_threshold:
+                await self.compact()
+
+    async def compact(self) -> None:
+        """
+        Rewrite the journal with only the jobs not finished yet.
+        """
+        lines = [
+            json.dumps(entry, cls=JSONEncoder)
+            for entry in self.unfinished.values()
+        ]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._rewrite, lines)
+        self._records = len(lines)
+
+    ###########################################################################
+    # Internals, run off the event loop
+    ###########################################################################
+    def _load(self) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+        unfinished: Dict[str, Dict[str, Any]] = {}
+        known: Dict[str, None] = {}
+        if not os.path.isfile(self.path):
+            return unfinished, []
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # likely the last record, cut short when we were killed
+                    logger.warning(f"Skipping invalid journal record {line}")
+                    continue
+
+                job_id, state = entry["id"], entry["state"]
+                known[job_id] = None
+                if state == "received":
+                    unfinished[job_id] = entry
+                elif state == "finished":
+                    unfinished.pop(job_id, None)
+                elif state == "requeued":
+                    unfinished.pop(job_id, None)
+                    known.pop(job_id, None)
+                elif job_id in unfinished:
+                    unfinished[job_id]["state"] = state
+        return unfinished, list(known)
+
+    def _write(self, lines: List[str]) -> None:
+        f = self._file
+        # opened by the setup, closed once the last records were written
+        assert f is not None
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _rewrite(self, lines: List[str]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", opener=private) as f:
+            if lines:
+                f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        if self._file:
+            self._file.close()
+        self._file = open(self.path, "a")
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
+
+
+def private(path: str, flags: int) -> int:
+    """
+    Open the file, creating it readable by its owner only.
+    """
+    return os.open(path, flags, 0o600)
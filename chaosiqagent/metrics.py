@@ -0,0 +1,275 @@
+import asyncio
+import bisect
+import socket
+from types import TracebackType
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, \
+    Type
+
+import uvicorn
+
+from .log import logger
+from .types import Config
+
+__all__ = ["Counter", "Gauge", "Histogram", "MetricsServer", "render",
+           "LATENCY_BUCKETS", "DURATION_BUCKETS", "POLL_DURATION",
+           "FETCH_TO_SPAWN", "JOB_DURATION", "BACKEND_WAIT", "HEARTBEAT",
+           "K8S_SUBMISSION", "OUTBOX_DURATION", "OUTBOX_ERRORS",
+           "JOBS_ACTIVE", "JOBS_PENDING", "LOOP_LAG", "SLOW_CALLBACKS",
+           "SEEN_JOBS", "SEEN_JOBS_EVICTIONS", "DEFERRED_LATENESS"]
+
+# seconds, for calls to ChaosIQ, Kubernetes or the event loop
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds, for jobs
+DURATION_BUCKETS = (
+    1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+Labels = Tuple[str, ...]
+
+# every metric, in the order they are rendered
+REGISTRY: List["Metric"] = []
+
+
+class Metric:
+    """
+    Metric in the Prometheus text format. Label values are given in the
+    order of the metric's `labels`.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str,
+                 labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+        ] + self.samples()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def format_labels(self, values: Labels, **extra: str) -> str:
+        pairs = list(zip(self.labels, values)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str,
+                 labels: Sequence[str] = ()) -> None:
+        Metric.__init__(self, name, help, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *values: str, amount: float = 1.0) -> None:
+        self.values[values] = self.values.get(values, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{self.format_labels(values)} {value}"
+            for values, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge whose value is read from a function when the metrics are
+    rendered.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str) -> None:
+        Metric.__init__(self, name, help)
+        self.function: Optional[Callable[[], float]] = None
+
+    def set_function(self, function: Optional[Callable[[], float]]) -> None:
+        self.function = function
+
+    def samples(self) -> List[str]:
+        if self.function is None:
+            return []
+        return [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets. Observing a value costs a binary search
+    and two additions, the buckets are only accumulated when rendered.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+        # per label values, the count of each bucket then of +Inf
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, *values: str) -> None:
+        counts = self.counts.get(values)
+        if counts is None:
+            counts = self.counts[values] = [0] * (len(self.buckets) + 1)
+            self.sums[values] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[values] += value
+
+    def count(self, *values: str) -> int:
+        return sum(self.counts.get(values, []))
+
+    def samples(self) -> List[str]:
+        samples = []
+        for values, counts in self.counts.items():
+            total = 0
+            bounds = [str(b) for b in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                total += count
+                samples.append(
+                    f"{self.name}_bucket"
+                    f"{self.format_labels(values, le=bound)} {total}")
+            labels = self.format_labels(values)
+            samples.append(f"{self.name}_sum{labels} {self.sums[values]}")
+            samples.append(f"{self.name}_count{labels} {total}")
+        return samples
+
+
+def render() -> str:
+    """
+    All the metrics, in the Prometheus text format.
+    """
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+POLL_DURATION = Histogram(
+    "chaosiq_agent_poll_seconds",
+    "Polls of the ChaosIQ job queue, by result: jobs, empty or error",
+    ["result"])
+FETCH_TO_SPAWN = Histogram(
+    "chaosiq_agent_fetch_to_spawn_seconds",
+    "Delay between a job being received and handed over to the scheduler")
+JOB_DURATION = Histogram(
+    "chaosiq_agent_job_seconds",
+    "Jobs run by the backend, by backend", ["backend"],
+    buckets=DURATION_BUCKETS)
+BACKEND_WAIT = Histogram(
+    "chaosiq_agent_backend_wait_seconds",
+    "Time jobs waited for room in their backend, by backend", ["backend"],
+    buckets=DURATION_BUCKETS)
+K8S_SUBMISSION = Histogram(
+    "chaosiq_agent_k8s_submission_seconds",
+    "Submissions of the settings secret and experiment of a job to "
+    "Kubernetes")
+HEARTBEAT = Histogram(
+    "chaosiq_agent_heartbeat_seconds",
+    "Heartbeats sent to ChaosIQ, by result: sent, error or skipped when "
+    "ChaosIQ heard from the agent meanwhile", ["result"])
+OUTBOX_DURATION = Histogram(
+    "chaosiq_agent_outbox_request_seconds",
+    "Calls reporting jobs to ChaosIQ, by kind: ack or status", ["kind"])
+OUTBOX_ERRORS = Counter(
+    "chaosiq_agent_outbox_errors_total",
+    "Calls reporting jobs to ChaosIQ that failed, by kind: ack or status",
+    ["kind"])
+JOBS_ACTIVE = Gauge(
+    "chaosiq_agent_jobs_active", "Jobs the scheduler is running")
+JOBS_PENDING = Gauge(
+    "chaosiq_agent_jobs_pending", "Jobs waiting for a free slot")
+LOOP_LAG = Histogram(
+    "chaosiq_agent_loop_lag_seconds",
+    "How late the event loop ran the watchdog's timer")
+SLOW_CALLBACKS = Counter(
+    "chaosiq_agent_slow_callbacks_total",
+    "Callbacks that blocked the event loop for too long, by location",
+    ["location"])
+SEEN_JOBS = Counter(
+    "chaosiq_agent_seen_jobs_total",
+    "Jobs received, by whether they were seen already: hit or miss",
+    ["result"])
+SEEN_JOBS_EVICTIONS = Counter(
+    "chaosiq_agent_seen_jobs_evictions_total",
+    "Seen jobs forgotten, as they expired or too many were held")
+
+DEFERRED_LATENESS = Histogram(
+    "chaosiq_agent_deferred_lateness_seconds",
+    "How late deferred jobs were handed over, past their run_at date")
+
+
+class MetricsServer:
+    """
+    Local HTTP server exposing the metrics to Prometheus on
+    `http://<metrics_host>:<metrics_port>/metrics`, when a port is set.
+    """
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.server: Optional[uvicorn.Server] = None
+        self.task: Optional[asyncio.Future] = None
+        self.port = 0
+
+    async def __aenter__(self) -> 'MetricsServer':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when the metrics are being served.
+        """
+        return self.server is not None and self.server.started
+
+    async def setup(self) -> None:
+        if not self.config.metrics_port:
+            return
+
+        host, port = self.config.metrics_host, self.config.metrics_port
+        # bound here so that a port in use is not fatal to the agent
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except OSError as x:
+            sock.close()
+            logger.error(f"Cannot serve metrics on {host}:{port}: {x}")
+            return
+
+        self.port = sock.getsockname()[1]
+        # started before the agent installs its signal handlers, which then
+        # take precedence over the server's
+        self.server = uvicorn.Server(uvicorn.Config(
+            self.app, interface="asgi3", lifespan="off", access_log=False,
+            log_level="warning"))
+        self.task = asyncio.ensure_future(self.server.serve(sockets=[sock]))
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        logger.info(f"Serving metrics on http://{host}:{self.port}/metrics")
+
+    async def cleanup(self) -> None:
+        if self.server and self.task:
+            self.server.should_exit = True
+            await self.task
+            self.server = self.task = None
+
+    async def app(self, scope: Dict[str, Any], receive: Any,
+                  send: Any) -> None:
+        if scope["path"] != "/metrics":
+            status, body = 404, b""
+        else:
+            status, body = 200, render().encode()
+        await send({
+            "type": "http.response.start", "status": status,
+            "headers": [
+                (b"content-type", b"text/plain; version=0.0.4")]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,248 @@
+import asyncio
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Type
+
+import aiojobs
+from aiojobs import Scheduler
+import httpx
+
+from .client import ChaosIQClient
+from .journal import Journal
+from .log import logger
+from .metrics import OUTBOX_DURATION, OUTBOX_ERRORS
+from .types import Config
+
+__all__ = ["Outbox"]
+
+
+class Outbox:
+    """
+    Background queue of the acknowledgements and status updates to send to
+    ChaosIQ.
+
+    They are coalesced into bulk calls, sent when `outbox_batch_size` items
+    are waiting or every `outbox_flush_interval` seconds, so that the jobs
+    consumer never waits on them. Individual calls are used instead when
+    ChaosIQ does not support the bulk endpoints.
+
+    Items that could not be delivered are kept for the next flush, up to
+    `outbox_max_size` items. Acknowledgements are only sent once the jobs
+    journal is on disk, so that ChaosIQ does not forget a job the agent
+    could still lose.
+    """
+    def __init__(self, config: Config, client: ChaosIQClient,
+                 journal: Optional[Journal] = None) -> None:
+        self.sched: Scheduler = None
+        self.config = config
+        self.client = client
+        self.journal = journal
+        self.acks: List[str] = []
+        self.statuses: List[Dict[str, Any]] = []
+        self.bulk = True
+        self.aiojob: aiojobs._job.Job = None
+        self._running = False
+        self._wakeup: asyncio.Event = None  # type: ignore
+        # one flush at a time, so that nothing is sent twice or out of order
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self) -> 'Outbox':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when the outbox is flushed periodically.
+        """
+        return self._running
+
+    def __len__(self) -> int:
+        return len(self.acks) + len(self.statuses)
+
+    async def setup(self) -> None:
+        """
+        Spawn the loop flushing the outbox.
+        """
+        logger.info("Creating outbox")
+        self._wakeup = asyncio.Event()
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        self._running = True
+        self.aiojob = await self.sched.spawn(self.send())
+
+    async def cleanup(self) -> None:
+        """
+        Stop the flushing loop and send what is left in the outbox.
+        """
+        self._running = False
+        self._wakeup.set()
+        if not self.sched.closed:
+            logger.info("Closing outbox")
+            await self.aiojob.wait()
+            await asyncio.wait_for(self.sched.close(), None)
+
+    def ack(self, job_id: str) -> None:
+        """
+        Queue the removal of the job from the ChaosIQ job queue.
+        """
+        self.acks.append(job_id)
+        self._notify()
+
+    def update_status(self, job_id: str, status: str,
+                      info: Dict[str, Any] = None) -> None:
+        """
+        Queue the report of the job's status.
+        """
+        self.statuses.append({"id": job_id, "status": status, "info": info})
+        self._notify()
+
+    async def send(self) -> None:
+        """
+        Flush the outbox whenever it is full or periodically.
+        """
+        while self._running:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), self.config.outbox_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+        # last chance to send what was queued while terminating
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Send everything currently queued. Acknowledgements go first.
+
+        Items that could not be delivered are kept for the next flush.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            acks, self.acks = self.acks, []
+            statuses, self.statuses = self.statuses, []
+
+            if acks and self.journal:
+                await self.journal.flush()
+            if acks:
+                self.acks[:0] = await self.send_acks(acks)
+            if statuses:
+                self.statuses[:0] = await self.send_statuses(statuses)
+            self._trim()
+
+    async def send_acks(self, acks: List[str]) -> List[str]:
+        """
+        Send the acknowledgements, and return the ones not delivered.
+        """
+        if self.bulk:
+            resp = await self._call(
+                "ack", "POST", "/agent/jobs/queue/acks", json={"ids": acks})
+            if resp is None or not self._unsupported(resp):
+                if self._delivered(resp, "acknowledge jobs"):
+                    return []
+                return acks
+
+        responses = await asyncio.gather(*[
+            self._call("ack", "DELETE", f"/agent/jobs/queue/{job_id}")
+            for job_id in acks
+        ])
+        return [
+            job_id for job_id, resp in zip(acks, responses)
+            if not self._delivered(resp, "acknowledge job")]
+
+    async def send_statuses(
+            self, statuses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send the status updates, and return the ones not delivered.
+        """
+        if self.bulk:
+            resp = await self._call(
+                "status", "PUT", "/agent/jobs/statuses",
+                json={"statuses": statuses})
+            if resp is None or not self._unsupported(resp):
+                if self._delivered(resp, "report jobs status"):
+                    return []
+                return statuses
+
+        # transitions of a given job must be reported in order
+        for index, s in enumerate(statuses):
+            resp = await self._call(
+                "status", "PUT", f"/agent/jobs/{s['id']}/status",
+                json={"status": s["status"], "info": s["info"]})
+            if not self._delivered(resp, "report job status"):
+                return statuses[index:]
+        return []
+
+    ###########################################################################
+    # Internals
+    ###########################################################################
+    def _notify(self) -> None:
+        if len(self) >= self.config.outbox_batch_size:
+            self._wakeup.set()
+
+    def _trim(self) -> None:
+        """
+        Drop the oldest items past `outbox_max_size`, status updates first
+        since a job whose acknowledgement is lost is delivered again.
+        """
+        excess = len(self) - self.config.outbox_max_size
+        if excess <= 0:
+            return
+
+        logger.warning(
+            f"Outbox is full, dropping {excess} items ChaosIQ did not get")
+        dropped = min(excess, len(self.statuses))
+        del self.statuses[:dropped]
+        del self.acks[:excess - dropped]
+
+    async def _call(self, kind: str, method: str, url: str,
+                    **kwargs: Any) -> Optional[httpx.Response]:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            resp = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as x:
+            logger.warning(f"Failed to reach ChaosIQ: {str(x)}")
+            OUTBOX_ERRORS.inc(kind)
+            return None
+        finally:
+            OUTBOX_DURATION.observe(loop.time() - start, kind)
+        if resp.status_code >= 400:
+            OUTBOX_ERRORS.inc(kind)
+        return resp
+
+    def _unsupported(self, resp: httpx.Response) -> bool:
+        if resp.status_code in (404, 405, 501):
+            logger.warning(
+                "ChaosIQ does not support bulk job updates, falling back "
+                "to individual calls")
+            self.bulk = False
+            return True
+        return False
+
+    @staticmethod
+    def _delivered(resp: Optional[httpx.Response], what: str) -> bool:
+        if resp is None:
+            return False
+        if resp.status_code >= 500:
+            logger.warning(f"Failed to {what}: {resp.text}")
+            return False
+        if resp.status_code >= 400:
+            # retrying would not make it any better
+            logger.error(f"ChaosIQ refused to {what}: {resp.text}")
+        return True
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
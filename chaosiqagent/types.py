@@ -2,16 +2,35 @@ import asyncio
 from datetime import datetime
 from typing import Literal, Optional, Dict, Any, List
 
-from pydantic import BaseModel, BaseSettings, Field, UUID4, AnyUrl, PositiveInt
+from pydantic import BaseModel, BaseSettings, Field, UUID4, AnyUrl, \
+    NonNegativeFloat, NonNegativeInt, PositiveFloat, PositiveInt
 from pydantic.fields import Undefined
 
-__all__ = ["Config", "Job", "Backend", "Futures"]
+__all__ = ["Config", "Job", "Backend", "Futures", "Route", "Capacity"]
 
 
-Backend = Literal["null", "kubernetes", "shell"]
+Backend = Literal["null", "kubernetes", "shell", "inprocess", "router"]
 Futures = List[asyncio.Future]
 
 
+class Route(BaseModel):
+    """
+    Jobs of `target_type`, any type when not set, whose payload holds all the
+    `payload` items are run by `backend`.
+    """
+    backend: Backend
+    target_type: Optional[Literal["experiment", "verification"]]
+    payload: Dict[str, Any] = {}
+
+
+class Capacity(BaseModel):
+    """
+    Jobs a backend runs at once, and jobs waiting for one of its slots.
+    """
+    limit: PositiveInt = 10
+    queue: NonNegativeInt = 10
+
+
 class Config(BaseSettings):
     debug: bool = False
     log_format: Literal["plain", "structured"]
@@ -22,10 +41,116 @@ class Config(BaseSettings):
     verify_tls: bool = Field(True, env='VERIFY_TLS')
     # This binary is used for shell backend
     chaos_binary: str = Field(Undefined, env='CHAOS_BINARY')
+    # Warm Chaos Toolkit processes the shell backend runs jobs with, instead
+    # of starting `chaos_binary` for each job when set. They use the
+    # `chaos_worker_python` interpreter, by default the binary's, and are
+    # replaced after `chaos_worker_max_jobs` jobs or past
+    # `chaos_worker_max_rss` MiB of memory
+    chaos_workers: NonNegativeInt = Field(0, env='CHAOS_WORKERS')
+    chaos_worker_python: Optional[str] = Field(
+        None, env='CHAOS_WORKER_PYTHON')
+    chaos_worker_max_jobs: PositiveInt = Field(
+        20, env='CHAOS_WORKER_MAX_JOBS')
+    chaos_worker_max_rss: PositiveInt = Field(512, env='CHAOS_WORKER_MAX_RSS')
+    # Processes the inprocess backend runs experiments in, each one running
+    # up to `inprocess_max_jobs_per_worker` jobs, and each job running up
+    # to `inprocess_job_timeout` seconds
+    inprocess_workers: PositiveInt = Field(4, env='INPROCESS_WORKERS')
+    inprocess_max_jobs_per_worker: PositiveInt = Field(
+        20, env='INPROCESS_MAX_JOBS_PER_WORKER')
+    inprocess_job_timeout: PositiveFloat = Field(
+        3600.0, env='INPROCESS_JOB_TIMEOUT')
+    # Jobs are run by the backend of the first route they match with the
+    # router backend. Each of those backends has its own capacity, jobs are
+    # handed back to ChaosIQ once its queue is full too. The agent then runs
+    # as many jobs at once as all of them hold, instead of
+    # `max_concurrent_jobs`
+    router_routes: List[Route] = Field([], env='ROUTER_ROUTES')
+    router_capacities: Dict[str, Capacity] = Field(
+        {}, env='ROUTER_CAPACITIES')
+    # Prometheus metrics are served locally on
+    # `http://<metrics_host>:<metrics_port>/metrics`, when a port is set
+    metrics_port: NonNegativeInt = Field(0, env='METRICS_PORT')
+    metrics_host: str = Field('127.0.0.1', env='METRICS_HOST')
+    # Callbacks blocking the event loop for more than that many seconds are
+    # reported along with their stack (0 to disable)
+    loop_lag_threshold: NonNegativeFloat = Field(
+        0.1, env='LOOP_LAG_THRESHOLD')
     heartbeat_interval: PositiveInt = Field(900, env='HEARTBEAT_INTERVAL')
     # Default docker image containing the Chaos Toolkit (K8s)
     ctk_docker_image: str = Field(
         'chaosiq/chaostoolkit', env='CTK_DOCKER_IMAGE')
+    # Jobs are spread over the clusters of these kubeconfig contexts, rather
+    # than run on the current one, when set (K8s)
+    k8s_contexts: List[str] = Field([], env='K8S_CONTEXTS')
+    # Connections to the Kubernetes API server, shared by all jobs (K8s)
+    k8s_max_connections: PositiveInt = Field(4, env='K8S_MAX_CONNECTIONS')
+    # Jobs fail when their experiment did not complete in time (K8s)
+    k8s_job_timeout: PositiveFloat = Field(3600.0, env='K8S_JOB_TIMEOUT')
+    # The cluster is saturated with `k8s_max_experiments` experiments
+    # pending or running (0 for no limit), or once a resource of the
+    # `k8s_resource_quota` quota of the `chaostoolkit-run` namespace, read
+    # every `k8s_quota_interval` seconds, is used up. Jobs are then held
+    # until it has room again, or declined (K8s)
+    k8s_max_experiments: NonNegativeInt = Field(
+        0, env='K8S_MAX_EXPERIMENTS')
+    k8s_resource_quota: Optional[str] = Field(
+        None, env='K8S_RESOURCE_QUOTA')
+    k8s_quota_interval: PositiveFloat = Field(
+        10.0, env='K8S_QUOTA_INTERVAL')
+    k8s_saturation_policy: Literal["hold", "decline"] = Field(
+        "hold", env='K8S_SATURATION_POLICY')
+    # Objects of finished jobs are deleted after that many seconds, up to
+    # `k8s_reaper_batch_size` jobs every `k8s_reaper_interval` seconds (K8s)
+    k8s_retention: PositiveFloat = Field(86400.0, env='K8S_RETENTION')
+    k8s_reaper_interval: PositiveFloat = Field(
+        60.0, env='K8S_REAPER_INTERVAL')
+    k8s_reaper_batch_size: PositiveInt = Field(
+        50, env='K8S_REAPER_BATCH_SIZE')
+    # Connection pool of the HTTP client shared by all agent's components
+    http_max_connections: PositiveInt = Field(
+        10, env='HTTP_MAX_CONNECTIONS')
+    http_max_keepalive_connections: PositiveInt = Field(
+        5, env='HTTP_MAX_KEEPALIVE_CONNECTIONS')
+    http_keepalive_expiry: PositiveFloat = Field(
+        60.0, env='HTTP_KEEPALIVE_EXPIRY')
+    # How jobs are delivered by ChaosIQ: periodically polled or pushed over
+    # a long-lived stream (falls back to polling when not supported)
+    job_delivery: Literal["poll", "stream"] = Field(
+        "poll", env='JOB_DELIVERY')
+    # Jobs stream is re-opened when nothing, not even a keep-alive, was
+    # received for that long
+    job_stream_timeout: PositiveFloat = Field(
+        60.0, env='JOB_STREAM_TIMEOUT')
+    # Maximum number of jobs fetched at once when polling
+    job_batch_size: PositiveInt = Field(10, env='JOB_BATCH_SIZE')
+    # Jobs running at once, and started jobs waiting for a free slot. No
+    # more jobs are fetched from ChaosIQ while all the slots are busy, so
+    # only deferred jobs coming due and jobs resumed on startup ever wait
+    max_concurrent_jobs: PositiveInt = Field(10, env='MAX_CONCURRENT_JOBS')
+    max_pending_jobs: PositiveInt = Field(10, env='MAX_PENDING_JOBS')
+    # Jobs running when the agent is terminated are given that many seconds
+    # to complete, they are reported as interrupted past it
+    drain_timeout: NonNegativeFloat = Field(25.0, env='DRAIN_TIMEOUT')
+    # Acks and status updates are sent by bulk once that many are waiting
+    # or periodically. Past the max size, the oldest ones that could not be
+    # delivered are dropped
+    outbox_batch_size: PositiveInt = Field(50, env='OUTBOX_BATCH_SIZE')
+    outbox_flush_interval: PositiveFloat = Field(
+        0.5, env='OUTBOX_FLUSH_INTERVAL')
+    outbox_max_size: PositiveInt = Field(10000, env='OUTBOX_MAX_SIZE')
+    # Jobs transitions are journaled on disk, when a path is set, so that
+    # they can be resumed after a crash
+    journal_path: Optional[str] = Field(None, env='JOURNAL_PATH')
+    journal_sync_interval: PositiveFloat = Field(
+        0.1, env='JOURNAL_SYNC_INTERVAL')
+    journal_compact_threshold: PositiveInt = Field(
+        10000, env='JOURNAL_COMPACT_THRESHOLD')
+    # Jobs received again within that many seconds, for instance because
+    # their acknowledgement was lost, are dropped. At most
+    # `seen_jobs_max_size` identifiers are remembered
+    seen_jobs_ttl: PositiveFloat = Field(3600.0, env='SEEN_JOBS_TTL')
+    seen_jobs_max_size: PositiveInt = Field(10000, env='SEEN_JOBS_MAX_SIZE')
 
 
 class Job(BaseModel):
@@ -1,7 +1,78 @@
+import asyncio
+import math
+from typing import AsyncIterator, Awaitable, Dict, Iterable, Optional, \
+    Sequence, Set, TypeVar
+
 from .log import logger
 from .types import Futures
 
-__all__ = ["raise_if_errored"]
+__all__ = ["raise_if_errored", "percentiles", "Stop"]
+
+T = TypeVar("T")
+
+
+class Stop:
+    """
+    Stop signal shared by the agent's loops, so that they leave as soon as
+    it is set rather than once their current sleep is over.
+
+    Its event is created on first use, in the running event loop.
+    """
+    def __init__(self) -> None:
+        self._event: Optional[asyncio.Event] = None
+
+    @property
+    def event(self) -> asyncio.Event:
+        if self._event is None:
+            self._event = asyncio.Event()
+        return self._event
+
+    def set(self) -> None:
+        self.event.set()
+
+    def is_set(self) -> bool:
+        return self.event.is_set()
+
+    async def sleep(self, delay: float) -> bool:
+        """
+        Sleep for `delay` seconds, less when stopped meanwhile. Returns
+        whether it was stopped.
+        """
+        try:
+            await asyncio.wait_for(self.event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_set()
+
+    async def interrupt(self, aw: Awaitable[T]) -> Optional[T]:
+        """
+        Result of the awaitable, or `None` when stopped before it was done,
+        in which case it is cancelled.
+        """
+        task = asyncio.ensure_future(aw)
+        stopped = asyncio.ensure_future(self.event.wait())
+        futures: Set[asyncio.Future] = {task, stopped}
+        try:
+            await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.cancel()
+            done = task.done()
+            if not done:
+                task.cancel()
+        return task.result() if done else None
+
+    async def iterate(self, it: AsyncIterator[T]) -> AsyncIterator[T]:
+        """
+        Items of the asynchronous iterator, until stopped.
+        """
+        while True:
+            try:
+                item = await self.interrupt(it.__anext__())
+            except StopAsyncIteration:
+                return
+            if item is None:
+                return
+            yield item
 
 
 def raise_if_errored(done: Futures, pending: Futures) -> None:
@@ -20,3 +91,19 @@ def raise_if_errored(done: Futures, pending: Futures) -> None:
         if x:
             logger.error(f"Failed to setup properly: {str(x)}")
             raise x
+
+
+def percentiles(values: Iterable[float],
+                ranks: Sequence[int]) -> Dict[str, float]:
+    """
+    Nearest-rank percentiles of the values, keyed as `p50`, `p99`...
+
+    Empty when there are no values.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {
+        f"p{rank}": ordered[max(0, math.ceil(rank * len(ordered) / 100) - 1)]
+        for rank in ranks
+    }
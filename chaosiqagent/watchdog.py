@@ -0,0 +1,185 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from types import FrameType, TracebackType
+from typing import Any, Dict, List, Optional, Type
+
+import aiojobs
+from aiojobs import Scheduler
+
+from .log import logger
+from .metrics import LOOP_LAG, SLOW_CALLBACKS
+from .types import Config
+
+__all__ = ["LoopWatchdog", "get_location", "trim_stack"]
+
+ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopWatchdog:
+    """
+    Measure the event loop lag continuously, and report the callbacks that
+    block the loop for more than `loop_lag_threshold` seconds.
+
+    A timer of the loop ticks every half threshold and records how late it
+    ran. Meanwhile, a thread checks that the timer keeps ticking: when it
+    does not, the thread samples the stack the loop is stuck in. The sample
+    is reported once the loop is free again, as the `trace` of a log record
+    and in the `chaosiq_agent_slow_callbacks_total` metric, by location.
+
+    Both only wake up every half threshold, so that the watchdog can be left
+    on in production.
+    """
+    def __init__(self, config: Config) -> None:
+        self.sched: Scheduler = None
+        self.config = config
+        self.interval = config.loop_lag_threshold / 2
+        # monotonic time the timer last ticked at
+        self.last_tick = 0.0
+        # largest lag since it was last taken, in seconds
+        self.max_lag = 0.0
+        # stack the loop was stuck in, as sampled by the thread
+        self.sample: Optional[traceback.StackSummary] = None
+        self.slow_callbacks = 0
+        self.thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._running = False
+
+    async def __aenter__(self) -> 'LoopWatchdog':
+        await self.setup()
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        exc_value: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.cleanup()
+
+    @property
+    def running(self) -> bool:
+        """
+        Flag that is set when the loop is being watched.
+        """
+        return self._running
+
+    async def setup(self) -> None:
+        self.sched = await asyncio.wait_for(
+            aiojobs.create_scheduler(
+                exception_handler=self.aiojobs_exception), None)
+        if not self.config.loop_lag_threshold:
+            return
+
+        logger.info(
+            f"Watching for callbacks blocking the event loop for more than "
+            f"{self.config.loop_lag_threshold}s")
+        self._running = True
+        self._stopped.clear()
+        self.last_tick = time.monotonic()
+        self.thread = threading.Thread(
+            target=self.watch, args=(threading.get_ident(),),
+            name="loop-watchdog", daemon=True)
+        self.thread.start()
+        await self.sched.spawn(self.tick())
+
+    async def cleanup(self) -> None:
+        self._running = False
+        self._stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if not self.sched.closed:
+            await asyncio.wait_for(self.sched.close(), None)
+
+    async def tick(self) -> None:
+        """
+        Record how late the loop runs the timer, and report the callback
+        that blocked it when it was too late.
+        """
+        loop = asyncio.get_running_loop()
+        while self._running:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self.last_tick = time.monotonic()
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+
+            sample, self.sample = self.sample, None
+            if lag > self.config.loop_lag_threshold:
+                self.report(lag, sample)
+
+    def take_lag(self) -> float:
+        """
+        Largest event loop lag since the previous call, in seconds.
+        """
+        lag, self.max_lag = self.max_lag, 0.0
+        return lag
+
+    def report(self, lag: float,
+               sample: Optional[traceback.StackSummary]) -> None:
+        self.slow_callbacks += 1
+        stack = trim_stack(sample) if sample else []
+        location = get_location(stack)
+        SLOW_CALLBACKS.inc(location)
+        logger.warning(
+            f"Event loop was blocked for at least {lag:.3f}s by {location}",
+            extra={
+                "blocked": lag, "location": location,
+                "trace": [
+                    f"{frame.filename}:{frame.lineno} in {frame.name}"
+                    for frame in stack]})
+
+    def watch(self, loop_thread: int) -> None:
+        """
+        Sample the stack of the loop's thread, once per stall, when the timer
+        did not tick in time.
+        """
+        threshold = self.config.loop_lag_threshold
+        sampled_tick = None
+        while not self._stopped.wait(self.interval):
+            tick = self.last_tick
+            if tick == sampled_tick or time.monotonic() - tick < threshold:
+                continue
+            frame: Optional[FrameType] = \
+                sys._current_frames().get(loop_thread)
+            if frame is not None:
+                self.sample = traceback.extract_stack(frame)
+                sampled_tick = tick
+
+    @staticmethod
+    def aiojobs_exception(
+            scheduler: Scheduler,
+            context: Dict[str, Any]) -> None:  # pragma: no cover
+        logger.error(context)
+
+
+def trim_stack(stack: traceback.StackSummary) -> List[traceback.FrameSummary]:
+    """
+    Frames of the callback the loop was running, without the loop's own.
+    """
+    frames = list(stack)
+    for index in range(len(frames) - 1, -1, -1):
+        if frames[index].filename.startswith(ASYNCIO_DIR):
+            return frames[index + 1:]
+    return frames
+
+
+def get_location(stack: List[traceback.FrameSummary]) -> str:
+    """
+    Innermost function of the agent in the stack, or innermost function
+    when the agent has none there: `chaosiqagent/job.py:dispatch`.
+    """
+    if not stack:
+        return "unknown"
+    agent = [f for f in stack if f.filename.startswith(PACKAGE_DIR)]
+    if agent:
+        frame = agent[-1]
+        filename = os.path.relpath(
+            frame.filename, os.path.dirname(PACKAGE_DIR))
+    else:
+        frame = stack[-1]
+        filename = os.path.basename(frame.filename)
+    return f"{filename}:{frame.name}"
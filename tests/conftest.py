@@ -1,11 +1,16 @@
 # type: ignore
 import os.path
+import stat
+import sys
+from unittest.mock import patch
 
 import better_exceptions
 import httpx
 import pytest
+from kubernetes_asyncio.client.api import core_v1_api, custom_objects_api
 
 from chaosiqagent.backend.base import BaseBackend
+from chaosiqagent.client import ChaosIQClient, get_client
 from chaosiqagent.settings import load_settings
 from chaosiqagent.types import Config, Job
 
@@ -27,7 +32,14 @@ def config(config_path: str) -> Config:
 @pytest.fixture
 def backend(config: Config) -> BaseBackend:
     from fixtures.backend import DummyBackend
-    return DummyBackend({})
+    return DummyBackend(config)
+
+
+@pytest.fixture
+async def client(config: Config) -> ChaosIQClient:
+    c = get_client(config)
+    yield c
+    await c.aclose()
 
 
 @pytest.fixture
@@ -51,3 +63,62 @@ def job(experiment) -> Job:
 def verification() -> Job:
     from fixtures.job import create_job
     return create_job(target_type="verification")
+
+
+@pytest.fixture
+def chaos_binary(tmp_path) -> str:
+    """
+    Fake `chaos` command echoing its arguments. It sleeps for
+    `FAKE_CHAOS_SLEEP` seconds and exits with `FAKE_CHAOS_EXIT`.
+    """
+    path = tmp_path / "chaos"
+    path.write_text(
+        "#!/bin/sh\n"
+        "echo \"chaos $@\"\n"
+        "echo \"running on stderr\" >&2\n"
+        "sleep ${FAKE_CHAOS_SLEEP:-0}\n"
+        "exit ${FAKE_CHAOS_EXIT:-0}\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+@pytest.fixture
+def ctk_binary(tmp_path, monkeypatch) -> str:
+    """
+    Python `chaos` script of a fake Chaos Toolkit installation.
+    """
+    ctk_dir = os.path.join(fixtures_dir, "ctk")
+    monkeypatch.setenv(
+        "PYTHONPATH", os.pathsep.join(
+            filter(None, [ctk_dir, os.getenv("PYTHONPATH")])))
+    path = tmp_path / "chaos"
+    path.write_text(
+        f"#!{sys.executable}\n"
+        "from chaostoolkit.cli import main\n"
+        "main()\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+@pytest.fixture
+def experiments_watch():
+    """
+    Watch requests of the Chaos Toolkit experiments custom resources.
+    """
+    from fixtures.k8s import FakeWatchApi
+    fake = FakeWatchApi()
+    with patch.object(
+            custom_objects_api.CustomObjectsApi,
+            "list_namespaced_custom_object", new=fake):
+        yield fake
+
+
+@pytest.fixture
+def pods_watch():
+    """
+    Watch requests of the pods running the experiments.
+    """
+    from fixtures.k8s import FakeWatchApi
+    fake = FakeWatchApi()
+    with patch.object(core_v1_api.CoreV1Api, "list_namespaced_pod", new=fake):
+        yield fake
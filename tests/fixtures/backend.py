@@ -1,8 +1,9 @@
-from chaosiqagent.types import Job
+import asyncio
+
 from chaosiqagent.backend.base import BaseBackend
 from chaosiqagent.types import Job
 
-__all__ = ["DummyBackend"]
+__all__ = ["DummyBackend", "BlockingBackend"]
 
 
 class DummyBackend(BaseBackend):
@@ -14,3 +15,22 @@ class DummyBackend(BaseBackend):
 
     async def process_job(self, job: Job) -> None:
         pass
+
+
+class BlockingBackend(DummyBackend):
+    """
+    Jobs keep running until `release` is set.
+    """
+    def __init__(self, config) -> None:
+        super().__init__(config)
+        self.release = asyncio.Event()
+        self.running = 0
+        self.max_running = 0
+
+    async def process_job(self, job: Job) -> None:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+        finally:
+            self.running -= 1
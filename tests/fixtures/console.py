@@ -0,0 +1,147 @@
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs
+
+import uvicorn
+
+from chaosiqagent.json import JSONEncoder
+from chaosiqagent.types import Job
+
+__all__ = ["FakeConsole", "run_console"]
+
+
+class FakeConsole:
+    """
+    Minimal ASGI application mimicking the ChaosIQ agent's endpoints so that
+    the agent can be exercised over real HTTP connections.
+    """
+    def __init__(self, stream: bool = True, bulk: bool = True) -> None:
+        self.stream = stream
+        self.bulk = bulk
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.requests: List[Tuple[str, str]] = []
+        self.queued_at: Dict[str, float] = {}
+        self.statuses: Dict[str, List[Tuple[str, float]]] = {}
+        self.acked: List[str] = []
+        self.closing = False
+
+    def push(self, job: Job) -> None:
+        self.queued_at[str(job.id)] = time.monotonic()
+        self.queue.put_nowait(job)
+
+    def latency(self, job: Job) -> float:
+        """
+        Time between the job being queued and its first status report.
+        """
+        job_id = str(job.id)
+        return self.statuses[job_id][0][1] - self.queued_at[job_id]
+
+    def count(self, method: str, path: str) -> int:
+        return len([r for r in self.requests if r == (method, path)])
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any,
+                       send: Any) -> None:
+        if scope["type"] != "http":
+            return
+
+        method, path = scope["method"], scope["path"]
+        self.requests.append((method, path))
+        body = b""
+        more = True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+
+        if path == "/agent/jobs/queue/next":
+            if self.queue.empty():
+                return await self.respond(send, 204)
+            query = parse_qs(scope["query_string"].decode())
+            if "limit" not in query:
+                job = self.queue.get_nowait()
+                return await self.respond(
+                    send, 200, json.dumps(job, cls=JSONEncoder).encode())
+            limit = int(query["limit"][0])
+            jobs = []
+            while len(jobs) < limit and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+            return await self.respond(
+                send, 200, json.dumps(jobs, cls=JSONEncoder).encode())
+        elif path == "/agent/jobs/queue/stream":
+            if not self.stream:
+                return await self.respond(send, 404)
+            return await self.stream_jobs(send)
+        elif path == "/agent/jobs/queue/acks":
+            if not self.bulk:
+                return await self.respond(send, 404)
+            self.acked.extend(json.loads(body)["ids"])
+            return await self.respond(send, 204)
+        elif path.startswith("/agent/jobs/queue/") and method == "DELETE":
+            self.acked.append(path.rsplit("/", 1)[-1])
+            return await self.respond(send, 204)
+        elif path == "/agent/jobs/statuses":
+            if not self.bulk:
+                return await self.respond(send, 404)
+            for status in json.loads(body)["statuses"]:
+                self.record_status(status["id"], status["status"])
+            return await self.respond(send, 200)
+        elif path.endswith("/status"):
+            self.record_status(
+                path.split("/")[3], json.loads(body)["status"])
+            return await self.respond(send, 200)
+
+        await self.respond(send, 200, b"{}")
+
+    def record_status(self, job_id: str, status: str) -> None:
+        self.statuses.setdefault(job_id, []).append(
+            (status, time.monotonic()))
+
+    async def respond(self, send: Any, status: int,
+                      body: bytes = b"") -> None:
+        await send({
+            "type": "http.response.start", "status": status,
+            "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def stream_jobs(self, send: Any) -> None:
+        await send({
+            "type": "http.response.start", "status": 200,
+            "headers": [(b"content-type", b"application/x-ndjson")]})
+        while not self.closing:
+            try:
+                job = await asyncio.wait_for(self.queue.get(), 0.1)
+                line = json.dumps(job, cls=JSONEncoder).encode() + b"\n"
+            except asyncio.TimeoutError:
+                # keep-alive
+                line = b"\n"
+            await send({
+                "type": "http.response.body", "body": line,
+                "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+class run_console:
+    """
+    Serve the fake console on a random local port for the duration of the
+    `async with` block. The block receives the console's base URL.
+    """
+    def __init__(self, console: FakeConsole) -> None:
+        self.console = console
+        self.server = uvicorn.Server(uvicorn.Config(
+            console, host="127.0.0.1", port=0, lifespan="off",
+            log_level="warning"))
+        self.task: asyncio.Task = None
+
+    async def __aenter__(self) -> str:
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def __aexit__(self, *exc: Any) -> None:
+        self.console.closing = True
+        self.server.should_exit = True
+        await self.task
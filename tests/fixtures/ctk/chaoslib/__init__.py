@@ -0,0 +1,7 @@
+"""
+Stand-in for the Chaos Toolkit's library.
+
+Experiments sleep for `FAKE_CHAOS_SLEEP` seconds and end with the
+`FAKE_CHAOS_STATUS` status, `completed` by default. Their settings are
+kept in `FAKE_CHAOS_SETTINGS`, when set, so that tests can check them.
+"""
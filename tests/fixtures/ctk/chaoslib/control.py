@@ -0,0 +1,17 @@
+import os
+
+loaded = None
+
+
+def load_global_controls(settings):
+    global loaded
+    loaded = settings
+
+
+def cleanup_global_controls():
+    global loaded
+    path = os.getenv("FAKE_CHAOS_SETTINGS")
+    if path:
+        with open(path, "a") as f:
+            f.write(f"{os.getpid()} {loaded}\n")
+    loaded = None
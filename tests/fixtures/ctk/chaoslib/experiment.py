@@ -0,0 +1,15 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger("chaostoolkit")
+
+
+def ensure_experiment_is_valid(experiment):
+    pass
+
+
+def run_experiment(experiment, settings=None):
+    logger.info(f"Running experiment: {experiment['title']}")
+    time.sleep(float(os.getenv("FAKE_CHAOS_SLEEP", "0")))
+    return {"status": os.getenv("FAKE_CHAOS_STATUS", "completed")}
@@ -0,0 +1,2 @@
+def load_experiment(experiment_source, settings=None, verify_tls=True):
+    return {"title": experiment_source, "verify_tls": verify_tls}
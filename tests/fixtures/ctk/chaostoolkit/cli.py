@@ -0,0 +1,44 @@
+"""
+Stand-in for the Chaos Toolkit's command line.
+
+`FAKE_CHAOS_IMPORT_TIME` is how long importing it takes, standing for the
+toolkit and its extensions imports. Commands echo their arguments, sleep for
+`FAKE_CHAOS_SLEEP` seconds and exit with `FAKE_CHAOS_EXIT`, or crash the
+process when `FAKE_CHAOS_CRASH` is set. The settings they are given are
+echoed too, and a line longer than a stream's limit when
+`FAKE_CHAOS_LONG_LINE` is set.
+"""
+import os
+import sys
+import time
+
+time.sleep(float(os.getenv("FAKE_CHAOS_IMPORT_TIME", "0")))
+print("chaostoolkit loaded")
+
+
+class Cli:
+    def main(self, args, prog_name="chaos", standalone_mode=True):
+        print(f"{prog_name} {' '.join(args)}")
+        if args[:1] == ["--settings"]:
+            with open(args[1]) as f:
+                print(f"settings: {f.read()!r}")
+        if os.getenv("FAKE_CHAOS_LONG_LINE"):
+            print("x" * 100000)
+        sys.stdout.flush()
+        time.sleep(float(os.getenv("FAKE_CHAOS_SLEEP", "0")))
+        if os.getenv("FAKE_CHAOS_CRASH"):
+            os._exit(9)
+        if os.getenv("FAKE_CHAOS_RAISE"):
+            raise RuntimeError("experiment blew up")
+        code = os.getenv("FAKE_CHAOS_EXIT")
+        if code:
+            sys.exit(int(code) if code.isdigit() else code)
+        if not standalone_mode:
+            return {"status": "completed"}
+
+
+cli = Cli()
+
+
+def main():
+    cli.main(sys.argv[1:])
@@ -0,0 +1,180 @@
+import asyncio
+import json
+from typing import Any, Dict, List, Set, Tuple
+
+from aiohttp import web
+
+__all__ = ["FakeWatchApi", "FakeWatchResponse", "pod_event", "FakeOperator",
+           "FakeApiServer"]
+
+
+class FakeWatchResponse:
+    """
+    Streamed response of a watch request, events are pushed by the test.
+    """
+    def __init__(self, status: int = 200) -> None:
+        self.status = status
+        self.content = self
+        self.released = False
+        self._lines: asyncio.Queue = asyncio.Queue()
+
+    def push(self, event_type: str, obj: Dict[str, Any]) -> None:
+        self.push_line(json.dumps({"type": event_type, "object": obj}))
+
+    def push_line(self, line: str) -> None:
+        self._lines.put_nowait(line.encode("utf-8") + b"\n")
+
+    def close(self) -> None:
+        """
+        The API server closes the watch, for instance once timed out.
+        """
+        self._lines.put_nowait(None)
+
+    def __aiter__(self) -> 'FakeWatchResponse':
+        return self
+
+    async def __anext__(self) -> bytes:
+        line = await self._lines.get()
+        if line is None:
+            raise StopAsyncIteration
+        return line
+
+    async def text(self) -> str:
+        return "watch failed"
+
+    def release(self) -> None:
+        self.released = True
+
+
+class FakeWatchApi:
+    """
+    Stands for a `list_namespaced_*` function of the Kubernetes API called to
+    watch resources. Scripted responses, or exceptions, are served first.
+    """
+    def __init__(self) -> None:
+        self.calls: List[Dict[str, Any]] = []
+        self.scripted: List[Any] = []
+        self.current: FakeWatchResponse = None
+
+    async def __call__(self, *args: Any, **kwargs: Any) -> FakeWatchResponse:
+        self.calls.append(kwargs)
+        if self.scripted:
+            response = self.scripted.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            self.current = response
+        else:
+            self.current = FakeWatchResponse()
+        return self.current
+
+    def push(self, event_type: str, obj: Dict[str, Any]) -> None:
+        self.current.push(event_type, obj)
+
+
+def pod_event(job_id: str, phase: str, version: str = "1",
+              **status: Any) -> Dict[str, Any]:
+    return {
+        "metadata": {
+            "name": f"chaostoolkit-{job_id}",
+            "resourceVersion": version,
+            "labels": {"job": job_id, "type": "experiment"},
+        },
+        "status": {"phase": phase, **status},
+    }
+
+
+class FakeOperator:
+    """
+    Side effect of the custom object creation: the experiment's pod ends in
+    the given phase right away.
+    """
+    def __init__(self, pods: FakeWatchApi, phase: str = "Succeeded") -> None:
+        self.pods = pods
+        self.phase = phase
+
+    def __call__(self, group: str, version: str, namespace: str,
+                       plural: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        job_id = body["metadata"]["labels"]["job"]
+        self.pods.push("MODIFIED", pod_event(job_id, self.phase))
+        return body
+
+
+class FakeApiServer:
+    """
+    Local Kubernetes API server answering the creation of secrets and
+    experiments after `latency` seconds. Experiments complete right away,
+    their pod being reported by the pods watch.
+
+    Creations of a kind fail with the status set in `failures`. The names
+    of the experiments are kept until they are deleted, deletions fail with
+    the status set for `deletions`.
+    """
+    def __init__(self, pods: FakeWatchApi, latency: float) -> None:
+        self.pods = pods
+        self.latency = latency
+        self.failures: Dict[str, int] = {}
+        # kind, start and end time of each request
+        self.requests: List[Tuple[str, float, float]] = []
+        self.experiments: Set[str] = set()
+        self.runner: web.AppRunner = None
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post(
+            "/api/v1/namespaces/{namespace}/secrets", self.create_secret)
+        app.router.add_get(
+            "/api/v1/namespaces/{namespace}/secrets", self.list_secrets)
+        app.router.add_post(
+            "/apis/{group}/{version}/namespaces/{namespace}/{plural}",
+            self.create_experiment)
+        app.router.add_delete(
+            "/apis/{group}/{version}/namespaces/{namespace}/{plural}/{name}",
+            self.delete_experiment)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+    async def create_secret(self, request: web.Request) -> web.Response:
+        return await self.create("secrets", request)
+
+    async def list_secrets(self, request: web.Request) -> web.Response:
+        return web.json_response({"kind": "SecretList", "items": []})
+
+    async def create_experiment(self, request: web.Request) -> web.Response:
+        response = await self.create("experiments", request)
+        if response.status == 201:
+            body = await request.json()
+            self.experiments.add(body["metadata"]["name"])
+            self.pods.push(
+                "MODIFIED", pod_event(body["metadata"]["name"], "Succeeded"))
+        return response
+
+    async def delete_experiment(self, request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        if "deletions" in self.failures:
+            return web.json_response(
+                {"kind": "Status", "code": self.failures["deletions"]},
+                status=self.failures["deletions"])
+        if name not in self.experiments:
+            return web.json_response(
+                {"kind": "Status", "code": 404}, status=404)
+        self.experiments.discard(name)
+        return web.json_response({"kind": "Status", "code": 200})
+
+    async def create(self, kind: str, request: web.Request) -> web.Response:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        self.requests.append((kind, start, loop.time()))
+        if kind in self.failures:
+            return web.json_response(
+                {"kind": "Status", "code": self.failures[kind]},
+                status=self.failures[kind])
+        return web.json_response(body, status=201)
@@ -15,6 +15,8 @@ from chaosiqagent.agent import Agent
 from chaosiqagent.log import configure_logging
 from chaosiqagent.settings import load_settings
 
+from fixtures.console import FakeConsole, run_console
+
 
 @respx.mock
 @pytest.mark.parametrize('sig', [signal.SIGTERM, signal.SIGINT, signal.SIGHUP])
@@ -64,3 +66,28 @@ async def test_agent_fails_connecting(config_path: str):
 
     agent = Agent(c)
     await agent.register()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("delivery", ["poll", "stream"])
+async def test_agent_terminates_right_away(config_path: str, delivery: str):
+    c = load_settings(config_path)
+    c.job_delivery = delivery
+    console = FakeConsole()
+
+    async with run_console(console) as url:
+        c.agent_url = url
+        agent = Agent(c)
+        run = asyncio.ensure_future(agent.run())
+        # the consumer backs off to sleeping for 2.4s when polling
+        await asyncio.sleep(2.5)
+
+        signaled_at = time.monotonic()
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(run, 5)
+        latency = time.monotonic() - signaled_at
+
+    assert agent.running is False
+    assert agent.client.is_closed
+    assert latency < 0.25
+    assert console.count("POST", "/agent/actions") == 3
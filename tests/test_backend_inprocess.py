@@ -0,0 +1,185 @@
+# type: ignore
+import asyncio
+import os
+import time
+
+import pytest
+
+from chaosiqagent.backend import get_backend
+from chaosiqagent.backend.inprocess import InProcessBackend
+from chaosiqagent.log import configure_logging
+from chaosiqagent.settings import load_settings
+
+from fixtures.job import create_job
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@pytest.fixture
+def chaoslib(monkeypatch, tmp_path) -> str:
+    """
+    Fake Chaos Toolkit library, its experiments record their process and
+    settings in the returned file.
+    """
+    monkeypatch.syspath_prepend(os.path.join(fixtures_dir, "ctk"))
+    path = str(tmp_path / "settings.log")
+    monkeypatch.setenv("FAKE_CHAOS_SETTINGS", path)
+    return path
+
+
+def read_runs(path: str):
+    with open(path) as f:
+        return [line.split(" ", 1) for line in f.read().splitlines()]
+
+
+@pytest.fixture
+def inprocess_config(config_path: str):
+    c = load_settings(config_path)
+    c.agent_backend = "inprocess"
+    c.inprocess_workers = 1
+    return c
+
+
+def test_get_inprocess_backend(inprocess_config):
+    assert isinstance(get_backend(inprocess_config), InProcessBackend)
+
+
+@pytest.mark.asyncio
+async def test_setup_without_chaos_toolkit(inprocess_config):
+    backend = InProcessBackend(inprocess_config)
+    with pytest.raises(RuntimeError) as x:
+        await backend.setup()
+    assert "The Chaos Toolkit must be installed alongside the agent" in \
+        str(x.value)
+    assert backend.executor is None
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_run_experiments_in_process(capfd, chaoslib, inprocess_config):
+    configure_logging(inprocess_config)
+    backend = InProcessBackend(inprocess_config)
+    await backend.setup()
+
+    jobs = [create_job() for _ in range(3)]
+    for job in jobs:
+        await backend.process_job(job)
+    await backend.cleanup()
+
+    runs = read_runs(chaoslib)
+    # the same warm process ran every job
+    assert len({pid for pid, _ in runs}) == 1
+    assert str(os.getpid()) not in {pid for pid, _ in runs}
+    # with the settings handed over in memory
+    assert "'value': 'azerty1234'" in runs[0][1]
+    assert f"'id': '{jobs[0].org_id}'" in runs[0][1]
+
+    captured = capfd.readouterr()
+    assert "running experiments in 1 processes" in captured.err
+    assert f"Experiment of job '{jobs[2].id}' ended as 'completed'" in \
+        captured.err
+    # logs of the experiment
+    assert f"Running experiment: {jobs[0].target_url}" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_recycle_processes(chaoslib, inprocess_config):
+    inprocess_config.inprocess_max_jobs_per_worker = 2
+    backend = InProcessBackend(inprocess_config)
+    await backend.setup()
+
+    for _ in range(5):
+        await backend.process_job(create_job())
+    await backend.cleanup()
+
+    pids = [pid for pid, _ in read_runs(chaoslib)]
+    assert pids[0] == pids[1]
+    assert pids[2] == pids[3]
+    assert len({pids[0], pids[2], pids[4]}) == 3
+
+
+@pytest.mark.asyncio
+async def test_experiment_not_completed(monkeypatch, chaoslib,
+                                        inprocess_config):
+    monkeypatch.setenv("FAKE_CHAOS_STATUS", "failed")
+    backend = InProcessBackend(inprocess_config)
+    await backend.setup()
+
+    with pytest.raises(RuntimeError) as x:
+        await backend.process_job(create_job())
+    assert str(x.value) == "Experiment ended as 'failed'"
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_experiment_timeout(monkeypatch, chaoslib, inprocess_config):
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "10")
+    inprocess_config.inprocess_job_timeout = 0.5
+    backend = InProcessBackend(inprocess_config)
+    await backend.setup()
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError) as x:
+            await backend.process_job(create_job())
+        assert str(x.value) == "Experiment did not complete within 0.5s"
+    await backend.cleanup()
+
+    # the process was interrupted but kept serving jobs
+    runs = read_runs(chaoslib)
+    assert len(runs) == 2
+    assert runs[0][0] == runs[1][0]
+
+
+@pytest.mark.asyncio
+async def test_run_verifications_with_chaos_binary(
+        capsys, chaoslib, chaos_binary, inprocess_config):
+    configure_logging(inprocess_config)
+    backend = InProcessBackend(inprocess_config)
+    await backend.setup()
+    with pytest.raises(RuntimeError) as x:
+        await backend.process_job(create_job(target_type="verification"))
+    assert str(x.value) == "Verifications need the 'chaos' binary to be set"
+    await backend.cleanup()
+
+    inprocess_config.chaos_binary = chaos_binary
+    backend = InProcessBackend(inprocess_config)
+    await backend.setup()
+    job = create_job(target_type="verification")
+    await backend.process_job(job)
+    await backend.cleanup()
+
+    captured = capsys.readouterr()
+    assert f"[{job.id}] chaos --settings" in captured.err
+    assert f"verify {job.target_url}" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_cancelled_job_kills_the_processes(
+        capfd, monkeypatch, chaoslib, inprocess_config):
+    configure_logging(inprocess_config)
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "30")
+    backend = InProcessBackend(inprocess_config)
+    await backend.setup()
+    executor = backend.executor
+
+    task = asyncio.ensure_future(backend.process_job(create_job()))
+    err = ""
+    while "Running experiment" not in err:
+        await asyncio.sleep(0.05)
+        err += capfd.readouterr().err
+    processes = list(executor._processes.values())
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # the next jobs run in new processes
+    assert backend.executor is not executor
+
+    start = time.monotonic()
+    await backend.cleanup()
+    assert time.monotonic() - start < 5
+    assert all(not p.is_alive() for p in processes)
+
+    # killing them again is a no-op
+    backend.kill(executor)
+    err += capfd.readouterr().err
+    assert err.count("Killing the processes") == 1
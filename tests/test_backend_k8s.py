@@ -1,19 +1,29 @@
+import asyncio
 import json
 import os
+import time
+import uuid
 from tempfile import NamedTemporaryFile
 from unittest.mock import patch, AsyncMock
 import yaml
 
 import pytest
 import respx
+from kubernetes_asyncio.client.api import core_v1_api, custom_objects_api
+from kubernetes_asyncio.client.rest import ApiException
 
 from chaosiqagent.agent import Agent
 from chaosiqagent.log import configure_logging
 from chaosiqagent.settings import load_settings
-from chaosiqagent.backend.k8s import render_experiment_manifest, \
-    render_secret_manifest
+from chaosiqagent.backend.k8s import get_k8s_labels_for_job, \
+    render_experiment_manifest, render_secret_manifest
+from chaosiqagent.ctk import SETTINGS_PATH, get_chaostoolkit_settings
 from chaosiqagent.types import Job
-from chaosiqagent.backend.k8s import core_v1_api, custom_objects_api
+from chaosiqagent.backend.k8s import K8SBackend
+from chaosiqagent.backend.k8s_watch import ExperimentFailed
+
+from fixtures.job import create_job
+from fixtures.k8s import FakeApiServer, FakeOperator
 
 
 
@@ -43,6 +53,11 @@ contexts:
 current-context: dev
 """
 
+# the API client is really created, it needs a valid certificate otherwise
+INSECURE_CONFIG = BASIC_CONFIG.replace(
+    b"certificate-authority-data: dGVzdAoK",
+    b"insecure-skip-tls-verify: true")
+
 
 @pytest.mark.asyncio
 async def test_fails_when_kubeconfig_cannot_be_found(config_path: str):
@@ -81,9 +96,10 @@ async def test_fails_when_kubeconfig_cannot_be_found(config_path: str):
 
 
 @pytest.mark.asyncio
-async def test_load_kube_config_at_default_location(config_path: str):
+async def test_load_kube_config_at_default_location(
+        config_path: str, experiments_watch, pods_watch):
     with NamedTemporaryFile() as f:
-        f.write(BASIC_CONFIG)
+        f.write(INSECURE_CONFIG)
         f.seek(0)
         os.environ["KUBECONFIG"] = f.name
 
@@ -112,9 +128,14 @@ async def test_load_kube_config_at_default_location(config_path: str):
 
                 await agent.setup()
                 assert agent.backend.k8s_config.host == "https://example.com"
+                # a single pool of connections for all jobs
+                session = agent.backend.k8s_client.rest_client.pool_manager
+                assert session.connector.limit == c.k8s_max_connections
 
                 await agent.cleanup()
                 assert agent.backend.k8s_config is None
+                assert agent.backend.k8s_client is None
+                assert session.closed
             del os.environ["KUBECONFIG"]
 
 
@@ -125,7 +146,8 @@ async def test_load_kube_config_at_default_location(config_path: str):
 @pytest.mark.asyncio
 async def test_load_kube_config_process_job(
         k8s_client, create_secret, create_custom_object,
-        config_path: str, job: Job):
+        config_path: str, job: Job, experiments_watch, pods_watch):
+    create_custom_object.side_effect = FakeOperator(pods_watch)
 
     with NamedTemporaryFile() as f:
         f.write(BASIC_CONFIG)
@@ -155,32 +177,190 @@ async def test_load_kube_config_process_job(
                 )
 
                 await agent.setup()
-
-                await agent.backend.process_job(job)
-                k8s_client.assert_called()
-                create_secret.assert_awaited()
-                assert create_secret.call_count == 1
+                await asyncio.sleep(0.05)
+
+                for _ in range(3):
+                    await agent.backend.process_job(job)
+                # the client is shared by all jobs
+                k8s_client.assert_called_once()
+                # the settings secret is shared by the team's jobs
+                create_secret.assert_awaited_once()
                 create_custom_object.assert_awaited()
-                assert create_custom_object.call_count == 1
+                assert create_custom_object.call_count == 3
 
                 await agent.cleanup()
                 assert agent.backend.k8s_config is None
+                k8s_client.return_value.close.assert_awaited_once()
+        del os.environ["KUBECONFIG"]
+
+
+@patch.object(custom_objects_api.CustomObjectsApi, "create_namespaced_custom_object", new_callable=AsyncMock)
+@patch.object(core_v1_api.CoreV1Api, "create_namespaced_secret", new_callable=AsyncMock)
+@patch("chaosiqagent.backend.k8s.ApiClient", autospec=True)
+@pytest.mark.asyncio
+async def test_process_job_fails_with_its_experiment(
+        k8s_client, create_secret, create_custom_object,
+        config_path: str, job: Job, experiments_watch, pods_watch):
+    with NamedTemporaryFile() as f:
+        f.write(BASIC_CONFIG)
+        f.seek(0)
+        os.environ["KUBECONFIG"] = f.name
+
+        c = load_settings(config_path)
+        c.agent_backend = "kubernetes"
+        c.k8s_job_timeout = 0.2
+        backend = K8SBackend(c)
+        await backend.setup()
+        await asyncio.sleep(0.05)
+
+        create_custom_object.side_effect = FakeOperator(pods_watch, "Failed")
+        with pytest.raises(ExperimentFailed) as x:
+            await backend.process_job(job)
+        assert str(x.value) == "Experiment pod failed (unknown)"
+
+        # the operator never ran the experiment
+        create_custom_object.side_effect = None
+        with pytest.raises(ExperimentFailed) as x:
+            await backend.process_job(job)
+        assert str(x.value) == "Experiment did not complete within 0.2s"
+        assert backend.watch.in_flight == {}
+        # reaped once the retention period is over
+        assert list(backend.reaper.finished) == [str(job.id)]
+
+        await backend.cleanup()
         del os.environ["KUBECONFIG"]
 
 
+@pytest.fixture
+async def api_server(tmp_path, monkeypatch, pods_watch):
+    """
+    Local API server answering after 0.2s, like a busy or remote one.
+    """
+    server = FakeApiServer(pods_watch, latency=0.2)
+    url = await server.start()
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_bytes(BASIC_CONFIG.replace(
+        b"server: https://example.com", f"server: {url}".encode()))
+    monkeypatch.setenv("KUBECONFIG", str(kubeconfig))
+    yield server
+    await server.stop()
+
+
+@pytest.mark.asyncio
+async def test_submit_secret_and_experiment_together(
+        config_path: str, job: Job, api_server, experiments_watch):
+    config = load_settings(config_path)
+    config.agent_backend = "kubernetes"
+    backend = K8SBackend(config)
+    await backend.setup()
+    await asyncio.sleep(0.05)
+    loop = asyncio.get_running_loop()
+
+    start = loop.time()
+    await backend.process_job(job)
+    elapsed = loop.time() - start
+
+    (kind, start, end), (other_kind, other_start, other_end) = \
+        api_server.requests
+    assert {kind, other_kind} == {"secrets", "experiments"}
+    # both requests were in flight at the same time
+    assert max(start, other_start) < min(end, other_end)
+    # rather than 0.4s one after the other
+    assert elapsed < 0.35
+
+    # the next jobs of the team only create their experiment
+    start = loop.time()
+    await backend.process_job(job.copy(update={"id": uuid.uuid4()}))
+    elapsed = loop.time() - start
+    assert [r[0] for r in api_server.requests[2:]] == ["experiments"]
+    assert elapsed < 0.35
+    assert sum(backend.settings.users.values()) == 0
+
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_process_job_fails_when_submission_fails(
+        capsys, config_path: str, job: Job, api_server, experiments_watch):
+    config = load_settings(config_path)
+    configure_logging(config)
+    config.agent_backend = "kubernetes"
+    backend = K8SBackend(config)
+    await backend.setup()
+    await asyncio.sleep(0.05)
+
+    api_server.failures = {"secrets": 500}
+    with pytest.raises(ApiException):
+        await backend.process_job(job)
+    captured = capsys.readouterr()
+    assert "Cannot create the secret on K8s" in captured.err
+    assert backend.settings.created == {}
+    # the experiment was withdrawn, its pod cannot start with the secret
+    # of the next job
+    assert api_server.experiments == set()
+    assert f"Experiment of job '{job.id}' withdrawn" in captured.err
+
+    api_server.failures = {"experiments": 500}
+    with pytest.raises(ApiException):
+        await backend.process_job(job)
+    assert "Cannot create the experiment on K8s" in capsys.readouterr().err
+    # the secret was created and is kept for the next jobs
+    assert len(backend.settings.created) == 1
+    assert "withdrawn" not in capsys.readouterr().err
+    assert sum(backend.settings.users.values()) == 0
+    assert backend.watch.in_flight == {}
+
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_withdraw_experiment(capsys, config_path: str, job: Job,
+                                   api_server, experiments_watch):
+    config = load_settings(config_path)
+    configure_logging(config)
+    config.agent_backend = "kubernetes"
+    backend = K8SBackend(config)
+    await backend.setup()
+
+    # still being created, it may be created nonetheless
+    creating = asyncio.ensure_future(asyncio.sleep(10))
+    await backend.withdraw_experiment(job, creating)
+    assert creating.cancelled()
+
+    api_server.failures = {"deletions": 500}
+    creating = asyncio.ensure_future(asyncio.sleep(10))
+    await backend.withdraw_experiment(job, creating)
+    captured = capsys.readouterr()
+    assert f"Failed to delete experiment of job '{job.id}'" in captured.err
+
+    await backend.cleanup()
+
+
 def test_render_experiment_manifest(job):
-    manifest = render_experiment_manifest(job=job)
-    assert manifest not in [None, '']
+    manifest = render_experiment_manifest(
+        job=job, settings_name="my-settings", ctk_docker_image="ctk:latest")
+
+    assert manifest["metadata"]["name"] == str(job.id)
+    assert manifest["metadata"]["labels"] == {
+        "job": str(job.id), "type": job.target_type}
+    pod = manifest["spec"]["pod"]
+    assert pod["image"] == "ctk:latest"
+    assert pod["chaosArgs"] == ["run", job.target_url]
+    assert pod["settings"]["secretName"] == "my-settings"
+
+    manifest = render_experiment_manifest(job=job, verify_tls=False)
+    pod = manifest["spec"]["pod"]
+    assert pod["chaosArgs"] == ["run", job.target_url, "--no-verify-tls"]
 
-    # ensure yaml is valid
-    try:
-        yaml.safe_load(manifest)
-    except yaml.YAMLError:
-        pytest.fail("manifest YAML is not valid")
+    # each job gets its own manifest
+    assert render_experiment_manifest(job=job)["spec"]["pod"]["chaosArgs"] \
+        == ["run", job.target_url]
 
-    # ensure all fields have been replaced
-    assert '{' not in manifest
-    assert '}' not in manifest
+
+def test_render_verification_manifest(verification):
+    manifest = render_experiment_manifest(job=verification)
+    pod = manifest["spec"]["pod"]
+    assert pod["chaosArgs"] == ["verify", verification.target_url]
 
 
 DUMMY_SETTINGS = """
@@ -194,18 +374,134 @@ controls:
 
 
 def test_render_secret_manifest():
-    manifest = render_secret_manifest(settings=DUMMY_SETTINGS)
-    assert manifest not in [None, '']
-
-    # ensure yaml is valid
-    try:
-        yaml.safe_load(manifest)
-    except yaml.YAMLError as exc:
-        pytest.fail("manifest YAML is not valid")
-
-    # ensure all fields have been replaced
-    assert '{' not in manifest
-    assert '}' not in manifest
+    manifest = render_secret_manifest(
+        settings=DUMMY_SETTINGS, settings_name="my-settings",
+        labels={"job": "1234", "type": "experiment"})
+
+    assert manifest["kind"] == "Secret"
+    assert manifest["metadata"]["name"] == "my-settings"
+    assert manifest["metadata"]["labels"] == {
+        "job": "1234", "type": "experiment"}
+    assert manifest["stringData"]["settings.yaml"] == DUMMY_SETTINGS
+    assert yaml.safe_load(manifest["stringData"]["settings.yaml"]) == \
+        yaml.safe_load(DUMMY_SETTINGS)
+
+
+# manifests templates as they were formatted, then parsed, for every job
+LEGACY_EXPERIMENT_TEMPLATE = """---
+apiVersion: chaostoolkit.org/v1
+kind: ChaosToolkitExperiment
+metadata:
+  name: {name}
+  namespace: chaostoolkit-crd
+  labels:
+    job: {job_id}
+    type: {job_type}
+spec:
+  namespace: chaostoolkit-run
+  pod:
+    image: {ctk_docker_image}
+    chaosArgs:
+    - {chaos_cmd}
+    - {asset_url}
+    {no_verify_tls}
+    settings:
+      enabled: true
+      secretName: {settings_name}
+    experiment:
+      asFile: false
+"""
+
+LEGACY_SECRET_TEMPLATE = """---
+apiVersion: v1
+kind: Secret
+metadata:
+  name: {settings_name}
+  namespace: chaostoolkit-run
+  labels:
+    job: {job_id}
+    type: {job_type}
+type: Opaque
+stringData:
+  settings.yaml: |-
+{settings}
+"""
+
+
+def legacy_render(config, job, templates_dir):
+    """
+    Rendering of the manifests of a job before templates were cached and
+    manifests built as dictionaries.
+    """
+    with open(SETTINGS_PATH) as f:
+        settings = f.read().format(
+            token=job.access_token, org_id=job.org_id, team_id=job.team_id,
+            console_hostname="console.example.com",
+            console_url="https://console.example.com", verify_tls="true")
+
+    settings_name = f"settings-{job.id}"
+    with open(os.path.join(templates_dir, "secret.yaml")) as f:
+        indented = os.linesep.join(
+            f"    {line}" for line in settings.split(os.linesep))
+        secret = f.read().format(
+            settings=indented, settings_name=settings_name,
+            job_id=job.id, job_type=job.target_type)
+    with open(os.path.join(templates_dir, "experiment.yaml")) as f:
+        experiment = f.read().format(
+            name=job.id, chaos_cmd="run", asset_url=job.target_url,
+            no_verify_tls="", settings_name=settings_name,
+            ctk_docker_image=config.ctk_docker_image,
+            job_id=job.id, job_type=job.target_type)
+    return yaml.safe_load(secret), yaml.safe_load(experiment)
+
+
+def render(config, job):
+    settings = get_chaostoolkit_settings(
+        config, job.access_token, org_id=job.org_id, team_id=job.team_id)
+    settings_name = f"settings-{job.id}"
+    secret = render_secret_manifest(
+        settings, settings_name=settings_name,
+        labels=get_k8s_labels_for_job(job))
+    experiment = render_experiment_manifest(
+        job, settings_name=settings_name,
+        ctk_docker_image=config.ctk_docker_image)
+    return secret, experiment
+
+
+@pytest.fixture
+def legacy_templates(tmp_path) -> str:
+    (tmp_path / "secret.yaml").write_text(LEGACY_SECRET_TEMPLATE)
+    (tmp_path / "experiment.yaml").write_text(LEGACY_EXPERIMENT_TEMPLATE)
+    return str(tmp_path)
+
+
+def test_manifests_are_unchanged(config, job, legacy_templates):
+    legacy_secret, legacy_experiment = legacy_render(
+        config, job, legacy_templates)
+    secret, experiment = render(config, job)
+
+    assert experiment == legacy_experiment
+    assert secret["metadata"] == legacy_secret["metadata"]
+    assert yaml.safe_load(secret["stringData"]["settings.yaml"]) == \
+        yaml.safe_load(legacy_secret["stringData"]["settings.yaml"])
+
+
+def test_render_cost_per_job(config, legacy_templates):
+    """
+    Micro-benchmark of the rendering of a job's manifests, before and after
+    templates were cached and manifests built as dictionaries.
+    """
+    jobs = [create_job() for _ in range(200)]
+
+    def measure(fn, *args) -> float:
+        start = time.perf_counter()
+        for job in jobs:
+            fn(config, job, *args)
+        return (time.perf_counter() - start) / len(jobs)
+
+    before = measure(legacy_render, legacy_templates)
+    after = measure(render)
+    assert after < before
 
 
 @pytest.mark.asyncio
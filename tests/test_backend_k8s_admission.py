@@ -0,0 +1,150 @@
+# type: ignore
+import asyncio
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from kubernetes_asyncio.client.api import core_v1_api
+from kubernetes_asyncio.client.rest import ApiException
+
+from chaosiqagent.backend.k8s_admission import Admission, ClusterSaturated, \
+    parse_quantity
+from chaosiqagent.backend.k8s_watch import ExperimentsWatch
+from chaosiqagent.log import configure_logging
+from chaosiqagent.settings import load_settings
+
+from fixtures.job import create_job
+from fixtures.k8s import pod_event
+
+
+def quota(hard, used):
+    return SimpleNamespace(status=SimpleNamespace(hard=hard, used=used))
+
+
+@pytest.fixture
+def read_quota():
+    with patch.object(
+            core_v1_api.CoreV1Api, "read_namespaced_resource_quota",
+            new_callable=AsyncMock) as read:
+        yield read
+
+
+def test_parse_quantity():
+    assert parse_quantity("10") == 10
+    assert parse_quantity("500m") == Decimal("0.5")
+    assert parse_quantity("2Gi") == 2 * 1024 ** 3
+    assert parse_quantity("1k") == 1000
+    assert parse_quantity("1e3") == 1000
+
+
+@pytest.mark.asyncio
+async def test_hold_jobs_while_too_many_experiments(
+        capsys, config_path: str, experiments_watch, pods_watch):
+    config = load_settings(config_path)
+    configure_logging(config)
+    config.k8s_max_experiments = 2
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        async with Admission(config, MagicMock(), w) as a:
+            await asyncio.sleep(0.05)
+            # run by a previous run of the agent, or by another one
+            pods_watch.push("ADDED", pod_event("a", "Running"))
+            await asyncio.sleep(0.05)
+            job = create_job()
+            await a.admit(job)
+            w.track(job)
+            assert a.experiments == 2
+            assert a.saturation() == "2 experiments out of 2"
+
+            held = create_job()
+            admitted = asyncio.ensure_future(a.admit(held))
+            await asyncio.sleep(0.05)
+            assert not admitted.done()
+
+            # still pending
+            pods_watch.push("ADDED", pod_event(str(job.id), "Pending"))
+            await asyncio.sleep(0.05)
+            assert not admitted.done()
+
+            pods_watch.push("MODIFIED", pod_event("a", "Succeeded"))
+            await asyncio.wait_for(admitted, 1)
+            w.track(held)
+            assert a.experiments == 2
+
+            w.forget(job)
+            pods_watch.push("DELETED", pod_event(str(job.id), "Running"))
+            await asyncio.sleep(0.05)
+            assert a.experiments == 1
+            assert a.stats == {
+                "experiments": 1, "exhausted": [], "held": 1, "declined": 0}
+
+    captured = capsys.readouterr()
+    assert f"Holding job '{held.id}', cluster is saturated: 2 experiments " \
+        f"out of 2" in captured.err
+    assert f"Admitting job '{held.id}'" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_decline_jobs_when_saturated(config_path: str, experiments_watch,
+                                           pods_watch):
+    config = load_settings(config_path)
+    config.k8s_max_experiments = 1
+    config.k8s_saturation_policy = "decline"
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        async with Admission(config, MagicMock(), w) as a:
+            w.track(create_job())
+            with pytest.raises(ClusterSaturated) as x:
+                await a.admit(create_job())
+            assert a.declined == 1
+
+    assert str(x.value) == "Cluster is saturated: 1 experiments out of 1"
+
+
+@pytest.mark.asyncio
+async def test_no_limit_by_default(config, experiments_watch, pods_watch):
+    async with ExperimentsWatch(MagicMock()) as w:
+        async with Admission(config, MagicMock(), w) as a:
+            for _ in range(100):
+                job = create_job()
+                await a.admit(job)
+                w.track(job)
+            assert a.experiments == 100
+            assert a.saturation() is None
+
+
+@pytest.mark.asyncio
+async def test_hold_jobs_while_quota_used_up(capsys, config_path: str, read_quota,
+                                             experiments_watch, pods_watch):
+    config = load_settings(config_path)
+    configure_logging(config)
+    config.k8s_resource_quota = "chaos"
+    config.k8s_quota_interval = 0.05
+    read_quota.side_effect = [
+        quota({"pods": "2", "limits.cpu": "1"},
+              {"pods": "2", "limits.cpu": "500m"}),
+        ApiException(status=403, reason="Forbidden"),
+        asyncio.TimeoutError(),
+        quota({"pods": "2", "requests.memory": "1Gi"}, {"pods": "1"}),
+    ] + [quota({"pods": "2"}, {"pods": "1"})] * 100
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        async with Admission(config, MagicMock(), w) as a:
+            assert a.running is True
+            await asyncio.sleep(0.01)
+            assert a.exhausted == ["pods"]
+            assert a.saturation() == \
+                "'chaos' resource quota used up (pods)"
+
+            job = create_job()
+            await asyncio.wait_for(a.admit(job), 1)
+            assert a.exhausted == []
+
+    assert a.running is False
+    read_quota.assert_awaited_with("chaos", "chaostoolkit-run")
+    captured = capsys.readouterr()
+    assert "Failed to read the 'chaos' resource quota: 403 Forbidden" in \
+        captured.err
+    assert "Failed to read the 'chaos' resource quota: TimeoutError" in \
+        captured.err
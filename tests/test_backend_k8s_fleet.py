@@ -0,0 +1,132 @@
+# type: ignore
+import asyncio
+from typing import Dict
+
+import pytest
+
+from chaosiqagent.backend import get_backend
+from chaosiqagent.backend.k8s import K8SBackend
+from chaosiqagent.backend.k8s_fleet import K8SFleetBackend, \
+    get_eligible_clusters
+from chaosiqagent.settings import load_settings
+from chaosiqagent.types import Config, Job
+
+from fixtures.job import create_job
+
+FLEET_CONFIG = """
+apiVersion: v1
+kind: Config
+preferences: {}
+
+clusters:
+- cluster:
+    server: https://eu.example.com
+    insecure-skip-tls-verify: true
+  name: eu
+- cluster:
+    server: https://us.example.com
+    insecure-skip-tls-verify: true
+  name: us
+
+users:
+- name: developer
+  user:
+    password: dGVzdHBhc3MK
+    username: admin
+
+contexts:
+- context:
+    cluster: eu
+    user: developer
+  name: eu
+- context:
+    cluster: us
+    user: developer
+  name: us
+
+current-context: eu
+"""
+
+
+@pytest.fixture
+def fleet_config(config_path: str, tmp_path, monkeypatch) -> Config:
+    config = load_settings(config_path)
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_text(FLEET_CONFIG)
+    monkeypatch.setenv("KUBECONFIG", str(kubeconfig))
+    config.agent_backend = "kubernetes"
+    config.k8s_contexts = ["eu", "us"]
+    return config
+
+
+def test_get_fleet_backend(fleet_config: Config):
+    backend = get_backend(fleet_config)
+    assert isinstance(backend, K8SFleetBackend)
+    assert backend.name == "kubernetes"
+    assert list(backend.clusters) == ["eu", "us"]
+
+
+def test_eligible_clusters_from_job_hints():
+    contexts = ["eu", "us", "ap"]
+    assert get_eligible_clusters(create_job(), contexts) == contexts
+
+    job = create_job()
+    job.payload = {"k8s_clusters": "us"}
+    assert get_eligible_clusters(job, contexts) == ["us"]
+    job.payload = {"k8s_clusters": ["ap", "eu", "unknown"]}
+    assert get_eligible_clusters(job, contexts) == ["eu", "ap"]
+    job.payload = {"k8s_clusters": ["unknown"]}
+    assert get_eligible_clusters(job, contexts) == []
+
+
+@pytest.mark.asyncio
+async def test_load_each_context(fleet_config: Config, experiments_watch,
+                                 pods_watch):
+    backend = K8SFleetBackend(fleet_config)
+    await backend.setup()
+    assert backend.clusters["eu"].k8s_config.host == "https://eu.example.com"
+    assert backend.clusters["us"].k8s_config.host == "https://us.example.com"
+    # each cluster has its own client and watch
+    assert backend.clusters["eu"].k8s_client is not \
+        backend.clusters["us"].k8s_client
+    assert len(pods_watch.calls) == 2
+
+    await backend.cleanup()
+    assert backend.clusters["eu"].k8s_client is None
+
+
+@pytest.mark.asyncio
+async def test_place_jobs_on_least_loaded_cluster(fleet_config: Config,
+                                                  monkeypatch):
+    running: Dict[str, str] = {}
+    release = asyncio.Event()
+
+    async def process_job(cluster: K8SBackend, job: Job) -> None:
+        running[str(job.id)] = cluster.context
+        await release.wait()
+
+    monkeypatch.setattr(K8SBackend, "process_job", process_job)
+    backend = K8SFleetBackend(fleet_config)
+
+    jobs = [create_job() for _ in range(3)]
+    pinned = create_job()
+    pinned.payload = {"k8s_clusters": ["eu"]}
+    tasks = [
+        asyncio.ensure_future(backend.process_job(job))
+        for job in [*jobs, pinned]]
+    await asyncio.sleep(0.05)
+
+    assert [running[str(job.id)] for job in jobs] == [
+        "eu", "us", "eu"]
+    assert running[str(pinned.id)] == "eu"
+    assert backend.stats == {"in_flight": {"eu": 3, "us": 1}}
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert backend.in_flight == {"eu": 0, "us": 0}
+
+    pinned.payload = {"k8s_clusters": ["unknown"]}
+    with pytest.raises(ValueError) as x:
+        await backend.process_job(pinned)
+    assert str(x.value) == \
+        "None of the Kubernetes contexts eu, us is eligible for the job"
@@ -0,0 +1,157 @@
+# type: ignore
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import aiohttp
+import pytest
+from kubernetes_asyncio.client.rest import ApiException
+
+from chaosiqagent.backend.k8s_reaper import Reaper
+from chaosiqagent.backend.k8s_watch import ExperimentsWatch
+from chaosiqagent.log import configure_logging
+from chaosiqagent.settings import load_settings
+
+from fixtures.k8s import pod_event
+
+
+def fake_client() -> MagicMock:
+    """
+    Client whose `deletecollection` calls delete one object per job.
+    """
+    async def call_api(path, method, query_params, **kwargs):
+        selector = dict(query_params)["labelSelector"]
+        jobs = selector[len("job in ("):-1].split(",")
+        return {"items": [{"metadata": {"labels": {"job": j}}} for j in jobs]}
+
+    client = MagicMock()
+    client.call_api = AsyncMock(side_effect=call_api)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_reap_finished_jobs_by_batch(config_path: str):
+    config = load_settings(config_path)
+    config.k8s_retention = 0.1
+    config.k8s_reaper_interval = 0.05
+    config.k8s_reaper_batch_size = 2
+    client = fake_client()
+
+    async with Reaper(config, client) as r:
+        assert r.running is True
+        for job_id in ("a", "b", "c"):
+            r.job_finished(job_id)
+        # reported again by the watch
+        r.job_finished("a")
+
+        await asyncio.sleep(0.08)
+        client.call_api.assert_not_awaited()
+
+        await asyncio.sleep(0.1)
+        assert r.finished == {}
+        assert r.reclaimed == 3
+
+    assert r.running is False
+    calls = client.call_api.call_args_list
+    assert len(calls) == 2
+    assert [c.args for c in calls] == [
+        ("/apis/{group}/{version}/namespaces/{namespace}/{plural}",
+         "DELETE"),
+    ] * 2
+    assert calls[0].kwargs["path_params"]["namespace"] == "chaostoolkit-crd"
+    assert calls[0].kwargs["query_params"] == [
+        ("labelSelector", "job in (a,b)")]
+    assert calls[1].kwargs["query_params"] == [
+        ("labelSelector", "job in (c)")]
+
+
+@pytest.mark.asyncio
+async def test_keep_jobs_until_their_retention_is_over(config_path: str):
+    config = load_settings(config_path)
+    config.k8s_retention = 60
+    config.k8s_reaper_interval = 0.02
+    client = fake_client()
+
+    async with Reaper(config, client) as r:
+        r.job_finished("a")
+        await asyncio.sleep(0.1)
+        assert list(r.finished) == ["a"]
+
+    client.call_api.assert_not_awaited()
+    assert r.reclaimed == 0
+
+
+@pytest.mark.asyncio
+async def test_retry_jobs_whose_objects_could_not_be_deleted(capsys, config_path: str):
+    config = load_settings(config_path)
+    configure_logging(config)
+    config.k8s_retention = 0.01
+    config.k8s_reaper_interval = 600
+    client = fake_client()
+    client.call_api.side_effect = [ApiException(status=500), None]
+
+    async with Reaper(config, client) as r:
+        r.job_finished("a")
+        await asyncio.sleep(0.02)
+        assert await r.collect() == 0
+        assert list(r.finished) == ["a"]
+
+        # nothing left to delete
+        assert await r.collect() == 0
+        assert r.finished == {}
+        assert await r.collect() == 0
+
+    assert client.call_api.await_count == 2
+    captured = capsys.readouterr()
+    assert "Failed to delete finished jobs objects: ApiException (500)" in \
+        captured.err
+    assert "Reclaimed 0 Kubernetes objects of 1 finished jobs" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_keep_reaping_after_connection_errors(capsys,
+                                                    config_path: str):
+    config = load_settings(config_path)
+    configure_logging(config)
+    config.k8s_retention = 0.01
+    config.k8s_reaper_interval = 0.05
+    client = fake_client()
+    reply = client.call_api.side_effect
+    errors = [
+        aiohttp.ClientConnectionError("connection reset"),
+        asyncio.TimeoutError()]
+
+    async def call_api(*args, **kwargs):
+        if errors:
+            raise errors.pop(0)
+        return await reply(*args, **kwargs)
+
+    client.call_api.side_effect = call_api
+
+    async with Reaper(config, client) as r:
+        r.job_finished("a")
+        await asyncio.sleep(0.3)
+        assert r.finished == {}
+
+    captured = capsys.readouterr()
+    assert "Failed to delete finished jobs objects: ClientConnectionError " \
+        "connection reset" in captured.err
+    assert "Failed to delete finished jobs objects: TimeoutError" in \
+        captured.err
+    assert "Reclaimed 1 Kubernetes objects of 1 finished jobs" in \
+        captured.err
+
+
+@pytest.mark.asyncio
+async def test_watch_reports_finished_jobs(experiments_watch, pods_watch):
+    finished = []
+
+    async with ExperimentsWatch(MagicMock(), finished.append):
+        await asyncio.sleep(0.05)
+        # the pods of previous runs are listed first
+        pods_watch.push("ADDED", pod_event("a", "Succeeded", version="1"))
+        pods_watch.push("ADDED", pod_event("b", "Running", version="2"))
+        pods_watch.push("MODIFIED", pod_event("b", "Failed", version="3"))
+        pods_watch.push("ADDED", pod_event("c", "Pending", version="4"))
+        await asyncio.sleep(0.05)
+
+    assert finished == ["a", "b"]
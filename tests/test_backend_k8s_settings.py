@@ -0,0 +1,206 @@
+# type: ignore
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from kubernetes_asyncio.client.api import core_v1_api
+from kubernetes_asyncio.client.models import V1ObjectMeta, V1Secret, \
+    V1SecretList
+from kubernetes_asyncio.client.rest import ApiException
+
+from chaosiqagent.backend.k8s_settings import SettingsSecrets, \
+    get_settings_secret_name
+from chaosiqagent.ctk import get_chaostoolkit_settings
+from chaosiqagent.log import configure_logging
+
+
+@pytest.fixture
+def create_secret():
+    with patch.object(
+            core_v1_api.CoreV1Api, "create_namespaced_secret",
+            new_callable=AsyncMock) as create:
+        yield create
+
+
+@pytest.fixture(autouse=True)
+def list_secrets():
+    with patch.object(
+            core_v1_api.CoreV1Api, "list_namespaced_secret",
+            new_callable=AsyncMock) as list_:
+        list_.return_value = V1SecretList(items=[])
+        yield list_
+
+
+def secret(name: str) -> V1Secret:
+    return V1Secret(metadata=V1ObjectMeta(name=name))
+
+
+@pytest.fixture
+def delete_secret():
+    with patch.object(
+            core_v1_api.CoreV1Api, "delete_namespaced_secret",
+            new_callable=AsyncMock) as delete:
+        yield delete
+
+
+def test_secret_name_is_the_settings_digest(config):
+    settings = get_chaostoolkit_settings(
+        config, "azerty1234", org_id="org", team_id="team")
+    name = get_settings_secret_name(settings, "agent")
+    assert name.startswith("settings-")
+    assert len(name) == 41
+    assert "azerty1234" not in name
+    assert name == get_settings_secret_name(settings, "agent")
+    assert name != get_settings_secret_name(
+        get_chaostoolkit_settings(
+            config, "qwerty1234", org_id="org", team_id="team"), "agent")
+    # agents sharing the namespace never share a secret
+    assert name != get_settings_secret_name(settings, "other")
+
+
+@pytest.mark.asyncio
+async def test_share_secret_of_the_same_team(config, create_secret,
+                                             delete_secret):
+    settings = get_chaostoolkit_settings(
+        config, "azerty1234", org_id="org", team_id="team")
+    secrets = SettingsSecrets(MagicMock())
+
+    names = await asyncio.gather(*[
+        secrets.acquire(settings, "agent", "org", "team") for _ in range(3)])
+    assert set(names) == {get_settings_secret_name(settings, "agent")}
+    create_secret.assert_awaited_once()
+    body = create_secret.call_args.kwargs["body"]
+    assert body["metadata"]["name"] == names[0]
+    assert body["metadata"]["labels"] == {"agent": "agent", "org": "org", "team": "team"}
+    assert body["stringData"]["settings.yaml"] == settings
+
+    for name in names:
+        await secrets.release(name)
+    # still current, kept for the next jobs
+    assert await secrets.acquire(settings, "agent", "org", "team") == names[0]
+    create_secret.assert_awaited_once()
+    delete_secret.assert_not_awaited()
+    assert secrets.stats == {"secrets": 1, "writes": 1, "reused": 3}
+
+
+@pytest.mark.asyncio
+async def test_rotate_secret_when_the_token_changes(capsys, config,
+                                                    create_secret,
+                                                    delete_secret):
+    configure_logging(config)
+    old = get_chaostoolkit_settings(
+        config, "azerty1234", org_id="org", team_id=None)
+    new = get_chaostoolkit_settings(
+        config, "qwerty1234", org_id="org", team_id=None)
+    secrets = SettingsSecrets(MagicMock())
+
+    old_name = await secrets.acquire(old, "agent", "org", None)
+    new_name = await secrets.acquire(new, "agent", "org", None)
+    assert old_name != new_name
+    assert create_secret.call_count == 2
+    assert create_secret.call_args.kwargs["body"]["metadata"]["labels"] == {
+        "agent": "agent", "org": "org", "team": ""}
+    # the previous secret is still used by a job
+    delete_secret.assert_not_awaited()
+
+    await secrets.release(old_name)
+    delete_secret.assert_awaited_once_with(old_name, "chaostoolkit-run")
+    await secrets.release(new_name)
+    delete_secret.assert_awaited_once()
+    assert list(secrets.created) == [new_name]
+
+    # deleted already
+    delete_secret.side_effect = ApiException(status=404)
+    await secrets.acquire(old, "agent", "org", None)
+    await secrets.acquire(new, "agent", "org", None)
+    assert delete_secret.call_count == 2
+
+    await secrets.release(new_name)
+    delete_secret.side_effect = ApiException(status=500)
+    await secrets.acquire(old, "agent", "org", None)
+    assert delete_secret.call_count == 3
+
+    captured = capsys.readouterr()
+    assert "Settings of organization 'org' and team '' changed" in \
+        captured.err
+    assert f"Failed to delete secret '{new_name}': (500)" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_reuse_secret_left_by_previous_run(config, create_secret):
+    create_secret.side_effect = ApiException(status=409)
+    settings = get_chaostoolkit_settings(
+        config, "azerty1234", org_id="org", team_id="team")
+    secrets = SettingsSecrets(MagicMock())
+
+    assert await secrets.acquire(settings, "agent", "org", "team") == \
+        get_settings_secret_name(settings, "agent")
+
+
+@pytest.mark.asyncio
+async def test_create_secret_again_after_failure(config, create_secret,
+                                                 delete_secret):
+    create_secret.side_effect = [ApiException(status=500), None]
+    settings = get_chaostoolkit_settings(
+        config, "azerty1234", org_id="org", team_id="team")
+    secrets = SettingsSecrets(MagicMock())
+
+    with pytest.raises(ApiException):
+        await secrets.acquire(settings, "agent", "org", "team")
+    assert secrets.created == {}
+
+    await secrets.acquire(settings, "agent", "org", "team")
+    assert create_secret.call_count == 2
+
+    # the token changed after the secret failed to be created
+    create_secret.side_effect = [ApiException(status=500), None]
+    other = get_chaostoolkit_settings(
+        config, "qwerty1234", org_id="org", team_id="other")
+    with pytest.raises(ApiException):
+        await secrets.acquire(other, "agent", "org", "other")
+    await secrets.acquire(settings, "agent", "org", "other")
+    delete_secret.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_delete_secrets_left_by_previous_run(
+        capsys, config, create_secret, delete_secret, list_secrets):
+    configure_logging(config)
+    settings = get_chaostoolkit_settings(
+        config, "azerty1234", org_id="org", team_id="team")
+    name = get_settings_secret_name(settings, "agent")
+    list_secrets.return_value = V1SecretList(items=[
+        secret(name), secret("settings-old"), secret("settings-older"),
+        secret("other")])
+    delete_secret.side_effect = [None, ApiException(status=404)]
+    secrets = SettingsSecrets(MagicMock())
+
+    await secrets.acquire(settings, "agent", "org", "team")
+    await asyncio.sleep(0.01)
+    list_secrets.assert_awaited_once_with(
+        "chaostoolkit-run", label_selector="agent=agent,org=org,team=team")
+    assert [c.args for c in delete_secret.call_args_list] == [
+        ("settings-old", "chaostoolkit-run"),
+        ("settings-older", "chaostoolkit-run")]
+
+    # only once per team
+    await secrets.acquire(settings, "agent", "org", "team")
+    await asyncio.sleep(0.01)
+    list_secrets.assert_awaited_once()
+
+    delete_secret.side_effect = ApiException(status=500)
+    await secrets.acquire(settings, "agent", "org", "other")
+    await asyncio.sleep(0.01)
+    list_secrets.side_effect = ApiException(status=503)
+    await secrets.acquire(settings, "agent", "org", "another")
+    await asyncio.sleep(0.01)
+    await secrets.acquire(settings, "agent", "org", "last")
+    await secrets.cleanup()
+    assert not secrets.sweeps
+
+    captured = capsys.readouterr()
+    assert "Deleting secret 'settings-old' left by a previous run" in \
+        captured.err
+    assert "Failed to delete secret 'settings-old': (500)" in captured.err
+    assert "Failed to list the secrets of organization 'org' and team " \
+        "'another': (503)" in captured.err
@@ -0,0 +1,235 @@
+# type: ignore
+import asyncio
+from unittest.mock import MagicMock
+
+import aiohttp
+import pytest
+
+from chaosiqagent.backend.k8s_watch import ExperimentFailed, \
+    ExperimentsWatch, WatchForbidden
+from chaosiqagent.log import configure_logging
+
+from fixtures.job import create_job
+from fixtures.k8s import FakeWatchResponse, pod_event
+
+
+def experiment_event(job_id: str, version: str = "1"):
+    return {
+        "metadata": {
+            "name": job_id,
+            "resourceVersion": version,
+            "labels": {"job": job_id, "type": "experiment"},
+        },
+    }
+
+
+@pytest.mark.asyncio
+async def test_complete_jobs_when_their_pod_succeeds(experiments_watch, pods_watch):
+    job, other = create_job(), create_job()
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        assert w.running is True
+        completed = w.track(job)
+        await asyncio.sleep(0.05)
+
+        pods_watch.push("ADDED", pod_event(str(job.id), "Pending", version="10"))
+        pods_watch.push("MODIFIED", pod_event(str(job.id), "Running", version="11"))
+        # pods of jobs we do not track are ignored
+        pods_watch.push("MODIFIED", pod_event(str(other.id), "Failed", version="12"))
+        await asyncio.sleep(0.05)
+        assert not completed.done()
+
+        pods_watch.push(
+            "MODIFIED", pod_event(str(job.id), "Succeeded", version="13"))
+        await asyncio.wait_for(completed, 1)
+        assert w.resource_versions["pods"] == "13"
+
+        # the pod may be reported again
+        pods_watch.push(
+            "MODIFIED", pod_event(str(job.id), "Succeeded", version="14"))
+        await asyncio.sleep(0.05)
+        w.forget(job)
+        assert w.in_flight == {}
+
+    assert w.running is False
+    assert pods_watch.calls[0]["label_selector"] == "job,type"
+    assert pods_watch.calls[0]["allow_watch_bookmarks"] is True
+    assert experiments_watch.calls[0]["label_selector"] == "job,type"
+
+
+@pytest.mark.asyncio
+async def test_fail_jobs_when_their_experiment_fails(experiments_watch, pods_watch):
+    jobs = [create_job() for _ in range(5)]
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        futures = [w.track(job) for job in jobs]
+        await asyncio.sleep(0.05)
+
+        ids = [str(job.id) for job in jobs]
+        pods_watch.push("MODIFIED", pod_event(
+            ids[0], "Failed", containerStatuses=[
+                {"state": {"terminated": {"exitCode": 1}}}]))
+        pods_watch.push("MODIFIED", pod_event(ids[1], "Failed", reason="Evicted"))
+        pods_watch.push("MODIFIED", pod_event(ids[2], "Failed"))
+        pods_watch.push("DELETED", pod_event(ids[3], "Running"))
+        experiments_watch.push("DELETED", experiment_event(ids[4]))
+        # other changes of the experiments do not matter
+        experiments_watch.push("MODIFIED", experiment_event(ids[0]))
+
+        results = await asyncio.wait_for(
+            asyncio.gather(*futures, return_exceptions=True), 1)
+
+    assert all(isinstance(r, ExperimentFailed) for r in results)
+    assert [str(r) for r in results] == [
+        "Experiment pod failed (exit code 1)",
+        "Experiment pod failed (Evicted)",
+        "Experiment pod failed (unknown)",
+        "Experiment pod was deleted before it completed",
+        "Experiment was deleted before it completed",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_one_watch_for_all_jobs(experiments_watch, pods_watch):
+    jobs = [create_job() for _ in range(100)]
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        futures = [w.track(job) for job in jobs]
+        await asyncio.sleep(0.05)
+        for i, job in enumerate(jobs):
+            pods_watch.push("MODIFIED", pod_event(
+                str(job.id), "Succeeded", version=str(i)))
+        await asyncio.wait_for(asyncio.gather(*futures), 1)
+
+        assert w.connections == {"experiments": 1, "pods": 1}
+
+
+@pytest.mark.asyncio
+async def test_resume_watch_from_last_version(experiments_watch, pods_watch):
+    async with ExperimentsWatch(MagicMock()) as w:
+        await asyncio.sleep(0.05)
+        pods_watch.push("ADDED", pod_event("1234", "Running", version="20"))
+        pods_watch.push("BOOKMARK", {"metadata": {"resourceVersion": "25"}})
+        pods_watch.current.push_line("")
+        first = pods_watch.current
+        first.close()
+        await asyncio.sleep(0.05)
+
+        assert first.released
+        assert w.connections["pods"] == 2
+        assert "resource_version" not in pods_watch.calls[0]
+        assert pods_watch.calls[1]["resource_version"] == "25"
+
+
+@pytest.mark.asyncio
+async def test_watch_again_from_scratch_when_expired(capsys, config,
+                                                     experiments_watch, pods_watch):
+    configure_logging(config)
+    pods_watch.scripted.append(FakeWatchResponse(status=410))
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        await asyncio.sleep(0.05)
+        pods_watch.push("ADDED", pod_event("1234", "Running", version="30"))
+        await asyncio.sleep(0.05)
+        assert w.active == {"1234"}
+        pods_watch.push("ERROR", {"code": 410, "message": "too old"})
+        await asyncio.sleep(0.05)
+
+        # pods are listed again from scratch
+        assert w.active == set()
+        assert w.connections["pods"] == 3
+        assert "resource_version" not in pods_watch.calls[2]
+        assert w.resource_versions["pods"] is None
+
+    captured = capsys.readouterr()
+    assert "Watch of pods expired" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_back_off_when_watch_fails(capsys, config, experiments_watch, pods_watch):
+    configure_logging(config)
+    experiments_watch.scripted.append(FakeWatchResponse(status=500))
+    pods_watch.scripted.append(aiohttp.ClientConnectionError("connection reset"))
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        await asyncio.sleep(0.1)
+        assert w.connections == {"experiments": 1, "pods": 1}
+        await asyncio.sleep(0.4)
+        assert w.connections == {"experiments": 2, "pods": 2}
+
+        experiments_watch.push("ERROR", {"code": 500, "message": "internal"})
+        await asyncio.sleep(0.1)
+        assert w.connections["experiments"] == 2
+
+    captured = capsys.readouterr()
+    assert "Failed to watch experiments: watch failed" in captured.err
+    assert "Watch of pods interrupted: connection reset" in captured.err
+    assert "Failed to watch experiments: internal" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_fail_setup_when_not_allowed_to_watch(
+        capsys, config, experiments_watch, pods_watch):
+    configure_logging(config)
+    pods_watch.scripted.append(FakeWatchResponse(status=403))
+
+    w = ExperimentsWatch(MagicMock())
+    with pytest.raises(WatchForbidden) as x:
+        await w.setup()
+    assert str(x.value) == "Not allowed to watch pods, the agent's role " \
+        "must grant get, list and watch on them: watch failed"
+    assert w.running is False
+    assert w.sched.closed
+
+    captured = capsys.readouterr()
+    assert "CRITICAL chaosiqagent Not allowed to watch pods" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_report_loudly_when_no_longer_allowed_to_watch(
+        capsys, config, experiments_watch, pods_watch):
+    configure_logging(config)
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        experiments_watch.push("ERROR", {"code": 403, "message": "denied"})
+        await asyncio.sleep(0.1)
+        assert w.running is True
+
+    captured = capsys.readouterr()
+    assert "Not allowed to watch experiments, the agent's role must grant " \
+        "get, list and watch on them: denied" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_watch_again_when_an_event_cannot_be_handled(
+        capsys, config, experiments_watch, pods_watch):
+    configure_logging(config)
+
+    async with ExperimentsWatch(MagicMock()) as w:
+        await asyncio.sleep(0.05)
+        pods_watch.push("ADDED", pod_event("1234", "Running", version="30"))
+        await asyncio.sleep(0.05)
+        assert w.active == {"1234"}
+        pods_watch.current.push_line('{"type": "MODIFIED", "obj')
+        await asyncio.sleep(0.5)
+
+        # the watch carries on, from scratch
+        assert w.active == set()
+        assert w.connections["pods"] == 2
+        assert "resource_version" not in pods_watch.calls[1]
+
+    captured = capsys.readouterr()
+    assert "Watch of pods failed, watching again from scratch" in \
+        captured.err
+    assert "JSONDecodeError" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_cancel_jobs_still_waiting(experiments_watch, pods_watch):
+    w = ExperimentsWatch(MagicMock())
+    await w.setup()
+    completed = w.track(create_job())
+    await w.cleanup()
+
+    assert completed.cancelled()
+    assert w.in_flight == {}
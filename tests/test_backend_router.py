@@ -0,0 +1,191 @@
+# type: ignore
+import asyncio
+from typing import List
+
+import pytest
+
+from chaosiqagent.backend import get_backend
+from chaosiqagent.backend.base import NullBackend
+from chaosiqagent.backend.router import BackendSaturated, RouterBackend, \
+    match_route
+from chaosiqagent.backend.shell import ShellBackend
+from chaosiqagent.client import ChaosIQClient
+from chaosiqagent.job import Jobs
+from chaosiqagent.log import configure_logging
+from chaosiqagent.metrics import JOB_DURATION
+from chaosiqagent.settings import load_settings
+from chaosiqagent.types import Capacity, Config, Job, Route
+
+from fixtures.backend import BlockingBackend
+from fixtures.job import create_job
+
+
+@pytest.fixture
+def router_config(config_path: str) -> Config:
+    config = load_settings(config_path)
+    config.agent_backend = "router"
+    config.router_routes = [
+        Route(backend="shell", target_type="verification"),
+        Route(backend="null", payload={"runner": "null"}),
+        Route(backend="shell"),
+    ]
+    config.router_capacities = {
+        "shell": Capacity(limit=1, queue=1),
+        "null": Capacity(limit=2, queue=0),
+    }
+    return config
+
+
+def test_get_router_backend(router_config: Config):
+    backend = get_backend(router_config)
+    assert isinstance(backend, RouterBackend)
+    assert list(backend.lanes) == ["shell", "null"]
+    assert isinstance(backend.lanes["shell"].backend, ShellBackend)
+    assert backend.lanes["shell"].backend.name == "shell"
+    assert isinstance(backend.lanes["null"].backend, NullBackend)
+
+
+def test_cannot_route_to_itself(router_config: Config):
+    router_config.router_routes = [Route(backend="router")]
+    with pytest.raises(ValueError):
+        RouterBackend(router_config)
+
+
+def test_match_route():
+    job = create_job(target_type="verification")
+    job.payload = {"runner": "k8s", "zone": None}
+    assert match_route(Route(backend="shell"), job)
+    assert match_route(Route(backend="shell", target_type="verification"), job)
+    assert not match_route(
+        Route(backend="shell", target_type="experiment"), job)
+    assert match_route(Route(backend="shell", payload={"runner": "k8s"}), job)
+    assert match_route(Route(backend="shell", payload={"zone": None}), job)
+    assert not match_route(
+        Route(backend="shell", payload={"runner": "shell"}), job)
+    assert not match_route(Route(backend="shell", payload={"id": None}), job)
+
+
+@pytest.mark.asyncio
+async def test_route_jobs_with_separate_capacities(
+        capsys, router_config: Config, monkeypatch):
+    configure_logging(router_config)
+    running: List[str] = []
+    release = asyncio.Event()
+
+    async def process_job(backend, job: Job) -> None:
+        running.append(str(job.id))
+        await release.wait()
+
+    monkeypatch.setattr(ShellBackend, "process_job", process_job)
+    monkeypatch.setattr(NullBackend, "process_job", process_job)
+    backend = RouterBackend(router_config)
+    await backend.setup()
+
+    slow = [create_job() for _ in range(2)]
+    tasks = [asyncio.ensure_future(backend.process_job(j)) for j in slow]
+    await asyncio.sleep(0.05)
+    # the shell backend is busy and its queue is full
+    assert running == [str(slow[0].id)]
+    with pytest.raises(BackendSaturated) as x:
+        await backend.process_job(create_job(target_type="verification"))
+    assert str(x.value) == \
+        "Backend 'shell' is saturated: 1 jobs running and 1 waiting"
+
+    # which does not hold up the other backends
+    quick = create_job()
+    quick.payload = {"runner": "null"}
+    tasks.append(asyncio.ensure_future(backend.process_job(quick)))
+    await asyncio.sleep(0.05)
+    assert str(quick.id) in running
+    assert backend.stats == {
+        "shell": {"running": 1, "waiting": 1, "declined": 1},
+        "null": {"running": 1, "waiting": 0, "declined": 0},
+    }
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert running == [str(slow[0].id), str(quick.id), str(slow[1].id)]
+    assert backend.stats["shell"] == {
+        "running": 0, "waiting": 0, "declined": 1}
+    await backend.cleanup()
+
+    captured = capsys.readouterr()
+    assert "Routing jobs to backends shell, null, up to 4 at once" in \
+        captured.err
+    assert f"Routing job '{quick.id}' to backend 'null'" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_no_route_matches(router_config: Config):
+    router_config.router_routes = [
+        Route(backend="null", target_type="verification")]
+    backend = RouterBackend(router_config)
+    await backend.setup()
+    job = create_job()
+    with pytest.raises(ValueError) as x:
+        await backend.process_job(job)
+    assert str(x.value) == "No route matches the job"
+    assert backend.backend_name(job) == "router"
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_job_duration_by_routed_backend(
+        router_config: Config, client: ChaosIQClient):
+    job = create_job()
+    job.payload = {"runner": "null"}
+    backend = RouterBackend(router_config)
+    assert backend.backend_name(job) == "null"
+    assert NullBackend(router_config).backend_name(job) == "router"
+
+    observed = JOB_DURATION.count("null")
+    await backend.setup()
+    async with Jobs(router_config, backend, client) as j:
+        await j.start_job(job)
+        while JOB_DURATION.count("null") == observed:
+            await asyncio.sleep(0.01)
+    await backend.cleanup()
+    assert JOB_DURATION.count("router") == 0
+
+
+@pytest.mark.asyncio
+async def test_hand_back_jobs_declined_by_a_saturated_backend(
+        capsys, router_config: Config, client: ChaosIQClient):
+    configure_logging(router_config)
+    running, declined = create_job(), create_job()
+    for job in (running, declined):
+        job.payload = {"runner": "null"}
+    backend = RouterBackend(router_config)
+    blocking = backend.lanes["null"].backend = BlockingBackend(
+        router_config.copy(update={"agent_backend": "null"}))
+    backend.lanes["null"].capacity = Capacity(limit=1, queue=0)
+
+    await backend.setup()
+    async with Jobs(router_config, backend, client) as j:
+        for job in (running, declined):
+            j.seen.add(str(job.id))
+            await j.start_job(job)
+        while len(j.outbox.statuses) < 1:
+            await asyncio.sleep(0.01)
+
+        assert blocking.running == 1
+        assert j.outbox.statuses == [{
+            "id": str(declined.id), "status": "requeued",
+            "info": {"reason": "Backend 'null' is saturated: 1 jobs running "
+                               "and 0 waiting"}}]
+        # run when delivered again
+        assert str(declined.id) not in j.seen
+        assert JOB_DURATION.count("router") == 0
+        blocking.release.set()
+    await backend.cleanup()
+
+    captured = capsys.readouterr()
+    assert f"Handing job '{declined.id}' back to ChaosIQ: Backend 'null' " \
+        f"is saturated" in captured.err
+    assert "Failed to handle job" not in captured.err
+
+
+def test_capacity_of_the_backends(router_config: Config):
+    router_config.router_capacities = {"shell": Capacity(limit=3, queue=2)}
+    assert RouterBackend(router_config).capacity == 3 + 2 + 10 + 10
+    assert NullBackend(router_config).capacity is None
@@ -1,4 +1,8 @@
+import asyncio
 import json
+import subprocess
+import sys
+import time
 from tempfile import NamedTemporaryFile
 from unittest.mock import patch
 
@@ -6,10 +10,13 @@ import pytest
 import respx
 
 from chaosiqagent.agent import Agent
+from chaosiqagent.backend.shell import ShellBackend
 from chaosiqagent.log import configure_logging
 from chaosiqagent.settings import load_settings
 from chaosiqagent.types import Job
 
+from fixtures.job import create_job
+
 
 @pytest.mark.asyncio
 async def test_load_chaos_binary(capsys, config_path: str):
@@ -118,17 +125,17 @@ async def test_setup_chaos_binary_cannot_be_found(capsys, config_path: str):
 
 
 @pytest.mark.asyncio
-@patch("subprocess.run", autospec=True)
 async def test_process_job(
-        subprocess_run, config_path: str, job: Job):
+        capsys, chaos_binary: str, config_path: str, job: Job):
     with open(config_path) as o:
         with NamedTemporaryFile() as p:
             r = o.read()
             r = r.replace('AGENT_BACKEND="null"', 'AGENT_BACKEND="shell"')
-            r = r.replace('CHAOS_BINARY=', 'CHAOS_BINARY=chaos')
+            r = r.replace('CHAOS_BINARY=', f'CHAOS_BINARY={chaos_binary}')
             p.write(r.encode('utf-8'))
             p.seek(0)
             c = load_settings(p.name)
+            configure_logging(c)
 
     with patch("chaosiqagent.agent.Jobs", autospec=True):
         agent = Agent(c)
@@ -145,23 +152,25 @@ async def test_process_job(
             await agent.setup()
 
             await agent.backend.process_job(job)
-            subprocess_run.assert_called()
+            captured = capsys.readouterr()
+            assert f"[{job.id}] chaos --settings" in captured.err
+            assert f"[{job.id}] running on stderr" in captured.err
 
             await agent.cleanup()
 
 
 @pytest.mark.asyncio
-@patch("subprocess.run", autospec=True)
 async def test_process_experiment(
-        subprocess_run, config_path: str, experiment: Job):
+        capsys, chaos_binary: str, config_path: str, experiment: Job):
     with open(config_path) as o:
         with NamedTemporaryFile() as p:
             r = o.read()
             r = r.replace('AGENT_BACKEND="null"', 'AGENT_BACKEND="shell"')
-            r = r.replace('CHAOS_BINARY=', 'CHAOS_BINARY=chaos')
+            r = r.replace('CHAOS_BINARY=', f'CHAOS_BINARY={chaos_binary}')
             p.write(r.encode('utf-8'))
             p.seek(0)
             c = load_settings(p.name)
+            configure_logging(c)
 
     with patch("chaosiqagent.agent.Jobs", autospec=True):
         agent = Agent(c)
@@ -178,8 +187,7 @@ async def test_process_experiment(
             await agent.setup()
 
             await agent.backend.process_job(experiment)
-            subprocess_run.assert_called()
-            cmd = ' '.join(subprocess_run.call_args_list[0].args[0])
+            cmd = capsys.readouterr().err
             assert "chaos" in cmd
             assert "run" in cmd
             assert "--settings" in cmd
@@ -189,17 +197,17 @@ async def test_process_experiment(
 
 
 @pytest.mark.asyncio
-@patch("subprocess.run", autospec=True)
 async def test_process_verification(
-        subprocess_run, config_path: str, verification: Job):
+        capsys, chaos_binary: str, config_path: str, verification: Job):
     with open(config_path) as o:
         with NamedTemporaryFile() as p:
             r = o.read()
             r = r.replace('AGENT_BACKEND="null"', 'AGENT_BACKEND="shell"')
-            r = r.replace('CHAOS_BINARY=', 'CHAOS_BINARY=chaos')
+            r = r.replace('CHAOS_BINARY=', f'CHAOS_BINARY={chaos_binary}')
             p.write(r.encode('utf-8'))
             p.seek(0)
             c = load_settings(p.name)
+            configure_logging(c)
 
     with patch("chaosiqagent.agent.Jobs", autospec=True):
         agent = Agent(c)
@@ -216,8 +224,7 @@ async def test_process_verification(
             await agent.setup()
 
             await agent.backend.process_job(verification)
-            subprocess_run.assert_called()
-            cmd = ' '.join(subprocess_run.call_args_list[0].args[0])
+            cmd = capsys.readouterr().err
             assert "chaos" in cmd
             assert "verify" in cmd
             assert "--settings" in cmd
@@ -227,20 +234,20 @@ async def test_process_verification(
 
 
 @pytest.mark.asyncio
-@patch("subprocess.run", autospec=True)
 async def test_process_job_without_tls(
-        subprocess_run, config_path: str, verification: Job):
+        capsys, chaos_binary: str, config_path: str, verification: Job):
     # chaos binary supports an option for not checking TLS
     # when pushing its results to a local console server
     with open(config_path) as o:
         with NamedTemporaryFile() as p:
             r = o.read()
             r = r.replace('AGENT_BACKEND="null"', 'AGENT_BACKEND="shell"')
-            r = r.replace('CHAOS_BINARY=', 'CHAOS_BINARY=chaos')
+            r = r.replace('CHAOS_BINARY=', f'CHAOS_BINARY={chaos_binary}')
             r = r.replace('VERIFY_TLS=True', 'VERIFY_TLS=False')
             p.write(r.encode('utf-8'))
             p.seek(0)
             c = load_settings(p.name)
+            configure_logging(c)
 
     with patch("chaosiqagent.agent.Jobs", autospec=True):
         agent = Agent(c)
@@ -257,8 +264,113 @@ async def test_process_job_without_tls(
             await agent.setup()
 
             await agent.backend.process_job(verification)
-            subprocess_run.assert_called()
-            cmd = ' '.join(subprocess_run.call_args_list[0].args[0])
+            cmd = capsys.readouterr().err
             assert "--no-verify-tls" in cmd
 
             await agent.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_process_job_fails(monkeypatch, chaos_binary: str,
+                                 config_path: str, job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_EXIT", "2")
+    c = load_settings(config_path)
+    c.chaos_binary = chaos_binary
+    backend = ShellBackend(c)
+
+    with pytest.raises(subprocess.CalledProcessError) as x:
+        await backend.process_job(job)
+    assert x.value.returncode == 2
+
+
+@pytest.mark.asyncio
+async def test_process_jobs_without_blocking_the_loop(
+        monkeypatch, chaos_binary: str, config_path: str):
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "0.5")
+    c = load_settings(config_path)
+    c.chaos_binary = chaos_binary
+    backend = ShellBackend(c)
+
+    # stands for the heartbeat, it must keep ticking
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.05)
+
+    ticker = asyncio.ensure_future(tick())
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        backend.process_job(create_job()) for _ in range(10)])
+    elapsed = time.perf_counter() - start
+    ticker.cancel()
+
+    # experiments ran at once rather than one after the other
+    assert elapsed < 2
+    assert len(ticks) >= 8
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.25
+
+
+@pytest.mark.asyncio
+async def test_cancelled_job_kills_the_command(
+        monkeypatch, chaos_binary: str, config_path: str, job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "10")
+    c = load_settings(config_path)
+    c.chaos_binary = chaos_binary
+    backend = ShellBackend(c)
+
+    task = asyncio.ensure_future(backend.process_job(job))
+    await asyncio.sleep(0.3)
+    start = time.perf_counter()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert time.perf_counter() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_skip_output_lines_too_long(capsys, tmp_path, config_path: str,
+                                          job: Job):
+    chaos = tmp_path / "long-chaos"
+    chaos.write_text(
+        f"#!{sys.executable}\n"
+        "print('x' * 100000)\n"
+        "print('done')\n")
+    chaos.chmod(0o755)
+    c = load_settings(config_path)
+    configure_logging(c)
+    c.chaos_binary = str(chaos)
+    backend = ShellBackend(c)
+
+    await backend.process_job(job)
+    captured = capsys.readouterr()
+    assert f"[{job.id}] Skipped an output line too long" in captured.err
+    assert f"[{job.id}] done" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_failing_to_log_kills_the_command(
+        monkeypatch, chaos_binary: str, config_path: str, job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "10")
+    c = load_settings(config_path)
+    c.chaos_binary = chaos_binary
+    backend = ShellBackend(c)
+    processes = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def spawn(*args, **kwargs):
+        p = await create_subprocess_exec(*args, **kwargs)
+        processes.append(p)
+        return p
+
+    async def log_output(job, stream):
+        raise RuntimeError("cannot log")
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", spawn)
+    monkeypatch.setattr(backend, "log_output", log_output)
+    start = time.perf_counter()
+    with pytest.raises(RuntimeError):
+        await backend.process_job(job)
+    assert time.perf_counter() - start < 1
+    assert processes[0].returncode == -9
@@ -0,0 +1,330 @@
+# type: ignore
+import asyncio
+import subprocess
+import sys
+import time
+
+import pytest
+
+from chaosiqagent.backend.ctk_worker import settings_pipe
+from chaosiqagent.backend.shell import ShellBackend
+from chaosiqagent.backend.workers import WorkerPool, get_worker_python
+from chaosiqagent.log import configure_logging
+from chaosiqagent.settings import load_settings
+from chaosiqagent.types import Job
+
+from fixtures.job import create_job
+
+
+def make_config(config_path: str, ctk_binary: str, workers: int = 1):
+    c = load_settings(config_path)
+    configure_logging(c)
+    c.agent_backend = "shell"
+    c.chaos_binary = ctk_binary
+    c.chaos_workers = workers
+    return c
+
+
+def test_worker_python(config_path: str, ctk_binary: str,
+                       chaos_binary: str):
+    c = load_settings(config_path)
+
+    # interpreter of the chaos script
+    c.chaos_binary = ctk_binary
+    assert get_worker_python(c) == [sys.executable]
+
+    # chaos is not a Python script
+    c.chaos_binary = chaos_binary
+    assert get_worker_python(c) == [sys.executable]
+
+    c.chaos_worker_python = "/opt/ctk/bin/python -X dev"
+    assert get_worker_python(c) == ["/opt/ctk/bin/python", "-X", "dev"]
+
+
+def test_settings_pipe():
+    with settings_pipe(None) as options:
+        assert options == []
+
+    # larger than the pipe's buffer
+    settings = "auths: {}\n" * 10000
+    with settings_pipe(settings) as options:
+        assert options[0] == "--settings"
+        with open(options[1]) as f:
+            assert f.read() == settings
+
+    # left unread
+    with settings_pipe(settings) as options:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_run_jobs_in_warm_workers(capsys, config_path: str,
+                                        ctk_binary: str, job: Job):
+    c = make_config(config_path, ctk_binary, workers=2)
+
+    async with WorkerPool(c) as pool:
+        assert pool.running is True
+        assert pool.stats == {
+            "workers": 2, "idle": 2, "started": 2, "recycled": 0}
+
+        returncode = await pool.run(job, ["run", "experiment.json"])
+        assert returncode == 0
+        await asyncio.sleep(0.1)
+
+        # workers are reused
+        assert pool.stats["started"] == 2
+
+    assert pool.running is False
+    assert pool.workers == set()
+    captured = capsys.readouterr()
+    assert f"[{job.id}] chaos run experiment.json" in captured.err
+    # output of the worker while warming up
+    assert "] chaostoolkit loaded" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_report_exit_codes(monkeypatch, capsys, config_path: str,
+                                 ctk_binary: str, job: Job):
+    c = make_config(config_path, ctk_binary)
+
+    monkeypatch.setenv("FAKE_CHAOS_EXIT", "2")
+    async with WorkerPool(c) as pool:
+        assert await pool.run(job, ["run"]) == 2
+
+    monkeypatch.setenv("FAKE_CHAOS_EXIT", "deviated")
+    async with WorkerPool(c) as pool:
+        assert await pool.run(job, ["run"]) == 1
+
+    monkeypatch.delenv("FAKE_CHAOS_EXIT")
+    monkeypatch.setenv("FAKE_CHAOS_RAISE", "1")
+    async with WorkerPool(c) as pool:
+        assert await pool.run(job, ["run"]) == 1
+        await asyncio.sleep(0.1)
+
+    captured = capsys.readouterr()
+    assert "RuntimeError: experiment blew up" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_skip_output_lines_too_long(monkeypatch, capsys,
+                                          config_path: str, ctk_binary: str,
+                                          job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_LONG_LINE", "1")
+    c = make_config(config_path, ctk_binary)
+
+    async with WorkerPool(c) as pool:
+        assert await pool.run(job, ["run"]) == 0
+        await asyncio.sleep(0.1)
+
+    captured = capsys.readouterr()
+    assert f"[{job.id}] Skipped an output line too long" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_recycle_workers_after_max_jobs(capsys, config_path: str,
+                                              ctk_binary: str):
+    c = make_config(config_path, ctk_binary)
+    c.chaos_worker_max_jobs = 2
+
+    async with WorkerPool(c) as pool:
+        pids = set()
+        for _ in range(5):
+            pids.update(w.pid for w in pool.workers)
+            assert await pool.run(create_job(), ["run"]) == 0
+        await asyncio.sleep(0.5)
+        pids.update(w.pid for w in pool.workers)
+
+        assert pool.stats["recycled"] == 2
+        assert pool.stats["started"] == 3
+        assert len(pids) == 3
+
+    captured = capsys.readouterr()
+    assert "Recycling Chaos Toolkit worker" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_recycle_workers_past_max_rss(config_path: str,
+                                            ctk_binary: str):
+    c = make_config(config_path, ctk_binary)
+    c.chaos_worker_max_rss = 1
+
+    async with WorkerPool(c) as pool:
+        for _ in range(3):
+            assert await pool.run(create_job(), ["run"]) == 0
+
+        assert pool.stats["recycled"] == 3
+
+
+@pytest.mark.asyncio
+async def test_replace_crashed_workers(monkeypatch, capsys,
+                                       config_path: str, ctk_binary: str,
+                                       job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_CRASH", "1")
+    c = make_config(config_path, ctk_binary)
+
+    async with WorkerPool(c) as pool:
+        assert await pool.run(job, ["run"]) == 9
+        await asyncio.sleep(0.5)
+        assert pool.stats == {
+            "workers": 1, "idle": 1, "started": 2, "recycled": 1}
+
+    captured = capsys.readouterr()
+    assert "died while running job" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_replace_workers_that_died_while_idle(
+        config_path: str, ctk_binary: str, job: Job):
+    c = make_config(config_path, ctk_binary)
+
+    async with WorkerPool(c) as pool:
+        worker = next(iter(pool.workers))
+        worker.proc.kill()
+        await worker.proc.wait()
+        await asyncio.sleep(0.1)
+
+        assert await pool.run(job, ["run"]) == -9
+        await asyncio.sleep(0.5)
+        assert pool.stats["workers"] == 1
+        assert pool.stats["recycled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_kill_workers_that_do_not_stop(
+        monkeypatch, capsys, config_path: str, ctk_binary: str, job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "10")
+    c = make_config(config_path, ctk_binary)
+
+    pool = WorkerPool(c)
+    pool.stop_timeout = 0.2
+    await pool.setup()
+    task = asyncio.ensure_future(pool.run(job, ["run"]))
+    await asyncio.sleep(0.3)
+
+    start = time.perf_counter()
+    await pool.cleanup()
+    assert time.perf_counter() - start < 1
+    assert await task == -9
+
+    captured = capsys.readouterr()
+    assert "did not exit, killing it" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_workers_fail_to_start(capsys, config_path: str,
+                                     ctk_binary: str, job: Job):
+    c = make_config(config_path, ctk_binary)
+    c.chaos_worker_python = f"{sys.executable} -c 'import sys; sys.exit(3)'"
+
+    async with WorkerPool(c) as pool:
+        assert pool.workers == set()
+        with pytest.raises(RuntimeError):
+            await pool.run(job, ["run"])
+
+    captured = capsys.readouterr()
+    assert "failed to start (3)" in captured.err
+    assert "No Chaos Toolkit worker could be started" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_wake_up_waiting_jobs_once_no_worker_is_left(
+        monkeypatch, capsys, config_path: str, ctk_binary: str, job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "10")
+    c = make_config(config_path, ctk_binary)
+
+    async with WorkerPool(c) as pool:
+        worker = next(iter(pool.workers))
+        running = asyncio.ensure_future(pool.run(job, ["run"]))
+        waiting = [
+            asyncio.ensure_future(pool.run(create_job(), ["run"]))
+            for _ in range(2)]
+        await asyncio.sleep(0.3)
+
+        # the worker dies and cannot be replaced
+        pool.command = [sys.executable, "-c", "import sys; sys.exit(3)"]
+        worker.proc.kill()
+        assert await running == -9
+        for task in waiting:
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(task, 5)
+        assert pool.stats == {
+            "workers": 0, "idle": 0, "started": 2, "recycled": 1}
+
+    captured = capsys.readouterr()
+    assert "No Chaos Toolkit worker is left" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_cancelled_job_kills_the_worker(monkeypatch, config_path: str,
+                                              ctk_binary: str, job: Job):
+    monkeypatch.setenv("FAKE_CHAOS_SLEEP", "10")
+    c = make_config(config_path, ctk_binary)
+
+    async with WorkerPool(c) as pool:
+        pid = next(iter(pool.workers)).pid
+        task = asyncio.ensure_future(pool.run(job, ["run"]))
+        await asyncio.sleep(0.3)
+        start = time.perf_counter()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.5)
+
+        assert time.perf_counter() - start < 2
+        assert pool.stats["recycled"] == 1
+        assert [w.pid for w in pool.workers] != [pid]
+
+
+@pytest.mark.asyncio
+async def test_shell_backend_runs_jobs_in_workers(
+        monkeypatch, capsys, config_path: str, ctk_binary: str, job: Job):
+    c = make_config(config_path, ctk_binary)
+    backend = ShellBackend(c)
+    await backend.setup()
+    assert backend.pool.running is True
+
+    await backend.process_job(job)
+    await asyncio.sleep(0.1)
+    captured = capsys.readouterr()
+    # the settings went through a pipe
+    assert f"[{job.id}] chaos --settings /dev/fd/" in captured.err
+    assert f"[{job.id}] settings: " in captured.err
+    assert "azerty1234" in captured.err
+    await backend.cleanup()
+    assert backend.pool is None
+
+    monkeypatch.setenv("FAKE_CHAOS_EXIT", "1")
+    backend = ShellBackend(c)
+    await backend.setup()
+    with pytest.raises(subprocess.CalledProcessError):
+        await backend.process_job(job)
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_startup_latency_of_workers_against_binary(
+        monkeypatch, config_path: str, ctk_binary: str):
+    """
+    Benchmark of the time it takes for a job to run an empty experiment,
+    which is all startup: once with a new `chaos` process per job, once with
+    the warm workers.
+    """
+    # stands for importing the Chaos Toolkit and its extensions
+    monkeypatch.setenv("FAKE_CHAOS_IMPORT_TIME", "0.3")
+    rounds = 5
+
+    async def measure(workers: int) -> float:
+        c = make_config(config_path, ctk_binary, workers=workers)
+        backend = ShellBackend(c)
+        await backend.setup()
+        try:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                await backend.process_job(create_job())
+            return (time.perf_counter() - start) / rounds
+        finally:
+            await backend.cleanup()
+
+    binary = await measure(workers=0)
+    pool = await measure(workers=1)
+    assert pool < binary
@@ -0,0 +1,66 @@
+# type: ignore
+import json
+
+import pytest
+import respx
+
+from chaosiqagent.agent import Agent
+from chaosiqagent.client import ChaosIQClient, get_client
+from chaosiqagent.settings import load_settings
+
+
+def test_client_pool_is_configured(config_path: str):
+    c = load_settings(config_path)
+    c.http_max_connections = 3
+    c.http_max_keepalive_connections = 2
+    c.http_keepalive_expiry = 12.5
+
+    client = get_client(c)
+    pool = client._transport
+    assert pool._max_connections == 3
+    assert pool._max_keepalive_connections == 2
+    assert pool._keepalive_expiry == 12.5
+
+
+@respx.mock
+@pytest.mark.asyncio
+async def test_agent_components_share_a_single_client(config_path: str):
+    c = load_settings(config_path)
+
+    respx.post(
+        "https://console.example.com/agent/actions",
+        content=json.dumps({})
+    )
+
+    agent = Agent(c)
+    assert isinstance(agent.client, ChaosIQClient)
+    assert agent.jobs.client is agent.client
+    assert agent.heartbeat.client is agent.client
+    assert agent.heartbeat.watchdog is agent.watchdog
+
+    await agent.setup()
+    await agent.cleanup()
+    assert agent.client.is_closed
+
+
+@respx.mock
+@pytest.mark.asyncio
+async def test_client_remembers_last_response(client: ChaosIQClient):
+    respx.get("https://console.example.com/agent/jobs/queue/next",
+              status_code=204)
+    assert client.last_seen == 0
+    await client.get("/agent/jobs/queue/next")
+    first = client.last_seen
+    assert first > 0
+    await client.get("/agent/jobs/queue/next")
+    assert client.last_seen > first
+
+
+@respx.mock
+@pytest.mark.asyncio
+async def test_client_ignores_failed_responses(client: ChaosIQClient):
+    for status_code in (401, 503):
+        respx.get("https://console.example.com/agent/jobs/queue/next",
+                  status_code=status_code)
+        await client.get("/agent/jobs/queue/next")
+        assert client.last_seen == 0
@@ -0,0 +1,123 @@
+# type: ignore
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from chaosiqagent.deferred import DeferredJobs, seconds_until
+from chaosiqagent.log import configure_logging
+from chaosiqagent.metrics import DEFERRED_LATENESS
+from chaosiqagent.types import Config
+
+from fixtures.job import create_job
+
+
+def test_seconds_until():
+    now = datetime.now(timezone.utc)
+    assert 9 < seconds_until(now + timedelta(seconds=10)) <= 10
+    assert seconds_until(now - timedelta(seconds=10)) < 0
+
+    # naive dates are UTC
+    naive = datetime.utcnow() + timedelta(seconds=10)
+    assert 9 < seconds_until(naive) <= 10
+
+
+@pytest.mark.asyncio
+async def test_fire_thousands_of_jobs_on_time(capsys, config):
+    configure_logging(config)
+    observed = DEFERRED_LATENESS.count()
+    loop = asyncio.get_running_loop()
+    fired = []
+
+    async def on_due(job):
+        fired.append((job, loop.time()))
+
+    jobs = [create_job() for _ in range(5000)]
+    async with DeferredJobs(on_due) as d:
+        tasks = len(asyncio.all_tasks())
+
+        for job in jobs:
+            d.defer(job, random.uniform(0.1, 0.6))
+        deadlines = {job.id: deadline for deadline, _, job in d._heap}
+
+        # sleeping jobs are not coroutines
+        assert len(d) == len(jobs)
+        assert len(asyncio.all_tasks()) == tasks
+
+        while len(fired) < len(jobs):
+            await asyncio.sleep(0.05)
+
+    assert len(d) == 0
+    for job, at in fired:
+        assert at >= deadlines[job.id]
+    ordered = [deadlines[job.id] for job, _ in fired]
+    assert ordered == sorted(ordered)
+
+    stats = d.stats
+    assert stats["deferred"] == 0
+    assert stats["fired"] == len(jobs)
+    assert stats["lateness_mean"] < 0.05
+    assert stats["lateness_max"] >= stats["lateness_mean"]
+    assert DEFERRED_LATENESS.count() == observed + len(jobs)
+    captured = capsys.readouterr()
+    assert f"Fired {len(jobs)} deferred jobs, late by " in captured.err
+
+
+@pytest.mark.asyncio
+async def test_earlier_job_reschedules_the_timer():
+    fired = []
+
+    async def on_due(job):
+        fired.append(job)
+
+    late, early = create_job(), create_job()
+    async with DeferredJobs(on_due) as d:
+        d.defer(late, 60)
+        await asyncio.sleep(0.05)
+        d.defer(early, 0.05)
+        await asyncio.sleep(0.2)
+
+        assert fired == [early]
+        assert d.jobs() == [late]
+
+
+@pytest.mark.asyncio
+async def test_keep_firing_when_a_job_cannot_be_handed_over(capsys, config):
+    configure_logging(config)
+    fired = []
+
+    async def on_due(job):
+        if not fired:
+            fired.append(None)
+            raise RuntimeError("no slot")
+        fired.append(job)
+
+    first, second = create_job(), create_job()
+    async with DeferredJobs(on_due) as d:
+        d.defer(first, 0.01)
+        d.defer(second, 0.02)
+        await asyncio.sleep(0.1)
+
+    assert fired == [None, second]
+    captured = capsys.readouterr()
+    assert f"Failed to hand over deferred job {first.id}" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_cleanup_reports_jobs_not_run(capsys, config):
+    configure_logging(config)
+
+    async def on_due(job):
+        pass
+
+    d = DeferredJobs(on_due)
+    await d.setup()
+    assert d.running is True
+    d.defer(create_job(), 60)
+    await d.cleanup()
+    assert d.running is False
+    assert len(d.jobs()) == 1
+
+    captured = capsys.readouterr()
+    assert "1 deferred jobs were not run" in captured.err
@@ -1,4 +1,5 @@
 # type: ignore
+import asyncio
 import json
 import threading
 import time
@@ -8,16 +9,28 @@ import respx
 from unittest.mock import patch, AsyncMock
 
 from chaosiqagent.backend.base import BaseBackend
+from chaosiqagent.client import ChaosIQClient
 from chaosiqagent.heartbeat import Heartbeat
 from chaosiqagent.job import Jobs
 from chaosiqagent.json import JSONEncoder
 from chaosiqagent.log import configure_logging
+from chaosiqagent.metrics import HEARTBEAT
 from chaosiqagent.settings import load_settings
 from chaosiqagent.types import Job
+from chaosiqagent.watchdog import LoopWatchdog
+
+from fixtures.backend import BlockingBackend, DummyBackend
+from fixtures.job import create_job
+
+
+def pulses(route):
+    return [
+        json.loads(list(call[0].stream)[0]) for call in route.calls
+        if json.loads(list(call[0].stream)[0])["action"] == "heartbeat"]
 
 
 @pytest.mark.asyncio
-async def test_send_heartbeat(config_path: str):
+async def test_send_heartbeat(config_path: str, client: ChaosIQClient):
     c = load_settings(config_path)
     c.heartbeat_interval = 1  # every second
     configure_logging(c)
@@ -26,7 +39,9 @@ async def test_send_heartbeat(config_path: str):
         req_heartbeat = respx.post(
             f"https://console.example.com/agent/actions", status_code=200)
 
-        async with Heartbeat(c) as h:
+        jobs = Jobs(c, DummyBackend(c), client)
+        await jobs.setup()
+        async with Heartbeat(c, client, jobs) as h:
 
             def terminate():
                 time.sleep(1.5)
@@ -38,6 +53,7 @@ async def test_send_heartbeat(config_path: str):
             # need to have the send_pulse function being executed as spawn
             # NB: function is spawned by the setup method
             await h.aiojob.wait(timeout=5.0)
+        await jobs.cleanup()
 
         assert req_heartbeat.called
         try:
@@ -45,15 +61,22 @@ async def test_send_heartbeat(config_path: str):
             assert req_body["action"] == "heartbeat"
         except (AssertionError, json.JSONDecodeError, IndexError):
             assert False, "Unable to ensure heartbeat action was sent"
+        load = req_body["payload"]
+        assert load["backend"] == "null"
+        assert load["in_flight"] == 0
+        assert load["free_slots"] == 10
+        assert load["latency"] == {}
+        assert load["loop_lag"] == 0
 
 
 @pytest.mark.asyncio
-async def test_setup_with_invalid_interval(capsys, config_path: str):
+async def test_setup_with_invalid_interval(capsys, config_path: str,
+                                           client: ChaosIQClient):
     c = load_settings(config_path)
     c.heartbeat_interval = 0
     configure_logging(c)
 
-    h = Heartbeat(c)
+    h = Heartbeat(c, client, Jobs(c, DummyBackend(c), client))
     await h.setup()
 
     assert h.running is False
@@ -62,3 +85,101 @@ async def test_setup_with_invalid_interval(capsys, config_path: str):
     assert captured.out == ""
     assert "Heartbeat is not properly configured" in captured.err
 
+
+
+@pytest.mark.asyncio
+async def test_skip_heartbeat_when_chaosiq_heard_from_agent(
+        config_path: str, client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.max_concurrent_jobs = 2
+    backend = BlockingBackend(c)
+    steps = asyncio.Queue()
+    sent, skipped = HEARTBEAT.count("sent"), HEARTBEAT.count("skipped")
+
+    async def idle(period: float) -> None:
+        await steps.get()
+
+    async def pulse() -> None:
+        steps.put_nowait(None)
+        await asyncio.sleep(0.05)
+
+    async with respx.mock:
+        req_actions = respx.post(
+            "https://console.example.com/agent/actions", status_code=200)
+        respx.get("https://console.example.com/agent/jobs/queue/next",
+                  status_code=204)
+        respx.put("https://console.example.com/agent/jobs/statuses",
+                  status_code=200)
+
+        async with Jobs(c, backend, client) as jobs:
+            h = Heartbeat(c, client, jobs)
+            h.idle = idle
+            async with h:
+                await pulse()
+                assert len(pulses(req_actions)) == 1
+
+                # polling proves the agent is alive
+                await client.get("/agent/jobs/queue/next")
+                await pulse()
+                assert len(pulses(req_actions)) == 1
+                assert h.skipped == 1
+                assert HEARTBEAT.count("sent") == sent + 1
+                assert HEARTBEAT.count("skipped") == skipped + 1
+
+                # but not anymore
+                await pulse()
+                assert len(pulses(req_actions)) == 2
+
+                # the load changed, it is worth a pulse
+                await client.get("/agent/jobs/queue/next")
+                await jobs.start_job(create_job())
+                await pulse()
+                assert len(pulses(req_actions)) == 3
+                assert pulses(req_actions)[-1]["payload"]["in_flight"] == 1
+                assert pulses(req_actions)[-1]["payload"]["free_slots"] == 1
+
+                h._running = False
+                await pulse()
+                assert h.aiojob.closed
+            backend.release.set()
+
+
+@pytest.mark.asyncio
+async def test_report_loop_lag_of_the_watchdog(
+        config_path: str, client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.heartbeat_interval = 0.2
+    c.loop_lag_threshold = 0.1
+
+    async with respx.mock:
+        req_actions = respx.post(
+            "https://console.example.com/agent/actions", status_code=200)
+        async with Jobs(c, DummyBackend(c), client) as jobs:
+            async with LoopWatchdog(c) as w:
+                async with Heartbeat(c, client, jobs, watchdog=w):
+                    await asyncio.sleep(0.1)
+                    # blocks the event loop
+                    time.sleep(0.3)
+                    while len(pulses(req_actions)) < 2:
+                        await asyncio.sleep(0.05)
+
+    lags = [p["payload"]["loop_lag"] for p in pulses(req_actions)]
+    assert max(lags) >= 0.2
+    # taken by the pulse it was reported in
+    assert w.max_lag < 0.2
+
+
+@pytest.mark.asyncio
+async def test_record_failed_heartbeats(config_path: str,
+                                        client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.heartbeat_interval = 0.05
+    failed = HEARTBEAT.count("error")
+
+    async with respx.mock:
+        respx.post(
+            "https://console.example.com/agent/actions", status_code=503)
+        async with Jobs(c, DummyBackend(c), client) as jobs:
+            async with Heartbeat(c, client, jobs):
+                while HEARTBEAT.count("error") == failed:
+                    await asyncio.sleep(0.01)
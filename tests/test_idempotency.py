@@ -0,0 +1,71 @@
+# type: ignore
+from chaosiqagent.idempotency import SeenJobs
+from chaosiqagent.metrics import SEEN_JOBS, SEEN_JOBS_EVICTIONS
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_remember_seen_jobs():
+    seen = SeenJobs(ttl=60, max_size=10)
+
+    assert seen.seen("a") is False
+    assert seen.seen("b") is False
+    assert seen.seen("a") is True
+    assert "a" in seen
+    assert "c" not in seen
+    assert seen.stats == {"size": 2, "hits": 1, "misses": 2, "evictions": 0}
+
+
+def test_forget_jobs_after_ttl():
+    clock = Clock()
+    seen = SeenJobs(ttl=60, max_size=10, clock=clock)
+
+    seen.seen("a")
+    clock.now = 30
+    seen.seen("b")
+    clock.now = 61
+    assert "a" not in seen
+    assert "b" in seen
+
+    # the TTL runs from when the job was first seen
+    clock.now = 91
+    assert seen.seen("b") is False
+    assert seen.stats == {"size": 1, "hits": 0, "misses": 3, "evictions": 2}
+
+
+def test_forget_oldest_jobs_when_full():
+    seen = SeenJobs(ttl=60, max_size=3)
+    misses = SEEN_JOBS.values.get(("miss",), 0)
+    evictions = SEEN_JOBS_EVICTIONS.values.get((), 0)
+
+    for job_id in "abcde":
+        seen.seen(job_id)
+    seen.seen("e")
+
+    assert len(seen) == 3
+    assert "a" not in seen
+    assert "b" not in seen
+    assert "e" in seen
+    assert seen.evictions == 2
+    assert SEEN_JOBS.values[("miss",)] == misses + 5
+    assert SEEN_JOBS.values[("hit",)] >= 1
+    assert SEEN_JOBS_EVICTIONS.values[()] == evictions + 2
+
+
+def test_seed_seen_jobs():
+    seen = SeenJobs(ttl=60, max_size=10)
+    seen.update(["a", "b", "a"])
+
+    assert len(seen) == 2
+    assert seen.seen("a") is True
+    assert seen.stats == {"size": 2, "hits": 1, "misses": 0, "evictions": 0}
+
+    seen.discard("a")
+    seen.discard("c")
+    assert "a" not in seen
@@ -1,4 +1,6 @@
 # type: ignore
+import asyncio
+from datetime import datetime, timedelta, timezone
 import json
 import os
 import signal
@@ -6,23 +8,30 @@ import threading
 import time
 import uuid
 
+import httpx
 import pytest
 import respx
 from unittest.mock import patch, AsyncMock
 
 from chaosiqagent.backend.base import BaseBackend
+from chaosiqagent.client import ChaosIQClient, get_client
 from chaosiqagent.job import Jobs
 from chaosiqagent.json import JSONEncoder
 from chaosiqagent.log import configure_logging
 from chaosiqagent.settings import load_settings
 from chaosiqagent.types import Job
 
+from fixtures.backend import BlockingBackend, DummyBackend
+from fixtures.console import FakeConsole, run_console
+from fixtures.job import create_job
+
 
 @pytest.mark.asyncio
-async def test_consume_jobs(config_path: str, backend: BaseBackend, job: Job):
+async def test_consume_jobs(config_path: str, client: ChaosIQClient,
+                            backend: BaseBackend, job: Job):
     c = load_settings(config_path)
     configure_logging(c)
-    async with Jobs(c, backend) as j:
+    async with Jobs(c, backend, client) as j:
         def terminate():
             time.sleep(0.5)
             j._running = False
@@ -35,27 +44,68 @@ async def test_consume_jobs(config_path: str, backend: BaseBackend, job: Job):
                 "https://console.example.com/agent/jobs/queue/next",
                 content=json.dumps(job, cls=JSONEncoder)
             )
-            req_ack = respx.delete(
-                f"https://console.example.com/agent/jobs/queue/{job.id}",
+            req_ack = respx.post(
+                "https://console.example.com/agent/jobs/queue/acks",
                 status_code=204
             )
             req_status = respx.put(
-                f"https://console.example.com/agent/jobs/{job.id}/status",
+                "https://console.example.com/agent/jobs/statuses",
                 status_code=200
             )
             await j.consume()
+            await j.outbox.flush()
             assert req_ack.called
             assert req_status.called
 
+            body = json.loads(req_ack.calls[0][0].read())
+            assert str(job.id) in body["ids"]
             body = json.loads(req_status.calls[0][0].read())
-            assert body["status"] == "processed"
+            assert body["statuses"][0]["id"] == str(job.id)
+            assert body["statuses"][0]["status"] == "processed"
+
+
+@pytest.mark.asyncio
+async def test_drop_redelivered_jobs(
+        capsys, config_path: str, client: ChaosIQClient,
+        backend: BaseBackend, job: Job):
+    c = load_settings(config_path)
+    configure_logging(c)
+    backend.process_job = AsyncMock()
+    async with Jobs(c, backend, client) as j:
+        async with respx.mock:
+            req_ack = respx.post(
+                "https://console.example.com/agent/jobs/queue/acks",
+                status_code=204
+            )
+            respx.put(
+                "https://console.example.com/agent/jobs/statuses",
+                status_code=200
+            )
+            body = json.loads(json.dumps(job, cls=JSONEncoder))
+            for _ in range(3):
+                await j.dispatch(body)
+            await asyncio.sleep(0.1)
+            await j.outbox.flush()
+
+            # run once, but acknowledged every time
+            assert backend.process_job.call_count == 1
+            body = json.loads(req_ack.calls[0][0].read())
+            assert body["ids"] == [str(job.id)] * 3
+            assert j.seen.stats == {
+                "size": 1, "hits": 2, "misses": 1, "evictions": 0}
+
+    captured = capsys.readouterr()
+    assert f"Dropping job '{job.id}' received more than once" in captured.err
+    assert "Seen 1 jobs, ignored 2 received again and forgot 0" in \
+        captured.err
 
 
 @pytest.mark.asyncio
-async def test_consume_empty_queue(config_path: str, backend: BaseBackend):
+async def test_consume_empty_queue(config_path: str, client: ChaosIQClient,
+                                   backend: BaseBackend):
     c = load_settings(config_path)
     configure_logging(c)
-    async with Jobs(c, backend) as j:
+    async with Jobs(c, backend, client) as j:
         def terminate():
             time.sleep(0.5)
             j._running = False
@@ -73,11 +123,12 @@ async def test_consume_empty_queue(config_path: str, backend: BaseBackend):
 
 @pytest.mark.asyncio
 async def test_do_not_process_failed_job_responses(capsys, config_path: str,
+                                                   client: ChaosIQClient,
                                                    backend: BaseBackend):
     c = load_settings(config_path)
 
     configure_logging(c)
-    async with Jobs(c, backend) as j:
+    async with Jobs(c, backend, client) as j:
         def terminate():
             time.sleep(0.5)
             j._running = False
@@ -99,11 +150,12 @@ async def test_do_not_process_failed_job_responses(capsys, config_path: str,
 
 @pytest.mark.asyncio
 async def test_do_not_process_invalid_job_responses(capsys, config_path: str,
+                                                    client: ChaosIQClient,
                                                     backend: BaseBackend):
     c = load_settings(config_path)
 
     configure_logging(c)
-    async with Jobs(c, backend) as j:
+    async with Jobs(c, backend, client) as j:
         def terminate():
             time.sleep(0.5)
             j._running = False
@@ -126,11 +178,12 @@ async def test_do_not_process_invalid_job_responses(capsys, config_path: str,
 
 @pytest.mark.asyncio
 async def test_do_not_process_invalid_jobs(capsys, config_path: str,
+                                           client: ChaosIQClient,
                                            backend: BaseBackend):
     c = load_settings(config_path)
 
     configure_logging(c)
-    async with Jobs(c, backend) as j:
+    async with Jobs(c, backend, client) as j:
         def terminate():
             time.sleep(0.5)
             j._running = False
@@ -154,12 +207,14 @@ async def test_do_not_process_invalid_jobs(capsys, config_path: str,
 @patch("fixtures.backend.DummyBackend")
 @pytest.mark.asyncio
 async def test_process_job_fails_in_backend(
-        mock_backend, config_path: str, job: Job):
+        mock_backend, config_path: str, client: ChaosIQClient,
+        job: Job):
     mock_backend.process_job.side_effect = Exception("Cannot process job")
+    mock_backend.capacity = None
 
     c = load_settings(config_path)
     configure_logging(c)
-    async with Jobs(c, mock_backend) as j:
+    async with Jobs(c, mock_backend, client) as j:
         def terminate():
             time.sleep(0.5)
             j._running = False
@@ -172,17 +227,544 @@ async def test_process_job_fails_in_backend(
                 "https://console.example.com/agent/jobs/queue/next",
                 content=json.dumps(job, cls=JSONEncoder)
             )
-            req_ack = respx.delete(
-                f"https://console.example.com/agent/jobs/queue/{job.id}",
+            req_ack = respx.post(
+                "https://console.example.com/agent/jobs/queue/acks",
                 status_code=204
             )
             req_status = respx.put(
-                f"https://console.example.com/agent/jobs/{job.id}/status",
+                "https://console.example.com/agent/jobs/statuses",
                 status_code=200
             )
             await j.consume()
+            await j.outbox.flush()
             assert req_ack.called
             assert req_status.called
 
+            body = json.loads(req_ack.calls[0][0].read())
+            assert str(job.id) in body["ids"]
             body = json.loads(req_status.calls[0][0].read())
-            assert body["status"] == "failed"
+            assert body["statuses"][0]["id"] == str(job.id)
+            assert body["statuses"][0]["status"] == "failed"
+
+
+async def _dispatch_one_job(config_path: str, console: FakeConsole,
+                            delivery: str, idle: float = 1.5) -> Job:
+    c = load_settings(config_path)
+    c.job_delivery = delivery
+    configure_logging(c)
+
+    async with run_console(console) as url:
+        c.agent_url = url
+        client = get_client(c)
+        async with Jobs(c, DummyBackend(c), client) as j:
+            consumer = asyncio.create_task(j.consume())
+
+            # let the agent idle for a while before a job is queued
+            await asyncio.sleep(idle)
+            job = create_job()
+            console.push(job)
+            while str(job.id) not in console.statuses:
+                await asyncio.sleep(0.01)
+
+            j._running = False
+            await consumer
+            await client.aclose()
+
+    return job
+
+
+@pytest.mark.asyncio
+async def test_stream_dispatches_jobs_faster_with_fewer_requests(
+        config_path: str):
+    polled = FakeConsole()
+    polled_job = await _dispatch_one_job(config_path, polled, "poll")
+
+    streamed = FakeConsole()
+    streamed_job = await _dispatch_one_job(config_path, streamed, "stream")
+
+    assert polled.acked == [str(polled_job.id)]
+    assert streamed.acked == [str(streamed_job.id)]
+    assert streamed.latency(streamed_job) < polled.latency(polled_job)
+
+    fetched = polled.count("GET", "/agent/jobs/queue/next")
+    streamed_fetched = streamed.count("GET", "/agent/jobs/queue/stream")
+    assert streamed.count("GET", "/agent/jobs/queue/next") == 0
+    assert streamed_fetched == 1
+    assert streamed_fetched < fetched
+
+
+@pytest.mark.asyncio
+async def test_stream_falls_back_to_polling(capsys, config_path: str):
+    console = FakeConsole(stream=False)
+    job = await _dispatch_one_job(config_path, console, "stream", idle=0.1)
+
+    assert console.count("GET", "/agent/jobs/queue/stream") == 1
+    assert console.count("GET", "/agent/jobs/queue/next") >= 1
+    assert console.statuses[str(job.id)][0][0] == "processed"
+
+    captured = capsys.readouterr()
+    assert "falling back to polling" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_stream_skips_keepalives_and_invalid_lines(
+        capsys, config_path: str, client: ChaosIQClient,
+        backend: BaseBackend, job: Job):
+    c = load_settings(config_path)
+    c.job_delivery = "stream"
+    configure_logging(c)
+    async with Jobs(c, backend, client) as j:
+        def terminate():
+            time.sleep(0.5)
+            j._running = False
+
+        thread = threading.Thread(target=terminate, daemon=True)
+        thread.start()
+
+        async with respx.mock:
+            lines = [
+                "",
+                ": keep-alive",
+                '{"m": "h"',
+                f"data: {json.dumps(job, cls=JSONEncoder)}",
+                "",
+            ]
+            req_stream = respx.get(
+                "https://console.example.com/agent/jobs/queue/stream",
+                content="\n".join(lines),
+                headers={"Content-Type": "application/x-ndjson"}
+            )
+            req_ack = respx.post(
+                "https://console.example.com/agent/jobs/queue/acks",
+                status_code=204
+            )
+            respx.put(
+                "https://console.example.com/agent/jobs/statuses",
+                status_code=200
+            )
+            await j.consume()
+            await j.outbox.flush()
+            assert req_stream.called
+            assert req_ack.called
+
+        captured = capsys.readouterr()
+        assert "Failed to decode ChaosIQ's streamed job" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_stream_reconnects_on_failure(
+        capsys, config_path: str, client: ChaosIQClient,
+        backend: BaseBackend):
+    c = load_settings(config_path)
+    c.job_delivery = "stream"
+    configure_logging(c)
+    async with Jobs(c, backend, client) as j:
+        def terminate():
+            time.sleep(1)
+            j._running = False
+
+        thread = threading.Thread(target=terminate, daemon=True)
+        thread.start()
+
+        async with respx.mock:
+            req_stream = respx.get(
+                "https://console.example.com/agent/jobs/queue/stream",
+                status_code=500, content="oops"
+            )
+            await j.consume()
+            assert req_stream.call_count > 1
+
+        captured = capsys.readouterr()
+        assert "Failed to stream jobs from ChaosIQ: oops" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_stream_reconnects_when_interrupted(
+        capsys, config_path: str, client: ChaosIQClient,
+        backend: BaseBackend):
+    c = load_settings(config_path)
+    c.job_delivery = "stream"
+    configure_logging(c)
+    async with Jobs(c, backend, client) as j:
+        def terminate():
+            time.sleep(1)
+            j._running = False
+
+        thread = threading.Thread(target=terminate, daemon=True)
+        thread.start()
+
+        async with respx.mock:
+            req_stream = respx.get(
+                "https://console.example.com/agent/jobs/queue/stream",
+                content=httpx.ReadTimeout("too slow", request=None)
+            )
+            await j.consume()
+            assert req_stream.call_count > 1
+
+        captured = capsys.readouterr()
+        assert "Jobs stream interrupted: too slow" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_fetch_jobs_by_batch(config_path: str):
+    c = load_settings(config_path)
+    c.job_batch_size = 10
+    configure_logging(c)
+
+    console = FakeConsole()
+    jobs = [create_job() for _ in range(25)]
+    async with run_console(console) as url:
+        c.agent_url = url
+        client = get_client(c)
+        async with Jobs(c, DummyBackend(c), client) as j:
+            for job in jobs:
+                console.push(job)
+
+            consumer = asyncio.create_task(j.consume())
+            while len(console.statuses) < len(jobs):
+                await asyncio.sleep(0.01)
+
+            j._running = False
+            await consumer
+            await client.aclose()
+
+    assert sorted(console.acked) == sorted(str(job.id) for job in jobs)
+    # 10 + 10 + 5 jobs
+    assert console.count("GET", "/agent/jobs/queue/next") == 3
+
+
+@pytest.mark.asyncio
+async def test_fetch_batch_skips_invalid_jobs(
+        capsys, config_path: str, client: ChaosIQClient,
+        backend: BaseBackend, job: Job):
+    c = load_settings(config_path)
+    configure_logging(c)
+    async with Jobs(c, backend, client) as j:
+        def terminate():
+            time.sleep(0.5)
+            j._running = False
+
+        thread = threading.Thread(target=terminate, daemon=True)
+        thread.start()
+
+        async with respx.mock:
+            respx.get(
+                "https://console.example.com/agent/jobs/queue/next",
+                content=json.dumps([{"id": 12324}, job], cls=JSONEncoder),
+                headers={"Content-Type": "application/json"}
+            )
+            req_ack = respx.post(
+                "https://console.example.com/agent/jobs/queue/acks",
+                status_code=204
+            )
+            respx.put(
+                "https://console.example.com/agent/jobs/statuses",
+                status_code=200
+            )
+            await j.consume()
+            await j.outbox.flush()
+            assert req_ack.called
+
+        captured = capsys.readouterr()
+        assert "Failed to parse job" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_batch_size_follows_free_slots(
+        config_path: str, client: ChaosIQClient, backend: BaseBackend):
+    c = load_settings(config_path)
+    c.job_batch_size = 10
+    async with Jobs(c, backend, client) as j:
+        assert j.batch_size == 10
+
+        done = asyncio.Event()
+        for _ in range(j.sched.limit - 3):
+            await j.sched.spawn(done.wait())
+        assert j.free_slots == 3
+        assert j.batch_size == 3
+
+        for _ in range(3):
+            await j.sched.spawn(done.wait())
+        assert j.free_slots == 0
+        assert j.batch_size == 1
+
+        done.set()
+
+
+@pytest.mark.asyncio
+async def test_stop_interrupts_polling(config_path: str,
+                                       client: ChaosIQClient, monkeypatch):
+    c = load_settings(config_path)
+
+    async def slow_get(*args, **kwargs):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(client, "get", slow_get)
+    async with Jobs(c, DummyBackend(c), client) as j:
+        consumer = asyncio.create_task(j.consume())
+        # waiting for ChaosIQ's reply
+        await asyncio.sleep(0.5)
+        j.stop.set()
+        await asyncio.wait_for(consumer, 0.1)
+
+
+@pytest.mark.asyncio
+async def test_drain_running_jobs_and_hand_back_the_others(
+        config_path: str):
+    c = load_settings(config_path)
+    c.max_concurrent_jobs = 1
+    c.drain_timeout = 5
+    configure_logging(c)
+    console = FakeConsole()
+    backend = BlockingBackend(c)
+    running, queued, deferred = [create_job() for _ in range(3)]
+    deferred.run_at = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    async with run_console(console) as url:
+        c.agent_url = url
+        client = get_client(c)
+        async with Jobs(c, backend, client) as j:
+            for job in (running, queued, deferred):
+                j.seen.add(str(job.id))
+                await j.handle_job(job)
+            await asyncio.sleep(0.05)
+            assert list(j.in_flight) == [str(running.id)]
+
+            drain = asyncio.create_task(j.drain())
+            await asyncio.sleep(0.1)
+            # still waiting for the running job
+            assert not drain.done()
+            assert len(j.deferred) == 0
+
+            backend.release.set()
+            await asyncio.wait_for(drain, 1)
+            # the scheduler did not run the queued job
+            assert backend.max_running == 1
+            assert j.in_flight == {}
+            # the handed back jobs are run when delivered again
+            assert str(queued.id) not in j.seen
+            assert str(deferred.id) not in j.seen
+        await client.aclose()
+
+    statuses = {
+        job_id: [status for status, _ in s]
+        for job_id, s in console.statuses.items()}
+    assert statuses == {
+        str(running.id): ["processed"],
+        str(queued.id): ["requeued"],
+        str(deferred.id): ["requeued"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_drain_when_terminated_while_saturated(config_path: str):
+    c = load_settings(config_path)
+    c.max_concurrent_jobs = 1
+    c.drain_timeout = 0.2
+    configure_logging(c)
+    console = FakeConsole()
+    backend = BlockingBackend(c)
+    running, queued, deferred, unfetched = [create_job() for _ in range(4)]
+    deferred.run_at = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    async with run_console(console) as url:
+        c.agent_url = url
+        client = get_client(c)
+        async with Jobs(c, backend, client) as j:
+            console.push(running)
+            consumer = asyncio.create_task(j.consume())
+            while not backend.running:
+                await asyncio.sleep(0.01)
+            for job in (queued, deferred):
+                await j.handle_job(job)
+            console.push(unfetched)
+            await asyncio.sleep(0.1)
+            assert j.free_slots == 0
+
+            # as the agent does when it gets a signal
+            start = time.monotonic()
+            j.stop.set()
+            await asyncio.wait_for(consumer, 0.2)
+            await j.drain()
+            assert time.monotonic() - start < 1
+        await client.aclose()
+
+    statuses = {
+        job_id: [status for status, _ in s]
+        for job_id, s in console.statuses.items()}
+    assert statuses == {
+        str(running.id): ["interrupted"],
+        str(queued.id): ["requeued"],
+        str(deferred.id): ["requeued"],
+    }
+    # never fetched, it is still in ChaosIQ's queue
+    assert console.queue.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_drain_cuts_off_jobs_past_deadline(capsys, config_path: str):
+    c = load_settings(config_path)
+    c.drain_timeout = 0.2
+    configure_logging(c)
+    console = FakeConsole()
+    backend = BlockingBackend(c)
+    job = create_job()
+
+    async with run_console(console) as url:
+        c.agent_url = url
+        client = get_client(c)
+        async with Jobs(c, backend, client) as j:
+            await j.start_job(job)
+            await asyncio.sleep(0.05)
+
+            start = time.monotonic()
+            await j.drain()
+            assert 0.2 <= time.monotonic() - start < 1
+            assert backend.running == 0
+            assert j.in_flight == {}
+        await client.aclose()
+
+    assert [s for s, _ in console.statuses[str(job.id)]] == ["interrupted"]
+    captured = capsys.readouterr()
+    assert "Draining 1 running jobs, for 0.2s at most" in captured.err
+    assert f"Job '{job.id}' was cut off" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_report_load(config_path: str, client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.max_concurrent_jobs = 1
+    backend = BlockingBackend(c)
+    async with Jobs(c, backend, client) as j:
+        assert j.load == {
+            "backend": "null", "in_flight": 0, "pending": 0,
+            "free_slots": 1, "latency": {}}
+
+        await j.start_job(create_job())
+        await j.start_job(create_job())
+        await asyncio.sleep(0.1)
+        assert j.load["in_flight"] == 1
+        assert j.load["pending"] == 1
+        assert j.load["free_slots"] == 0
+
+        backend.release.set()
+        await asyncio.sleep(0.05)
+        latency = j.load["latency"]
+        assert list(latency) == ["p50", "p90", "p99"]
+        # the second job waited for the first one
+        assert 0.1 <= latency["p50"] <= latency["p99"] < 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_holds_as_many_jobs_as_the_backend(config_path: str):
+    c = load_settings(config_path)
+    c.max_concurrent_jobs = 2
+    backend = DummyBackend(c)
+    client = get_client(c)
+    async with Jobs(c, backend, client) as j:
+        assert j.sched.limit == 2
+
+    with patch.object(DummyBackend, "capacity", 7):
+        async with Jobs(c, backend, client) as j:
+            assert j.sched.limit == 7
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_stop_fetching_jobs_while_saturated(config_path: str):
+    c = load_settings(config_path)
+    c.max_concurrent_jobs = 2
+    c.max_pending_jobs = 1
+    configure_logging(c)
+
+    console = FakeConsole()
+    jobs = [create_job() for _ in range(5)]
+    backend = BlockingBackend(c)
+    async with run_console(console) as url:
+        c.agent_url = url
+        client = get_client(c)
+        async with Jobs(c, backend, client) as j:
+            assert j.sched.limit == 2
+            assert j.sched.pending_limit == 1
+
+            for job in jobs:
+                console.push(job)
+
+            consumer = asyncio.create_task(j.consume())
+            await asyncio.sleep(1)
+
+            # unstarted jobs stay in the console's queue
+            assert backend.running == 2
+            assert len(console.acked) == 2
+            assert console.queue.qsize() == 3
+
+            backend.release.set()
+            while len(console.statuses) < len(jobs):
+                await asyncio.sleep(0.01)
+
+            j._running = False
+            await consumer
+            await client.aclose()
+
+    assert backend.max_running == 2
+    assert sorted(console.acked) == sorted(str(job.id) for job in jobs)
+
+
+@pytest.mark.asyncio
+async def test_terminate_while_saturated(
+        config_path: str, client: ChaosIQClient, job: Job):
+    c = load_settings(config_path)
+    c.max_concurrent_jobs = 1
+    configure_logging(c)
+
+    backend = BlockingBackend(c)
+    async with Jobs(c, backend, client) as j:
+        async with respx.mock:
+            respx.get(
+                "https://console.example.com/agent/jobs/queue/next",
+                content=json.dumps(job, cls=JSONEncoder)
+            )
+            respx.post(
+                "https://console.example.com/agent/jobs/queue/acks",
+                status_code=204
+            )
+            consumer = asyncio.create_task(j.consume())
+            while not backend.running:
+                await asyncio.sleep(0.01)
+            assert j.free_slots == 0
+
+            # as the agent's signal handler does
+            j.stop.set()
+            await asyncio.wait_for(consumer, 0.2)
+            assert j.running is False
+            assert backend.running == 1
+            backend.release.set()
+
+
+@pytest.mark.asyncio
+async def test_defer_jobs_until_run_at(config_path: str, client: ChaosIQClient,
+                                       job: Job):
+    c = load_settings(config_path)
+    configure_logging(c)
+
+    backend = BlockingBackend(c)
+    backend.release.set()
+    deferred = job.copy(update={
+        "run_at": datetime.now(timezone.utc) + timedelta(seconds=0.3)})
+    async with Jobs(c, backend, client) as j:
+        await j.handle_job(deferred)
+        assert len(j.deferred) == 1
+        assert j.sched.active_count == 0
+
+        await asyncio.sleep(0.5)
+        assert len(j.deferred) == 0
+        assert backend.max_running == 1
+        assert j.outbox.statuses[0]["status"] == "processed"
+
+        # jobs due in the past are started right away
+        past = job.copy(update={
+            "run_at": datetime.now(timezone.utc) - timedelta(seconds=1)})
+        await j.handle_job(past)
+        assert len(j.deferred) == 0
+        assert j.sched.active_count == 1
+        j.outbox.statuses.clear()
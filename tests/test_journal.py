@@ -0,0 +1,238 @@
+# type: ignore
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from chaosiqagent.backend.base import BaseBackend
+from chaosiqagent.client import ChaosIQClient
+from chaosiqagent.job import Jobs
+from chaosiqagent.journal import Journal
+from chaosiqagent.json import JSONEncoder
+from chaosiqagent.log import configure_logging
+from chaosiqagent.outbox import Outbox
+from chaosiqagent.settings import load_settings
+
+from fixtures.job import create_job
+
+
+@pytest.fixture
+def journal_path(tmp_path) -> str:
+    return str(tmp_path / "jobs.journal")
+
+
+@pytest.mark.asyncio
+async def test_journal_is_disabled_by_default(capsys, config_path: str):
+    c = load_settings(config_path)
+    configure_logging(c)
+
+    async with Journal(c) as j:
+        assert j.enabled is False
+        assert j.running is False
+        j.record(create_job(), "received")
+        assert j.unfinished == {}
+        assert j.jobs() == ([], [])
+
+    captured = capsys.readouterr()
+    assert "Jobs journal is disabled" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_replay_unfinished_jobs(config_path: str, journal_path: str):
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    waiting, running, done = create_job(), create_job(), create_job()
+
+    async with Journal(c) as j:
+        assert j.running is True
+        for job in (waiting, running, done):
+            j.record(job, "received")
+        j.record(running, "started")
+        j.record(done, "started")
+        j.record(done, "finished")
+
+    assert j.running is False
+    with open(journal_path) as f:
+        assert len(f.readlines()) == 6
+    # it holds the jobs' access tokens
+    assert os.stat(journal_path).st_mode & 0o777 == 0o600
+
+    async with Journal(c) as j:
+        received, interrupted = j.jobs()
+        assert received == [waiting]
+        assert interrupted == [running]
+
+        # only unfinished jobs are kept once compacted
+        with open(journal_path) as f:
+            assert len(f.readlines()) == 2
+
+
+@pytest.mark.asyncio
+async def test_skip_invalid_records(capsys, config_path: str,
+                                    journal_path: str):
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    configure_logging(c)
+    job = create_job()
+
+    with open(journal_path, "w") as f:
+        f.write(json.dumps({"id": "1234", "state": "received", "job": {}}))
+        f.write("\n")
+        f.write(json.dumps(
+            {"id": str(job.id), "state": "received", "job": job},
+            cls=JSONEncoder))
+        f.write("\n")
+        # killed while writing
+        f.write('{"id": "')
+
+    async with Journal(c) as j:
+        assert j.jobs() == ([job], [])
+
+    captured = capsys.readouterr()
+    assert "Skipping invalid journal record" in captured.err
+    assert "Failed to parse journaled job 1234" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_compact_periodically(config_path: str, journal_path: str):
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    c.journal_compact_threshold = 10
+
+    async with Journal(c) as j:
+        pending = create_job()
+        j.record(pending, "received")
+        for _ in range(5):
+            job = create_job()
+            j.record(job, "received")
+            j.record(job, "started")
+            j.record(job, "finished")
+        await j.flush()
+
+        with open(journal_path) as f:
+            lines = f.readlines()
+        assert len(lines) == 1
+        assert json.loads(lines[0])["id"] == str(pending.id)
+
+        # the journal keeps being appended once compacted
+        j.record(pending, "started")
+        await j.flush()
+        with open(journal_path) as f:
+            assert len(f.readlines()) == 2
+
+
+@pytest.mark.asyncio
+async def test_acks_wait_for_the_journal(monkeypatch, config_path: str,
+                                         journal_path: str,
+                                         client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    c.journal_sync_interval = 60
+    job = create_job()
+    on_disk = []
+
+    async def send_acks(acks):
+        with open(journal_path) as f:
+            on_disk.append(f.read())
+        return []
+
+    async with Journal(c) as j:
+        outbox = Outbox(c, client, j)
+        monkeypatch.setattr(outbox, "send_acks", send_acks)
+        j.record(job, "received")
+        outbox.ack(str(job.id))
+        await outbox.flush()
+
+    assert str(job.id) in on_disk[0]
+
+
+@pytest.mark.asyncio
+async def test_jobs_resume_from_journal(config_path: str, journal_path: str,
+                                        client: ChaosIQClient,
+                                        backend: BaseBackend):
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    waiting, running = create_job(), create_job()
+
+    async with Journal(c) as j:
+        j.record(waiting, "received")
+        j.record(running, "received")
+        j.record(running, "started")
+
+    async with Jobs(c, backend, client) as jobs:
+        await jobs.resume()
+        await asyncio.sleep(0.1)
+
+        statuses = {s["id"]: s["status"] for s in jobs.outbox.statuses}
+        assert statuses == {
+            str(waiting.id): "processed",
+            str(running.id): "interrupted",
+        }
+        jobs.outbox.statuses.clear()
+        assert jobs.journal.unfinished == {}
+
+
+@pytest.mark.asyncio
+async def test_journaled_jobs_are_not_run_again(
+        config_path: str, journal_path: str, client: ChaosIQClient,
+        backend: BaseBackend):
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    done = create_job()
+
+    async with Journal(c) as j:
+        j.record(done, "received")
+        j.record(done, "started")
+        j.record(done, "finished")
+
+    async with Jobs(c, backend, client) as jobs:
+        assert jobs.journal.known == [str(done.id)]
+        assert str(done.id) in jobs.seen
+        jobs.outbox.acks.clear()
+
+
+@pytest.mark.asyncio
+async def test_requeued_jobs_are_run_when_redelivered(
+        config_path: str, journal_path: str, client: ChaosIQClient,
+        backend: BaseBackend):
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    requeued = create_job()
+
+    async with Journal(c) as j:
+        j.record(requeued, "received")
+        j.record(requeued, "requeued")
+        assert j.unfinished == {}
+
+    async with Jobs(c, backend, client) as jobs:
+        assert jobs.journal.known == []
+        assert jobs.journal.recovered == {}
+        assert str(requeued.id) not in jobs.seen
+
+
+@pytest.mark.asyncio
+async def test_journal_overhead_per_job(config_path: str, journal_path: str):
+    """
+    Benchmark of the time spent journaling the three transitions of a job.
+    """
+    c = load_settings(config_path)
+    c.journal_path = journal_path
+    jobs = [create_job() for _ in range(2000)]
+
+    async with Journal(c) as j:
+        start = time.perf_counter()
+        for job in jobs:
+            j.record(job, "received")
+            j.record(job, "started")
+            j.record(job, "finished")
+        recorded = time.perf_counter() - start
+        await j.flush()
+        written = time.perf_counter() - start
+
+    # a small fraction of the cost of fetching and dispatching a job,
+    # loose enough for a busy CI runner
+    assert recorded / len(jobs) < 0.005
+    assert written / len(jobs) < 0.01
+    assert os.path.getsize(journal_path) > 0
@@ -0,0 +1,153 @@
+# type: ignore
+import asyncio
+import socket
+
+import httpx
+import pytest
+
+from chaosiqagent.agent import Agent
+from chaosiqagent.log import configure_logging
+from chaosiqagent.metrics import REGISTRY, Counter, Gauge, Histogram, \
+    Metric, MetricsServer, render
+from chaosiqagent.settings import load_settings
+
+from fixtures.console import FakeConsole, run_console
+from fixtures.job import create_job
+
+
+@pytest.fixture
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def metrics():
+    """
+    Metrics created by the test, removed from the registry afterwards.
+    """
+    created = []
+    yield created
+    for metric in created:
+        REGISTRY.remove(metric)
+
+
+def test_histogram(metrics):
+    h = Histogram("test_seconds", "Test", ["kind"], buckets=(0.1, 1.0))
+    metrics.append(h)
+    for value in (0.05, 0.1, 0.5, 2.0):
+        h.observe(value, "a")
+    h.observe(0.5, "b")
+    assert h.count("a") == 4
+    assert h.count("c") == 0
+
+    assert h.render() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{kind="a",le="0.1"} 2',
+        'test_seconds_bucket{kind="a",le="1.0"} 3',
+        'test_seconds_bucket{kind="a",le="+Inf"} 4',
+        'test_seconds_sum{kind="a"} 2.65',
+        'test_seconds_count{kind="a"} 4',
+        'test_seconds_bucket{kind="b",le="0.1"} 0',
+        'test_seconds_bucket{kind="b",le="1.0"} 1',
+        'test_seconds_bucket{kind="b",le="+Inf"} 1',
+        'test_seconds_sum{kind="b"} 0.5',
+        'test_seconds_count{kind="b"} 1',
+    ]
+
+
+def test_metric_kinds_render_their_samples(metrics):
+    m = Metric("test", "Test")
+    metrics.append(m)
+    with pytest.raises(NotImplementedError):
+        m.render()
+
+
+def test_counter_and_gauge(metrics):
+    c = Counter("test_total", "Test", ["kind"])
+    g = Gauge("test_gauge", "Test")
+    metrics.extend([c, g])
+    c.inc("a")
+    c.inc("a", amount=2)
+    assert c.samples() == ['test_total{kind="a"} 3.0']
+
+    assert g.samples() == []
+    g.set_function(lambda: 7)
+    assert g.samples() == ["test_gauge 7"]
+
+    text = render()
+    assert text.endswith("test_gauge 7\n")
+    assert "# TYPE test_total counter\n" in text
+
+
+@pytest.mark.asyncio
+async def test_serve_metrics(config_path: str, free_port: int):
+    c = load_settings(config_path)
+    assert MetricsServer(c).running is False
+    c.metrics_port = free_port
+
+    async with MetricsServer(c) as server:
+        assert server.running is True
+        async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{free_port}") as client:
+            resp = await client.get("/metrics")
+            assert resp.status_code == 200
+            assert resp.headers["content-type"].startswith("text/plain")
+            assert "# TYPE chaosiq_agent_poll_seconds histogram" in resp.text
+
+            resp = await client.get("/")
+            assert resp.status_code == 404
+    assert server.running is False
+
+
+@pytest.mark.asyncio
+async def test_port_in_use(capsys, config_path: str):
+    c = load_settings(config_path)
+    configure_logging(c)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        c.metrics_port = sock.getsockname()[1]
+
+        async with MetricsServer(c) as server:
+            assert server.running is False
+
+    captured = capsys.readouterr()
+    assert f"Cannot serve metrics on 127.0.0.1:{c.metrics_port}" in \
+        captured.err
+
+
+@pytest.mark.asyncio
+async def test_agent_records_metrics(config_path: str, free_port: int):
+    c = load_settings(config_path)
+    c.metrics_port = free_port
+    console = FakeConsole(stream=False)
+    job = create_job()
+
+    async with run_console(console) as url:
+        c.agent_url = url
+        agent = Agent(c)
+        await agent.setup()
+        consumer = asyncio.ensure_future(agent.jobs.consume())
+        console.push(job)
+        while str(job.id) not in console.statuses:
+            await asyncio.sleep(0.01)
+
+        async with httpx.AsyncClient() as client:
+            resp = await client.get(f"http://127.0.0.1:{free_port}/metrics")
+        agent.stop.set()
+        await consumer
+        await agent.cleanup()
+
+    samples = dict(
+        line.rsplit(" ", 1) for line in resp.text.splitlines()
+        if not line.startswith("#"))
+    assert int(samples['chaosiq_agent_poll_seconds_count{result="jobs"}'])
+    assert int(samples["chaosiq_agent_fetch_to_spawn_seconds_count"])
+    assert int(samples['chaosiq_agent_job_seconds_count{backend="null"}'])
+    assert int(
+        samples['chaosiq_agent_outbox_request_seconds_count{kind="ack"}'])
+    assert samples["chaosiq_agent_jobs_active"] == "0"
+    assert samples["chaosiq_agent_jobs_pending"] == "0"
@@ -0,0 +1,279 @@
+# type: ignore
+import asyncio
+import json
+
+import httpx
+import pytest
+import respx
+
+from chaosiqagent.client import ChaosIQClient
+from chaosiqagent.log import configure_logging
+from chaosiqagent.outbox import Outbox
+from chaosiqagent.settings import load_settings
+from chaosiqagent.types import Job
+
+
+@pytest.mark.asyncio
+async def test_flush_by_bulk(config_path: str, client: ChaosIQClient,
+                             job: Job):
+    c = load_settings(config_path)
+    c.outbox_flush_interval = 60
+
+    async with respx.mock:
+        req_ack = respx.post(
+            "https://console.example.com/agent/jobs/queue/acks",
+            status_code=204
+        )
+        req_status = respx.put(
+            "https://console.example.com/agent/jobs/statuses",
+            status_code=200
+        )
+
+        async with Outbox(c, client) as o:
+            assert o.running is True
+            o.ack(str(job.id))
+            o.update_status(str(job.id), "processed")
+            assert len(o) == 2
+            assert not req_ack.called
+
+        assert o.running is False
+        assert len(o) == 0
+        assert req_ack.call_count == 1
+        assert req_status.call_count == 1
+        body = json.loads(req_status.calls[0][0].read())
+        assert body == {
+            "statuses": [{
+                "id": str(job.id), "status": "processed", "info": None}]
+        }
+
+
+@pytest.mark.asyncio
+async def test_flush_when_full(config_path: str, client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.outbox_flush_interval = 60
+    c.outbox_batch_size = 3
+
+    async with respx.mock:
+        req_ack = respx.post(
+            "https://console.example.com/agent/jobs/queue/acks",
+            status_code=204
+        )
+
+        async with Outbox(c, client) as o:
+            for job_id in ("a", "b", "c"):
+                o.ack(job_id)
+            await asyncio.sleep(0.1)
+
+            assert len(o) == 0
+            assert req_ack.call_count == 1
+            body = json.loads(req_ack.calls[0][0].read())
+            assert body == {"ids": ["a", "b", "c"]}
+
+
+@pytest.mark.asyncio
+async def test_fallback_to_individual_calls(capsys, config_path: str,
+                                            client: ChaosIQClient):
+    c = load_settings(config_path)
+    configure_logging(c)
+
+    async with respx.mock:
+        req_bulk_ack = respx.post(
+            "https://console.example.com/agent/jobs/queue/acks",
+            status_code=404
+        )
+        req_bulk_status = respx.put(
+            "https://console.example.com/agent/jobs/statuses",
+            status_code=404
+        )
+        req_ack = respx.delete(
+            "https://console.example.com/agent/jobs/queue/a",
+            status_code=204
+        )
+        req_status = respx.put(
+            "https://console.example.com/agent/jobs/a/status",
+            status_code=200
+        )
+
+        async with Outbox(c, client) as o:
+            o.ack("a")
+            o.update_status("a", "started")
+            o.update_status("a", "processed")
+            await o.flush()
+            assert o.bulk is False
+
+            o.ack("a")
+            await o.flush()
+
+        assert req_bulk_ack.call_count == 1
+        assert req_bulk_status.call_count == 0
+        assert req_ack.call_count == 2
+        statuses = [
+            json.loads(r.read())["status"] for r, _ in req_status.calls]
+        assert statuses == ["started", "processed"]
+
+    captured = capsys.readouterr()
+    assert "falling back to individual calls" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_keep_undelivered_items(capsys, config_path: str,
+                                      client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.outbox_flush_interval = 60
+    configure_logging(c)
+
+    o = Outbox(c, client)
+    async with respx.mock:
+        respx.post(
+            "https://console.example.com/agent/jobs/queue/acks",
+            content=httpx.ConnectError("unreachable", request=None)
+        )
+        respx.put(
+            "https://console.example.com/agent/jobs/statuses",
+            status_code=503, content="later"
+        )
+
+        o.ack("a")
+        o.update_status("a", "processed")
+        await o.flush()
+        assert o.acks == ["a"]
+        assert len(o.statuses) == 1
+
+        o.bulk = False
+        respx.delete(
+            "https://console.example.com/agent/jobs/queue/a",
+            status_code=204
+        )
+        respx.put(
+            "https://console.example.com/agent/jobs/a/status",
+            status_code=503, content="later"
+        )
+        await o.flush()
+        assert o.acks == []
+        assert len(o.statuses) == 1
+
+    captured = capsys.readouterr()
+    assert "Failed to reach ChaosIQ: unreachable" in captured.err
+    assert "Failed to report jobs status: later" in captured.err
+    assert "Failed to report job status: later" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_drop_refused_items(capsys, config_path: str,
+                                  client: ChaosIQClient):
+    c = load_settings(config_path)
+    configure_logging(c)
+
+    o = Outbox(c, client)
+    async with respx.mock:
+        respx.post(
+            "https://console.example.com/agent/jobs/queue/acks",
+            status_code=400, content="unknown job"
+        )
+
+        o.ack("a")
+        await o.flush()
+        assert len(o) == 0
+
+    captured = capsys.readouterr()
+    assert "ChaosIQ refused to acknowledge jobs: unknown job" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_only_keep_items_not_delivered(config_path: str,
+                                             client: ChaosIQClient):
+    c = load_settings(config_path)
+
+    o = Outbox(c, client)
+    o.bulk = False
+    async with respx.mock:
+        req_ack_a = respx.delete(
+            "https://console.example.com/agent/jobs/queue/a",
+            status_code=204
+        )
+        respx.delete(
+            "https://console.example.com/agent/jobs/queue/b",
+            status_code=503
+        )
+        req_status_a = respx.put(
+            "https://console.example.com/agent/jobs/a/status",
+            status_code=200
+        )
+        respx.put(
+            "https://console.example.com/agent/jobs/b/status",
+            status_code=503
+        )
+
+        o.ack("a")
+        o.ack("b")
+        o.update_status("a", "processed")
+        o.update_status("b", "processed")
+        o.update_status("a", "failed")
+        await o.flush()
+
+        assert o.acks == ["b"]
+        # the transitions following the one not delivered are kept too
+        assert [(s["id"], s["status"]) for s in o.statuses] == [
+            ("b", "processed"), ("a", "failed")]
+        assert req_ack_a.call_count == 1
+        assert req_status_a.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_items_when_full(capsys, config_path: str,
+                                           client: ChaosIQClient):
+    c = load_settings(config_path)
+    c.outbox_max_size = 3
+    configure_logging(c)
+
+    o = Outbox(c, client)
+    async with respx.mock:
+        respx.post(
+            "https://console.example.com/agent/jobs/queue/acks",
+            status_code=503
+        )
+        respx.put(
+            "https://console.example.com/agent/jobs/statuses",
+            status_code=503
+        )
+
+        for job_id in ("a", "b", "c"):
+            o.ack(job_id)
+            o.update_status(job_id, "processed")
+        await o.flush()
+        assert o.acks == ["a", "b", "c"]
+        assert o.statuses == []
+
+        o.update_status("d", "processed")
+        o.ack("d")
+        await o.flush()
+        assert o.acks == ["b", "c", "d"]
+
+    captured = capsys.readouterr()
+    assert "Outbox is full, dropping 3 items" in captured.err
+    assert "Outbox is full, dropping 2 items" in captured.err
+
+
+@pytest.mark.asyncio
+async def test_flush_one_at_a_time(monkeypatch, config_path: str,
+                                   client: ChaosIQClient):
+    c = load_settings(config_path)
+    o = Outbox(c, client)
+    sent = []
+    sending = []
+
+    async def send_acks(acks):
+        sending.append(len(sending))
+        await asyncio.sleep(0.05)
+        assert len(sending) == 1
+        sending.pop()
+        sent.extend(acks)
+        return []
+
+    monkeypatch.setattr(o, "send_acks", send_acks)
+    o.ack("a")
+    first = asyncio.ensure_future(o.flush())
+    await asyncio.sleep(0)
+    o.ack("b")
+    await asyncio.gather(first, o.flush())
+    assert sent == ["a", "b"]
@@ -2,7 +2,7 @@ import asyncio
 
 import pytest
 
-from chaosiqagent.utils import raise_if_errored
+from chaosiqagent.utils import Stop, percentiles, raise_if_errored
 
 
 @pytest.mark.asyncio
@@ -41,3 +41,66 @@ async def test_only_log_how_many_pendings():
     t = asyncio.create_task(wait_for_me())
     raise_if_errored([], [t])
     await asyncio.wait([t])
+
+
+def test_percentiles():
+    assert percentiles([], (50, 99)) == {}
+    assert percentiles([3.0], (50, 99)) == {"p50": 3.0, "p99": 3.0}
+    values = [float(v) for v in range(100, 0, -1)]
+    assert percentiles(values, (0, 50, 90, 99, 100)) == {
+        "p0": 1.0, "p50": 50.0, "p90": 90.0, "p99": 99.0, "p100": 100.0}
+
+
+@pytest.mark.asyncio
+async def test_stop_cuts_sleeps_short():
+    stop = Stop()
+    assert await stop.sleep(0.01) is False
+
+    loop = asyncio.get_running_loop()
+    loop.call_later(0.05, stop.set)
+    start = loop.time()
+    assert await stop.sleep(5) is True
+    assert loop.time() - start < 0.5
+    # stopped for good
+    assert await stop.sleep(5) is True
+
+
+@pytest.mark.asyncio
+async def test_stop_interrupts_awaitables():
+    stop = Stop()
+
+    async def answer(delay: float) -> int:
+        await asyncio.sleep(delay)
+        return 42
+
+    assert await stop.interrupt(answer(0)) == 42
+
+    aw = asyncio.ensure_future(answer(5))
+    asyncio.get_running_loop().call_later(0.05, stop.set)
+    assert await stop.interrupt(aw) is None
+    await asyncio.sleep(0)
+    assert aw.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_stop_iterations():
+    stop = Stop()
+
+    async def count():
+        for i in range(3):
+            yield i
+        await asyncio.sleep(5)
+        yield 3
+
+    items = []
+    async for i in stop.iterate(count()):
+        items.append(i)
+        if i == 2:
+            asyncio.get_running_loop().call_later(0.05, stop.set)
+    assert items == [0, 1, 2]
+
+    async def letters():
+        yield "a"
+        yield "b"
+
+    assert [c async for c in Stop().iterate(letters())] == ["a", "b"]
@@ -0,0 +1,81 @@
+# type: ignore
+import asyncio
+import json
+import os
+import time
+from traceback import FrameSummary
+
+import pytest
+
+from chaosiqagent.log import configure_logging
+from chaosiqagent.metrics import SLOW_CALLBACKS
+from chaosiqagent.settings import load_settings
+from chaosiqagent.watchdog import ASYNCIO_DIR, PACKAGE_DIR, LoopWatchdog, \
+    get_location, trim_stack
+
+
+def block(seconds: float) -> None:
+    # such as a synchronous call to a subprocess
+    time.sleep(seconds)
+
+
+def test_get_location():
+    outside = FrameSummary("/usr/lib/python3/yaml/loader.py", 1, "load",
+                           lookup_line=False)
+    agent = FrameSummary(os.path.join(PACKAGE_DIR, "backend", "shell.py"), 1,
+                         "process_job", lookup_line=False)
+    assert get_location([]) == "unknown"
+    assert get_location([outside]) == "loader.py:load"
+    assert get_location([agent, outside]) == \
+        "chaosiqagent/backend/shell.py:process_job"
+
+
+def test_trim_stack():
+    loop = FrameSummary(os.path.join(ASYNCIO_DIR, "events.py"), 1, "_run",
+                        lookup_line=False)
+    callback = FrameSummary("/app/main.py", 1, "main", lookup_line=False)
+    assert trim_stack([loop, callback]) == [callback]
+    assert trim_stack([callback]) == [callback]
+
+
+@pytest.mark.asyncio
+async def test_report_blocking_callbacks(capsys, config_path: str):
+    c = load_settings(config_path)
+    c.log_format = "structured"
+    c.loop_lag_threshold = 0.1
+    configure_logging(c)
+    reported = SLOW_CALLBACKS.values.get(("test_watchdog.py:block",), 0)
+
+    async with LoopWatchdog(c) as w:
+        assert w.running is True
+        await asyncio.sleep(0.2)
+        assert w.slow_callbacks == 0
+
+        block(0.4)
+        await asyncio.sleep(0.2)
+        assert w.slow_callbacks == 1
+    assert w.running is False
+    assert w.thread is None
+
+    assert SLOW_CALLBACKS.values[("test_watchdog.py:block",)] == reported + 1
+    records = [
+        json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    slow = [r for r in records if r["message"].startswith("Event loop")]
+    assert len(slow) == 1
+    assert slow[0]["message"] == \
+        f"Event loop was blocked for at least {slow[0]['blocked']:.3f}s " \
+        f"by test_watchdog.py:block"
+    assert slow[0]["location"] == "test_watchdog.py:block"
+    assert slow[0]["blocked"] >= 0.3
+    assert slow[0]["trace"][-2].endswith(
+        "in test_report_blocking_callbacks")
+    assert slow[0]["trace"][-1].endswith("in block")
+
+
+@pytest.mark.asyncio
+async def test_disabled_watchdog(config_path: str):
+    c = load_settings(config_path)
+    c.loop_lag_threshold = 0
+    async with LoopWatchdog(c) as w:
+        assert w.running is False
+        assert w.thread is None